@@ -0,0 +1,137 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmarks of rookcheck's own hot paths. Absolute timings depend on
+# the machine, so every benchmark is expressed relative to a fixed reference
+# workload timed in the same run, and it is that ratio which is compared
+# against baselines.json. Regressions are only reported unless
+# --benchmark-check is given, in which case benchmarks slower than
+# --benchmark-tolerance times their baseline fail. Record new baselines with
+# --benchmark-update-baselines.
+
+import json
+import logging
+import os
+import statistics
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import pytest
+
+
+logger = logging.getLogger(__name__)
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    median: float
+    minimum: float
+    rounds: int
+    relative: float
+
+
+def _load_baselines() -> Dict[str, Dict[str, float]]:
+    try:
+        with open(BASELINES) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _time(func: Callable, *args, rounds: int = 5,
+          setup: Optional[Callable] = None, **kwargs) -> List[float]:
+    timings: List[float] = []
+    for i in range(rounds + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        if i > 0:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _reference_workload():
+    # A bit of everything the benchmarks spend their time on: string
+    # handling, dicts, sorting and serialisation
+    data = {f'key-{i}': [str(j) * 3 for j in range(20)] for i in range(2000)}
+    text = json.dumps(data, sort_keys=True)
+    sorted(json.loads(text).items(), key=lambda item: item[0][::-1])
+    '\n'.join(line.replace('1', 'one') for line in text.split(','))
+
+
+@pytest.fixture(scope="session")
+def benchmark_reference() -> float:
+    """Median time of the reference workload on this machine, in this run"""
+    reference = statistics.median(_time(_reference_workload, rounds=10))
+    logger.info(f"Benchmark reference workload: {reference:.4f}s")
+    return reference
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(request):
+    results: Dict[str, BenchmarkResult] = {}
+    yield results
+
+    baselines = _load_baselines()
+    logger.info("Benchmark results (median, min, relative, baseline):")
+    for r in sorted(results.values()):
+        baseline = baselines.get(r.name, {}).get('relative')
+        logger.info(f"  {r.name:40} {r.median:8.4f}s {r.minimum:8.4f}s "
+                    f"{r.relative:8.2f} "
+                    f"{baseline if baseline is not None else '-':>8}")
+
+    if results and request.config.getoption('benchmark_update_baselines'):
+        for r in results.values():
+            baselines[r.name] = {'relative': round(r.relative, 2)}
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        logger.info(f"Updated {BASELINES}")
+
+
+@pytest.fixture
+def benchmark(request, benchmark_reference, benchmark_results):
+    """
+    Time a function and compare it against its baseline
+
+    Returns a function taking (name, func, *args, rounds=5, setup=None,
+    **kwargs). `func` is called once to warm up and then `rounds` times.
+    `setup` is called (untimed) before every call of `func`.
+    """
+    baselines = _load_baselines()
+    update = request.config.getoption('benchmark_update_baselines')
+    check = request.config.getoption('benchmark_check')
+    tolerance = request.config.getoption('benchmark_tolerance')
+
+    def run(name: str, func: Callable, *args, rounds: int = 5,
+            setup: Optional[Callable] = None, **kwargs) -> BenchmarkResult:
+        timings = _time(func, *args, rounds=rounds, setup=setup, **kwargs)
+        median = statistics.median(timings)
+        result = BenchmarkResult(name, median, min(timings), rounds,
+                                 median / benchmark_reference)
+        benchmark_results[name] = result
+
+        baseline = baselines.get(name, {}).get('relative')
+        if baseline and not update and result.relative > baseline * tolerance:
+            message = (f"{name} regressed: {result.relative:.2f}x the "
+                       f"reference workload is more than {tolerance}x the "
+                       f"baseline of {baseline:.2f}x")
+            if check:
+                pytest.fail(message)
+            logger.warning(message)
+        return result
+    return run
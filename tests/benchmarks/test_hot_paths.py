@@ -0,0 +1,136 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+
+import pytest
+import yaml
+
+from tests.lib import common
+from tests.lib.hardware import null
+from tests.lib.hardware.hardware_base import AnsibleInventory
+from tests.lib.hardware.node_base import NodeRole
+from tests.lib.workspace import Workspace
+
+
+# Rook's manifests, as rookcheck loads, patches and applies them on every run
+ROOK_MANIFESTS = os.path.join(os.path.dirname(__file__), 'rook_manifests.yaml')
+
+
+@pytest.fixture(scope="module")
+def rook_tree(tmp_path_factory):
+    """A tree of the size of the rook examples with some images mixed in"""
+    template = str(tmp_path_factory.mktemp("rook-template"))
+    content = (
+        "apiVersion: apps/v1\n"
+        "kind: Deployment\n"
+        "metadata:\n"
+        "  name: rook-ceph-operator\n"
+        "  namespace: rook-ceph # namespace:operator\n"
+        "spec:\n"
+        "  template:\n"
+        "    spec:\n"
+        "      containers:\n"
+        "      - image: rook/ceph:master\n"
+        "        env:\n"
+        "        - name: ROOK_CSI_CEPH_IMAGE\n"
+        "          value: quay.io/cephcsi/cephcsi:v3.3.1\n"
+    ) * 10
+    for d in range(40):
+        path = os.path.join(template, f'dir{d}')
+        os.makedirs(path)
+        for f in range(50):
+            with open(os.path.join(path, f'manifest{f}.yaml'), 'w') as fh:
+                fh.write(content)
+        with open(os.path.join(path, 'image.png'), 'wb') as fh:
+            fh.write(b'\x89PNG\x00' + os.urandom(4096))
+    return template
+
+
+def test_execute_large_output(benchmark):
+    benchmark("execute_200k_lines", common.execute, "seq 200000",
+              capture=True, log_stdout=False)
+
+
+def test_execute_large_output_logged(benchmark):
+    # Every line goes through logging (and pytest's log capturing), which is
+    # much slower, so use fewer lines
+    benchmark("execute_20k_lines_logged", common.execute, "seq 20000",
+              capture=True)
+
+
+def test_recursive_replace(benchmark, rook_tree, tmp_path):
+    tree = str(tmp_path / "rook")
+
+    def setup():
+        shutil.rmtree(tree, ignore_errors=True)
+        shutil.copytree(rook_tree, tree)
+
+    replacements = {
+        "rook/ceph:master": "registry.example.com/rook/ceph:v1.6.0",
+        "quay.io/cephcsi/cephcsi:v3.3.1":
+            "registry.example.com/cephcsi/cephcsi:v3.3.1",
+        "# namespace:operator": "",
+    }
+    benchmark("recursive_replace_2000_files", common.recursive_replace,
+              tree, replacements, setup=setup)
+
+
+@pytest.fixture(scope="module")
+def workspace():
+    with Workspace() as workspace:
+        yield workspace
+
+
+def test_ansible_create_inventory(benchmark, workspace):
+    hardware = null.Hardware(workspace)
+    nodes = []
+    for i in range(500):
+        role = NodeRole.MASTER if i < 3 else NodeRole.WORKER
+        tags = ['master'] if i < 3 else ['worker']
+        nodes.append(null.Node(f"node-{i}", role, tags,
+                               hardware._allocate_ip(), hardware._simulator))
+
+    def create_inventory():
+        # Adding the nodes one by one as they boot, then writing once
+        inventory = AnsibleInventory(
+            os.path.join(workspace.working_dir, 'inventory'),
+            workspace.ansible_inventory_vars())
+        for node in nodes:
+            inventory.add(node.name, node.tags, node.ansible_inventory_vars())
+        inventory.write()
+    benchmark("ansible_inventory_add_write_500_nodes", create_inventory)
+
+
+def test_wait_for_result_overhead(benchmark):
+    def probe():
+        return (0, "HEALTH_OK", "")
+
+    def wait_many():
+        for i in range(1000):
+            common.wait_for_result(
+                probe, matcher=common.simple_matcher("HEALTH_OK"),
+                attempts=1, interval=1)
+    benchmark("wait_for_result_1000_immediate", wait_many)
+
+
+def test_yaml_manifests(benchmark):
+    with open(ROOK_MANIFESTS) as f:
+        text = f.read()
+
+    def load_dump():
+        docs = list(yaml.safe_load_all(text))
+        yaml.dump_all(docs, default_flow_style=False)
+    benchmark("yaml_load_dump_rook_manifests", load_dump)
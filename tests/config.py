@@ -30,6 +30,7 @@ settings = Dynaconf(
         os.path.join(settings_dir, 'openstack.toml'),
         os.path.join(settings_dir, 'libvirt.toml'),
         os.path.join(settings_dir, 'aws_ec2.toml'),
+        os.path.join(settings_dir, 'null.toml'),
         os.path.join(settings_dir, 'rook_upstream.toml'),
         os.path.join(settings_dir, 'ses.toml'),
     ],
@@ -15,10 +15,11 @@
 import logging
 import os
 import pytest
-import threading
 
 from tests.config import settings, converter
 from tests.lib import common
+from tests.lib import tracing
+from tests.lib.scheduler import Scheduler
 from tests.lib.workspace import Workspace
 
 
@@ -28,6 +29,8 @@ elif settings.HARDWARE_PROVIDER.upper() == 'LIBVIRT':
     from tests.lib.hardware.libvirt import Hardware as Hardware  # type: ignore
 elif settings.HARDWARE_PROVIDER.upper() == 'AWS_EC2':
     from tests.lib.hardware.aws_ec2 import Hardware as Hardware  # type: ignore
+elif settings.HARDWARE_PROVIDER.upper() == 'NULL':
+    from tests.lib.hardware.null import Hardware as Hardware  # type: ignore
 else:
     raise Exception("Hardware provider '{}' not yet supported by "
                     "rookcheck".format(settings.HARDWARE_PROVIDER))
@@ -59,11 +62,18 @@ def _print_config():
     logger.info("# ===================")
     logger.info(f"# ROOKCHECK_CLUSTER_PREFIX={settings.CLUSTER_PREFIX}")
     logger.info(f"# ROOKCHECK_WORKSPACE_DIR={settings.WORKSPACE_DIR}")
+    logger.info(
+        f"# ROOKCHECK_ARTIFACT_CACHE_DIR={settings.ARTIFACT_CACHE_DIR}")
+    logger.info(
+        f"# ROOKCHECK_ARTIFACT_CACHE_MAX_SIZE="
+        f"{settings.ARTIFACT_CACHE_MAX_SIZE}")
     logger.info(f"# ROOKCHECK_NUMBER_MASTERS={settings.NUMBER_MASTERS}")
     logger.info(f"# ROOKCHECK_NUMBER_WORKERS={settings.NUMBER_WORKERS}")
     logger.info(
         f"# ROOKCHECK_WORKER_INITIAL_DATA_DISKS="
         f"{settings.WORKER_INITIAL_DATA_DISKS}")
+    logger.info(f"# ROOKCHECK_BOOT_CONCURRENCY={settings.BOOT_CONCURRENCY}")
+    logger.info(f"# ROOKCHECK_BOOT_ATTEMPTS={settings.BOOT_ATTEMPTS}")
     logger.info(f"# ROOKCHECK_NODE_IMAGE_USER={settings.NODE_IMAGE_USER}")
     logger.info(f"# ROOKCHECK__USE_THREADS={settings._USE_THREADS}")
     logger.info(f"# ROOKCHECK__REMOVE_WORKSPACE={settings._REMOVE_WORKSPACE}")
@@ -73,6 +83,12 @@ def _print_config():
         f"# ROOKCHECK__TEAR_DOWN_CLUSTER_CONFIRM="
         f"{settings._TEAR_DOWN_CLUSTER_CONFIRM}")
     logger.info(f"# ROOKCHECK__GATHER_LOGS_DIR={settings._GATHER_LOGS_DIR}")
+    logger.info(f"# ROOKCHECK__TRACE_FILE={settings._TRACE_FILE}")
+    logger.info(
+        f"# ROOKCHECK_ANSIBLE_MAX_FORKS={settings.ANSIBLE_MAX_FORKS}")
+    logger.info(
+        f"# ROOKCHECK_ANSIBLE_CONTROL_PERSIST="
+        f"{settings.ANSIBLE_CONTROL_PERSIST}")
     logger.info(f"# ROOKCHECK_HARDWARE_PROVIDER={settings.HARDWARE_PROVIDER}")
     logger.info("# Hardware provider specific config:")
     logger.info("# ----------------------------------")
@@ -105,6 +121,9 @@ def _print_config():
             f"#    ROOKCHECK_AWS.AMI_IMAGE_ID={settings.AWS.AMI_IMAGE_ID}")
         logger.info(
             f"#    ROOKCHECK_AWS.NODE_SIZE={settings.AWS.NODE_SIZE}")
+    elif settings.HARDWARE_PROVIDER.upper() == "NULL":
+        for key, value in settings.NULL.items():
+            logger.info(f"#    ROOKCHECK_NULL__{key.upper()}={value}")
     logger.info(f"# ROOKCHECK_DISTRO={settings.DISTRO}")
     logger.info("# Distro specific config:")
     logger.info("# -----------------------")
@@ -147,6 +166,31 @@ def _check_docker_requirement():
         logger.debug("... Docker appears to be ready")
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark-update-baselines", action="store_true", default=False,
+        help="Record the benchmark results as the new baselines")
+    parser.addoption(
+        "--benchmark-check", action="store_true", default=False,
+        help="Fail benchmarks that regressed against their baseline instead "
+             "of only reporting them")
+    parser.addoption(
+        "--benchmark-tolerance", type=float, default=2.0,
+        help="With --benchmark-check, fail benchmarks that are slower than "
+             "this factor times their baseline")
+
+
+def pytest_configure(config):
+    tracing.tracer.enabled = bool(settings._TRACE_FILE)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    common.wait_stats.log_summary()
+    tracing.tracer.log_summary()
+    if settings._TRACE_FILE and tracing.tracer.spans():
+        tracing.tracer.export(settings._TRACE_FILE)
+
+
 @pytest.fixture(scope="module")
 def preflight_checks():
     # Do some checks before starting and print debug information
@@ -165,10 +209,12 @@ def hardware(workspace):
     # NOTE(jhesketh): The Hardware() object is expected to take care of any
     # cloud provider abstraction.
     with Hardware(workspace) as hardware:
-        hardware.boot_nodes(
-            masters=settings.NUMBER_MASTERS,
-            workers=settings.NUMBER_WORKERS)
-        hardware.prepare_nodes()
+        with tracing.span("boot_nodes", category='phase'):
+            hardware.boot_nodes(
+                masters=settings.NUMBER_MASTERS,
+                workers=settings.NUMBER_WORKERS)
+        with tracing.span("prepare_nodes", category='phase'):
+            hardware.prepare_nodes()
         yield hardware
 
 
@@ -181,8 +227,10 @@ def kubernetes(workspace, hardware):
     # etc), we should do them from an ABC so to ensure the interfaces are
     # correct.
     with Kubernetes(workspace, hardware) as kubernetes:
-        kubernetes.bootstrap()
-        kubernetes.install_kubernetes()
+        with tracing.span("bootstrap", category='phase'):
+            kubernetes.bootstrap()
+        with tracing.span("install_kubernetes", category='phase'):
+            kubernetes.install_kubernetes()
         yield kubernetes
 
 
@@ -194,9 +242,12 @@ def linear_rook_cluster(workspace, kubernetes):
     # fixture is preferred as it will build rook locally in a thread while
     # waiting on the infrastructure
     with RookCluster(workspace, kubernetes) as rook_cluster:
-        rook_cluster.build()
-        rook_cluster.preinstall()
-        rook_cluster.install()
+        with tracing.span("build", category='phase'):
+            rook_cluster.build()
+        with tracing.span("preinstall", category='phase'):
+            rook_cluster.preinstall()
+        with tracing.span("install", category='phase'):
+            rook_cluster.install()
         yield rook_cluster
 
 
@@ -208,29 +259,34 @@ def rook_cluster(workspace):
     with Hardware(workspace) as hardware:
         with Kubernetes(workspace, hardware) as kubernetes:
             with RookCluster(workspace, kubernetes) as rook_cluster:
-                if settings.as_bool('_USE_THREADS'):
-                    logger.info("Starting rook build in a thread")
-                    build_thread = threading.Thread(
-                        target=rook_cluster.build())
-                    build_thread.start()
-
-                # build rook thread
-                hardware.boot_nodes(masters=settings.NUMBER_MASTERS,
-                                    workers=settings.NUMBER_WORKERS)
-                hardware.prepare_nodes()
-                kubernetes.bootstrap()
-                kubernetes.install_kubernetes()
-
-                if settings.as_bool('_USE_THREADS'):
-                    logger.info("Re-joining rook build thread")
-                    build_thread.join()
-                else:
-                    rook_cluster.build()
-
-                # NOTE(jhesketh): The upload is very slow.. may want to
-                #                 consider how to do this in a thread too but
-                #                 is more complex with ansible.
-                rook_cluster.preinstall()
-                rook_cluster.install()
+                # The bring-up as a graph of stages. With _USE_THREADS the
+                # downloads and the rook build overlap with booting and
+                # preparing the nodes, and the (slow) upload of the rook
+                # image overlaps with installing kubernetes. Playbooks
+                # installing packages still run one at a time (see
+                # HardwareBase.ansible_run_playbook).
+                bring_up = Scheduler(
+                    "rook_cluster", category='phase',
+                    max_workers=None if settings.as_bool('_USE_THREADS')
+                    else 1)
+                bring_up.add("boot_nodes", lambda: hardware.boot_nodes(
+                    masters=settings.NUMBER_MASTERS,
+                    workers=settings.NUMBER_WORKERS))
+                bring_up.add("prepare_nodes", hardware.prepare_nodes,
+                             requires=["boot_nodes"])
+                bring_up.add("fetch_kubernetes", kubernetes.fetch)
+                bring_up.add("bootstrap", kubernetes.bootstrap,
+                             requires=["prepare_nodes"])
+                bring_up.add("install_kubernetes",
+                             kubernetes.install_kubernetes,
+                             requires=["bootstrap", "fetch_kubernetes"])
+                bring_up.add("fetch_rook", rook_cluster.fetch)
+                bring_up.add("build", rook_cluster.build,
+                             requires=["fetch_rook"])
+                bring_up.add("preinstall", rook_cluster.preinstall,
+                             requires=["build", "prepare_nodes"])
+                bring_up.add("install", rook_cluster.install,
+                             requires=["preinstall", "install_kubernetes"])
+                bring_up.run()
 
                 yield rook_cluster
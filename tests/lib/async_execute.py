@@ -0,0 +1,228 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# asyncio counterpart of tests.lib.common.execute. This allows fanning out
+# many commands (kubectl, ansible, skuba, ...) from a single event loop
+# instead of starting a thread per command.
+
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from tests.lib import tracing
+from tests.lib.common import _OutputStream
+
+
+logger = logging.getLogger(__name__)
+
+# How long a cancelled command gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE_PERIOD = 10
+
+
+async def _pump(stream: asyncio.StreamReader, output: _OutputStream):
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            output.feed(b"", final=True)
+            return
+        output.feed(data)
+
+
+def _signal_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _terminate(process):
+    # Commands run through a shell in their own session, so signal the whole
+    # process group. Otherwise children of the shell keep the pipes open.
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        _signal_group(process, signal.SIGKILL)
+        await process.wait()
+
+
+def _log_func(log_func: Optional[Callable[[str], None]],
+              line_callback: Optional[Callable[[str, str], None]],
+              stream_name: str) -> Optional[Callable[[str], None]]:
+    if line_callback is None:
+        return log_func
+
+    def handle_line(line):
+        if log_func is not None:
+            log_func(line)
+        line_callback(stream_name, line)
+    return handle_line
+
+
+async def execute_async(
+        command: str, capture: bool = False, check: bool = True,
+        log_stdout: bool = True, log_stderr: bool = True,
+        env: Optional[Dict[str, str]] = None,
+        logger_name: Optional[str] = None,
+        cwd: Optional[str] = None,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+        limiter: Optional[asyncio.Semaphore] = None) -> Tuple[
+            int, Optional[str], Optional[str]]:
+    """The asyncio version of `tests.lib.common.execute`.
+
+    `capture`, `check`, `log_stdout`, `log_stderr`, `env` and `logger_name`
+    behave as they do for `execute`.
+
+    `cwd` is the directory the command runs in. Unlike `Workspace.chdir` this
+    does not change the working directory of the whole process, so it is
+    safe to use for concurrent commands.
+
+    `line_callback` is called with ("stdout"|"stderr", line) for every line
+    the command outputs, as it arrives.
+
+    `limiter` is an optional semaphore that bounds how many commands run at
+    the same time.
+
+    If the coroutine is cancelled the command is terminated (and killed after
+    TERMINATE_GRACE_PERIOD seconds) before the cancellation propagates.
+
+    Returns a tuple of (rc code, stdout, stderr), where stdout and stderr are
+    None if `capture` is False, or are a string.
+    """
+    if limiter is not None:
+        async with limiter:
+            return await execute_async(
+                command, capture=capture, check=check, log_stdout=log_stdout,
+                log_stderr=log_stderr, env=env, logger_name=logger_name,
+                cwd=cwd, line_callback=line_callback)
+
+    want_stdout = log_stdout or capture or line_callback is not None
+    want_stderr = log_stderr or capture or line_callback is not None
+
+    logger_name = logger_name if logger_name is not None else command
+    log = logging.getLogger(logger_name)
+
+    parent = tracing.tracer.current()
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=subprocess.PIPE if want_stdout else subprocess.DEVNULL,
+        stderr=subprocess.PIPE if want_stderr else subprocess.DEVNULL,
+        env=env,
+        cwd=cwd,
+        start_new_session=True,
+    )
+
+    stdout = _OutputStream(
+        _log_func(log.info if log_stdout else None, line_callback, "stdout"),
+        capture)
+    stderr = _OutputStream(
+        _log_func(log.warning if log_stderr else None, line_callback,
+                  "stderr"),
+        capture)
+
+    pumps = []
+    if process.stdout is not None:
+        pumps.append(_pump(process.stdout, stdout))
+    if process.stderr is not None:
+        pumps.append(_pump(process.stderr, stderr))
+
+    try:
+        await asyncio.gather(*pumps)
+        rc = await process.wait()
+    except asyncio.CancelledError:
+        logger.warning(f"Command {command} cancelled, terminating it")
+        await _terminate(process)
+        tracing.tracer.record(logger_name, 'command', start, time.monotonic(),
+                              parent=parent, async_=True, command=command,
+                              cancelled=True)
+        raise
+    tracing.tracer.record(logger_name, 'command', start, time.monotonic(),
+                          parent=parent, async_=True, command=command, rc=rc)
+
+    logger.debug(f"Command {command} finished with RC {rc}")
+
+    if check and rc != 0:
+        if capture:
+            raise subprocess.CalledProcessError(
+                rc, command, stdout.captured, stderr.captured)
+        else:
+            raise subprocess.CalledProcessError(rc, command)
+
+    return (rc, stdout.captured, stderr.captured)
+
+
+async def execute_many_async(commands: List[str], concurrency: int = 8,
+                             **kwargs) -> List[
+                                 Tuple[int, Optional[str], Optional[str]]]:
+    """Run `commands` with at most `concurrency` running at the same time
+
+    `kwargs` are passed to `execute_async` for every command. If one command
+    fails, the remaining ones are cancelled and the error is raised.
+
+    Returns the results in the same order as `commands`.
+    """
+    limiter = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.ensure_future(
+        execute_async(command, limiter=limiter, **kwargs))
+        for command in commands]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def run_async(coroutine):
+    """Run `coroutine` to completion on a fresh event loop
+
+    If the loop is interrupted (eg. by KeyboardInterrupt), the outstanding
+    tasks are cancelled so that their commands are terminated.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            pending = [t for t in _all_tasks(loop) if not t.done()]
+            for t in pending:
+                t.cancel()
+            if pending:
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def _all_tasks(loop):
+    # asyncio.all_tasks only exists from python 3.7 on
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    return asyncio.Task.all_tasks(loop)  # type: ignore
+
+
+def execute_many(commands: List[str], concurrency: int = 8,
+                 **kwargs) -> List[Tuple[int, Optional[str], Optional[str]]]:
+    """Blocking wrapper around `execute_many_async`"""
+    return run_async(
+        execute_many_async(commands, concurrency=concurrency, **kwargs))
@@ -0,0 +1,247 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A persistent cache for downloaded artifacts (helm, kubectl, go, node
+# images, ...) that lives outside of the per-run workspace.
+#
+# Layout of the cache directory:
+#   index/<sha256 of url>.json  metadata about the url (content hash, etag)
+#   blobs/<sha256 of content>   the downloaded content
+#   tmp/                        downloads in progress (resumable)
+#   locks/                      lock files (flock) shared by concurrent runs
+#
+# A blob is read under a shared lock of its own, which eviction skips, so a
+# run never loses an artifact it is still unpacking or copying.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Dict, Optional
+
+import requests
+
+from tests.lib import download
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+@contextlib.contextmanager
+def _flock(path: str, shared: bool = False, blocking: bool = True):
+    """
+    Hold a lock on `path`
+
+    Yields whether the lock was taken, which is always the case unless not
+    `blocking`.
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        operation |= fcntl.LOCK_NB
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, operation)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class ArtifactCache():
+    """
+    Content-addressed download cache with size based LRU eviction
+
+    Artifacts are looked up by their URL (and optionally their expected
+    sha256). Cached entries are revalidated against the ETag/Last-Modified
+    headers of the URL when the server provides them, so URLs whose content
+    changes over time are downloaded again. If the server can't be reached
+    the cached copy is used.
+
+    `max_size` is the size in bytes the cache is trimmed to after each
+    download, evicting the least recently used artifacts first.
+    """
+    def __init__(self, cache_dir: str, max_size: int):
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._max_size = max_size
+        for d in ['index', 'blobs', 'tmp', 'locks']:
+            os.makedirs(os.path.join(self._cache_dir, d), exist_ok=True)
+
+    @property
+    def cache_dir(self) -> str:
+        return self._cache_dir
+
+    def _index_path(self, url: str) -> str:
+        return os.path.join(self._cache_dir, 'index', f'{_url_key(url)}.json')
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self._cache_dir, 'blobs', sha256)
+
+    def _lock_path(self, name: str) -> str:
+        return os.path.join(self._cache_dir, 'locks', f'{name}.lock')
+
+    def _blob_lock_path(self, sha256: str) -> str:
+        return self._lock_path(f'blob-{sha256}')
+
+    def _read_index(self, url: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._index_path(url)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_index(self, url: str, entry: Dict[str, Any]):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self._cache_dir, 'tmp'))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._index_path(url))
+
+    def _is_fresh(self, url: str, entry: Dict[str, Any],
+                  sha256: Optional[str]) -> bool:
+        if not os.path.exists(self._blob_path(entry['sha256'])):
+            return False
+        if sha256:
+            # The content is pinned, no need to ask the server
+            return entry['sha256'] == sha256
+        if not entry.get('etag') and not entry.get('last_modified'):
+            return True
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=10)
+            r.raise_for_status()
+        except requests.RequestException:
+            logger.warning(f"Unable to revalidate {url}, using cached copy")
+            return True
+        remote = download.validators(r.headers)
+        for key in ['etag', 'last_modified']:
+            if remote[key] and entry.get(key) and remote[key] != entry[key]:
+                return False
+        return True
+
+    def _download(self, url: str, sha256: Optional[str],
+                  on_chunk: Optional[Callable[[bytes], None]]) -> Dict[
+                      str, Any]:
+        logger.info(f"Downloading {url} into the artifact cache")
+        digest = hashlib.sha256()
+        size = 0
+
+        def consume(chunk):
+            nonlocal size
+            digest.update(chunk)
+            size += len(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+
+        # Named after the url (which is locked) so that an interrupted
+        # download is resumed by the next run
+        tmp = os.path.join(self._cache_dir, 'tmp', _url_key(url))
+        validators = download.download(url, tmp, on_chunk=consume)
+        try:
+            content_sha256 = digest.hexdigest()
+            if sha256 and sha256 != content_sha256:
+                raise Exception(f"Checksum mismatch for {url}: expected "
+                                f"{sha256}, got {content_sha256}")
+            os.rename(tmp, self._blob_path(content_sha256))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        entry = {'url': url, 'sha256': content_sha256, 'size': size}
+        entry.update(validators)
+        return entry
+
+    def _fetch(self, url: str, sha256: Optional[str],
+               on_chunk: Optional[Callable[[bytes], None]],
+               use: Optional[Callable[[str], Any]]) -> str:
+        with _flock(self._lock_path(_url_key(url))):
+            entry = self._read_index(url)
+            if entry and self._is_fresh(url, entry, sha256):
+                logger.info(f"Using cached {url}")
+                downloaded = False
+            else:
+                entry = self._download(url, sha256, on_chunk)
+                self._write_index(url, entry)
+                downloaded = True
+            path = self._blob_path(entry['sha256'])
+            with _flock(self._blob_lock_path(entry['sha256']), shared=True):
+                # Mark as recently used for the LRU eviction
+                os.utime(path)
+                if on_chunk and not downloaded:
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            on_chunk(chunk)
+                if use:
+                    use(path)
+        self.evict()
+        return path
+
+    def fetch(self, url: str, sha256: Optional[str] = None,
+              on_chunk: Optional[Callable[[bytes], None]] = None) -> str:
+        """
+        Return the path of the cached content of `url`, downloading it first
+        if needed
+
+        `on_chunk` is called with the content in order, either while it is
+        downloaded or read back from the cache. This allows eg. unpacking an
+        artifact in the same pass as downloading it. The content can't be
+        evicted while `on_chunk` runs.
+
+        The returned path is shared and must not be modified. Once returned
+        it may be evicted by a concurrent run at any time, use `on_chunk` or
+        `copy_to` to get at the content safely.
+        """
+        return self._fetch(url, sha256, on_chunk, None)
+
+    def copy_to(self, url: str, dst: str, sha256: Optional[str] = None):
+        """
+        Fetch `url` through the cache and place a private copy at `dst`
+        """
+        self._fetch(url, sha256, None, lambda path: shutil.copyfile(path, dst))
+
+    def evict(self):
+        """
+        Remove the least recently used artifacts until the cache fits into
+        `max_size`
+        """
+        with _flock(self._lock_path('evict')):
+            blobs_dir = os.path.join(self._cache_dir, 'blobs')
+            blobs = []
+            for name in os.listdir(blobs_dir):
+                st = os.stat(os.path.join(blobs_dir, name))
+                blobs.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in blobs)
+            # Never evict the most recently used artifact, even if it is
+            # larger than the whole cache.
+            for mtime, size, name in sorted(blobs)[:-1]:
+                if total <= self._max_size:
+                    break
+                with _flock(self._blob_lock_path(name),
+                            blocking=False) as unused:
+                    if not unused:
+                        logger.info(f"Not evicting {name}, it is in use")
+                        continue
+                    logger.info(f"Evicting {name} ({size} bytes) from the "
+                                "artifact cache")
+                    os.remove(os.path.join(blobs_dir, name))
+                total -= size
@@ -12,19 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import locale
 import logging
 import pdb
+import random
+import selectors
+import shutil
 import subprocess
 import threading
 import time
-import wget
 import os
-import filecmp
-from typing import Dict, Optional, Tuple
+from typing import (Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Sequence, Tuple)
+
+from tests.lib import scheduler
+from tests.lib import tracing
+from tests.lib.download import download
 
 
 logger = logging.getLogger(__name__)
 
+# How often (in seconds) a command run in a scheduler step checks whether the
+# step was cancelled
+CANCEL_CHECK_INTERVAL = 1
+
 
 def simple_matcher(result):
     def compare(testee):
@@ -48,45 +64,218 @@ def decode_wrapper(i):
     return i[1]
 
 
-def wait_for_result(func, *args, matcher=simple_matcher(True), attempts=20,
-                    interval=5, decode=decode_wrapper, ignore_exceptions=True,
-                    **kwargs):
-    """Runs `func` with `args` until `matcher(out)` returns true or timesout
+class Backoff():
+    """
+    Exponential backoff intervals with jitter
 
-    Returns the matching result, or raises an exception.
+    The first `fast_probes` intervals stay at `initial` so that conditions
+    that are (nearly) met already are noticed quickly. After that the
+    interval grows by `factor` up to `maximum`. Each interval is randomised by
+    +/- `jitter` (a fraction) so that concurrent waiters do not probe in
+    lockstep.
     """
+    def __init__(self, initial: float = 1, maximum: float = 15,
+                 factor: float = 2, jitter: float = 0.1,
+                 fast_probes: int = 3):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.fast_probes = fast_probes
+
+    def __iter__(self) -> Iterator[float]:
+        interval = self.initial
+        probe = 0
+        while True:
+            probe += 1
+            if probe > self.fast_probes:
+                interval = min(interval * self.factor, self.maximum)
+            yield min(interval * random.uniform(1 - self.jitter,
+                                                1 + self.jitter),
+                      self.maximum)
+
+
+class WaitRecord(NamedTuple):
+    description: str
+    duration: float
+    probes: int
+    success: bool
+
 
-    for i in range(attempts):
-        logger.info(f"Attempt {i+1} / {attempts}")
+class WaitStats():
+    """
+    Collects how long each wait took and how many probes it used so that
+    timeouts can be tuned from data.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: List[WaitRecord] = []
+
+    def record(self, description: str, duration: float, probes: int,
+               success: bool):
+        with self._lock:
+            self.records.append(
+                WaitRecord(description, duration, probes, success))
+        now = time.monotonic()
+        tracing.tracer.record(description, 'wait', now - duration, now,
+                              parent=tracing.tracer.current(), probes=probes,
+                              success=success)
+        logger.info(f"Waited {duration:.1f}s ({probes} probes, "
+                    f"{'ok' if success else 'failed'}) for {description}")
+
+    def log_summary(self):
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r.duration,
+                             reverse=True)
+        if not records:
+            return
+        logger.info(f"Wait summary ({len(records)} waits, "
+                    f"{sum(r.duration for r in records):.1f}s total):")
+        for r in records:
+            logger.info(f"  {r.duration:8.1f}s {r.probes:5d} probes "
+                        f"{'ok    ' if r.success else 'failed'} "
+                        f"{r.description}")
+
+
+wait_stats = WaitStats()
+
+
+def wait_until(func, *args, matcher=simple_matcher(True), timeout=300,
+               backoff: Optional[Backoff] = None, decode=decode_wrapper,
+               ignore_exceptions=True, description: Optional[str] = None,
+               abort: Optional[Callable[[], None]] = None, **kwargs):
+    """Runs `func` with `args` until `matcher(out)` returns true or `timeout`
+    seconds have passed
+
+    `func` is probed on the intervals given by `backoff` (see Backoff for the
+    defaults). The last probe happens at the deadline. If `ignore_exceptions`
+    is False, any exception raised by `func` is re-raised immediately.
+
+    `abort` is called before every probe and may raise to end the wait early
+    (eg. when something the wait depends on failed). Waits in a step of a
+    `scheduler.Scheduler` also end once the step is cancelled.
+
+    The duration and number of probes are recorded in `wait_stats`.
+
+    Returns the matching result, or raises a TimeoutError.
+    """
+    if backoff is None:
+        backoff = Backoff()
+    if description is None:
+        description = f"{getattr(func, '__name__', func)}{args}"
+    abort = scheduler.cancellable(abort)
+
+    start = time.monotonic()
+    deadline = start + timeout
+    out = None
+    last_exception: Optional[Exception] = None
+    probes = 0
+    for interval in backoff:
+        probes += 1
+        logger.debug(f"Probe {probes} for {description} "
+                     f"({time.monotonic() - start:.1f}s / {timeout}s)")
+        if abort is not None:
+            try:
+                abort()
+            except Exception:
+                wait_stats.record(
+                    description, time.monotonic() - start, probes, False)
+                raise
         try:
             out = func(*args, **kwargs)
             if decode:
                 out = decode(out)
             if matcher(out):
+                wait_stats.record(
+                    description, time.monotonic() - start, probes, True)
                 return out
         except Exception as e:
-            if ignore_exceptions:
-                if i == attempts:
-                    logger.error(e.output)
-            else:
-                logger.error(e.output)
+            if not ignore_exceptions:
+                wait_stats.record(
+                    description, time.monotonic() - start, probes, False)
+                logger.error(getattr(e, 'output', e))
                 raise
-        i = i+1
-        time.sleep(interval)
+            last_exception = e
 
-    logger.error("Timed out waiting for result %s in %s(%s)" %
-                 (matcher, func, args))
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
 
+    wait_stats.record(description, time.monotonic() - start, probes, False)
+    logger.error(f"Timed out waiting for result {matcher} in {description}")
+    if last_exception is not None:
+        logger.error("The last exception raised by the function:")
+        logger.error(getattr(last_exception, 'output', last_exception))
     logger.error("The last output of the function:")
     logger.error(out)
 
-    raise Exception("Timed out waiting for result")
+    raise TimeoutError("Timed out waiting for result")
+
+
+def wait_for_result(func, *args, matcher=simple_matcher(True), attempts=20,
+                    interval=5, decode=decode_wrapper, ignore_exceptions=True,
+                    **kwargs):
+    """Runs `func` with `args` until `matcher(out)` returns true or timesout
+
+    Deprecated: use `wait_until`. The `attempts` * `interval` budget is used
+    as the deadline and `interval` as the longest backoff interval.
+    """
+    return wait_until(func, *args, matcher=matcher,
+                      timeout=attempts * interval,
+                      backoff=Backoff(maximum=interval), decode=decode,
+                      ignore_exceptions=ignore_exceptions, **kwargs)
+
+
+class _OutputStream():
+    """
+    Collects the output of one pipe of a command
+
+    Output is decoded incrementally (with universal newlines) and kept as a
+    list of chunks so that capturing large outputs stays linear. Complete
+    lines are passed to `log_func` as they arrive.
+    """
+    def __init__(self, log_func: Optional[Callable[[str], None]] = None,
+                 capture: bool = False, tee: Optional[BinaryIO] = None):
+        self._log_func = log_func
+        self._capture = capture
+        self._tee = tee
+        self._decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(
+                locale.getpreferredencoding(False))(errors='replace'),
+            translate=True)
+        self._chunks: List[str] = []
+        self._pending_line = ""
+
+    def feed(self, data: bytes, final: bool = False):
+        if self._tee is not None and data:
+            self._tee.write(data)
+        text = self._decoder.decode(data, final=final)
+        if self._capture:
+            self._chunks.append(text)
+        if self._log_func is None:
+            return
+        lines = (self._pending_line + text).split('\n')
+        self._pending_line = lines.pop()
+        for line in lines:
+            self._log_func(line.rstrip())
+        if final and self._pending_line:
+            self._log_func(self._pending_line.rstrip())
+            self._pending_line = ""
+
+    @property
+    def captured(self) -> Optional[str]:
+        if not self._capture:
+            return None
+        return "".join(self._chunks)
 
 
 def execute(command: str, capture: bool = False, check: bool = True,
             log_stdout: bool = True, log_stderr: bool = True,
             env: Optional[Dict[str, str]] = None,
-            logger_name: Optional[str] = None) -> Tuple[
+            logger_name: Optional[str] = None,
+            tee: Optional[str] = None,
+            cwd: Optional[str] = None) -> Tuple[
                 int, Optional[str], Optional[str]]:
     """A helper util to excute `command`.
 
@@ -97,97 +286,100 @@ def execute(command: str, capture: bool = False, check: bool = True,
     use the `check` param).
 
     If `check` is true, subprocess.CalledProcessError is raised when the RC is
-    non-zero. Note, however, that due to the way we're buffering the output
-    into memory, stdout and stderr are only available on the exception if
-    `capture` was True.
+    non-zero. Note, however, that stdout and stderr are only available on the
+    exception if `capture` was True.
 
     `env` is a dictionary of environment vars passed into Popen.
 
     `logger_name` changes the logger used. Otherwise `command` is used.
 
+    `cwd` is the directory the command runs in (by default the current one).
+
+    `tee` is an optional path that the raw stdout of the command is written
+    to as it arrives (independent of `capture` and `log_stdout`). It is
+    compressed if the path ends in ".gz".
+
+    Both pipes are multiplexed on the calling thread, so no reader threads
+    are started.
+
+    When run in a step of a `scheduler.Scheduler` that is cancelled, the
+    command is killed and a `scheduler.StepCancelledError` is raised.
+
     Returns a tuple of (rc code, stdout, stdin), where stdout and stdin are
     None if `capture` is False, or are a string.
     """
     stdout_pipe = subprocess.PIPE \
-        if log_stdout or capture else subprocess.DEVNULL
+        if log_stdout or capture or tee else subprocess.DEVNULL
 
     stderr_pipe = subprocess.PIPE \
         if log_stderr or capture else subprocess.DEVNULL
 
-    process = subprocess.Popen(
-        command,
-        shell=True,
-        stdout=stdout_pipe, stderr=stderr_pipe,
-        universal_newlines=True,
-        env=env,
-    )
-
-    # Use a dictionary to capture the output as it is a mutable object that
-    # we can access outside of the threads.
-    output: Dict[str, Optional[str]] = {}
-    output['stdout'] = None
-    output['stderr'] = None
-    if capture:
-        output['stdout'] = ""
-        output['stderr'] = ""
-
-    def read_stdout_from_process(process, capture_dict, logger_name):
-        log = logging.getLogger(logger_name)
-        while True:
-            output = process.stdout.readline()
-            if output:
-                log.info(output.rstrip())
-                if capture_dict['stdout'] is not None:
-                    capture_dict['stdout'] += output
-            elif output == '' and process.poll() is not None:
-                break
-
-    def read_stderr_from_process(process, capture_dict, logger_name):
-        log = logging.getLogger(logger_name)
-        while True:
-            output = process.stderr.readline()
-            if output:
-                log.warning(output.rstrip())
-                if capture_dict['stderr'] is not None:
-                    capture_dict['stderr'] += output
-            elif output == '' and process.poll() is not None:
-                break
-
     logger_name = logger_name if logger_name is not None else command
-    if log_stdout:
-        stdout_thread = threading.Thread(
-            target=read_stdout_from_process,
-            args=(process, output, logger_name)
-        )
-        stdout_thread.start()
-    if log_stderr:
-        stderr_thread = threading.Thread(
-            target=read_stderr_from_process,
-            args=(process, output, logger_name)
+    log = logging.getLogger(logger_name)
+
+    with contextlib.ExitStack() as stack:
+        span = stack.enter_context(tracing.span(
+            logger_name, category='command', command=command))
+        tee_file: Any = None
+        if tee:
+            tee_file = stack.enter_context(
+                gzip.open(tee, 'wb') if tee.endswith('.gz')
+                else open(tee, 'wb'))
+
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=stdout_pipe, stderr=stderr_pipe,
+            env=env, cwd=cwd,
         )
-        stderr_thread.start()
-
-    if log_stdout:
-        stdout_thread.join()
-    if log_stderr:
-        stderr_thread.join()
 
-    if not log_stdout and capture:
-        output['stdout'] = process.stdout.read()  # type: ignore
-    if not log_stderr and capture:
-        output['stderr'] = process.stderr.read()  # type: ignore
+        stdout = _OutputStream(log.info if log_stdout else None, capture,
+                               tee_file)
+        stderr = _OutputStream(log.warning if log_stderr else None, capture)
+
+        selector = stack.enter_context(selectors.DefaultSelector())
+        if process.stdout is not None:
+            stack.enter_context(process.stdout)
+            selector.register(process.stdout, selectors.EVENT_READ, stdout)
+        if process.stderr is not None:
+            stack.enter_context(process.stderr)
+            selector.register(process.stderr, selectors.EVENT_READ, stderr)
+
+        # Only wake up regularly if there is a cancellation to look out for
+        cancellable = scheduler.cancellable() is not None
+        select_timeout = CANCEL_CHECK_INTERVAL if cancellable else None
+        cancelled = False
+        while selector.get_map():
+            if cancellable and scheduler.cancelled():
+                cancelled = True
+                break
+            for key, _ in selector.select(select_timeout):
+                data = os.read(key.fd, 65536)
+                if data:
+                    key.data.feed(data)
+                else:
+                    key.data.feed(b"", final=True)
+                    selector.unregister(key.fileobj)
+
+        if cancelled:
+            logger.warning(f"Killing {command} as its step was cancelled")
+            process.kill()
+        rc = process.wait()
+        span.args['rc'] = rc
+
+    if cancelled:
+        raise scheduler.StepCancelledError(f"{command} was cancelled")
 
-    rc = process.wait()
     logger.debug(f"Command {command} finished with RC {rc}")
 
     if check and rc != 0:
         if capture:
             raise subprocess.CalledProcessError(
-                rc, command, output['stdout'], output['stderr'])
+                rc, command, stdout.captured, stderr.captured)
         else:
             raise subprocess.CalledProcessError(rc, command)
 
-    return (rc, output['stdout'], output['stderr'])
+    return (rc, stdout.captured, stderr.captured)
 
 
 def handle_cleanup_input(msg):
@@ -202,28 +394,113 @@ def handle_cleanup_input(msg):
             break
 
 
+def unpack(tarball, unpack_folder):
+    """
+    Unpack a gzipped tarball in given folder
+    """
+    execute("tar -C %s -xzf %s" % (unpack_folder, tarball))
+
+
+@contextlib.contextmanager
+def unpack_stream(unpack_folder: str) -> Iterator[Callable[[bytes], None]]:
+    """
+    Unpack a gzipped tarball in given folder while it is being produced
+
+    Yields a function that is fed the content of the tarball in order. The
+    decompression and extraction run in a separate tar process concurrently
+    to whatever produces the content (eg. a download).
+    """
+    command = ["tar", "-C", unpack_folder, "-xzf", "-"]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    stdin = process.stdin
+    assert stdin is not None
+
+    def feed(chunk: bytes):
+        stdin.write(chunk)
+
+    try:
+        yield feed
+        stdin.close()
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        rc = process.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, " ".join(command))
+
+
 def get_unpack(url, dst_file, unpack_folder):
     """
     Download a file and unpack it in given folder
+
+    The file is unpacked while it is downloaded. `dst_file` keeps the
+    downloaded tarball, and a previously interrupted download to it is
+    resumed (see `tests.lib.download.download`).
+    """
+    with unpack_stream(unpack_folder) as feed:
+        download(url, dst_file, on_chunk=feed)
+
+
+def _is_binary(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return b'\0' in f.read(8192)
+
+
+def _replace_in_file(src: str,
+                     replacements: Sequence[Dict[str, str]]) -> bool:
+    if _is_binary(src):
+        return False
+    try:
+        with open(src, 'r') as f:
+            content = f.read()
+    except UnicodeDecodeError:
+        return False
+
+    # Keys are applied one after another in order, so a replacement can
+    # act on the result of an earlier one
+    new_content = content
+    for replacement in replacements:
+        for key, value in replacement.items():
+            new_content = new_content.replace(key, value)
+    if new_content == content:
+        return False
+
+    tmp = f'{src}_tmp'
+    with open(tmp, 'w') as f:
+        f.write(new_content)
+    shutil.copymode(src, tmp)
+    os.rename(src, f'{src}.back')
+    os.rename(tmp, src)
+    return True
+
+
+def recursive_replace(dir: str, *replacements: Dict[str, str],
+                      workers: int = 8) -> List[str]:
     """
-    wget.download(url, dst_file, bar=None)
-    execute("tar -C %s -xzf %s" % (unpack_folder, dst_file))
+    Replace strings in all (text) files below `dir`
 
+    Each of `replacements` is a dict mapping strings to their replacement.
+    The keys are replaced one after another in the order of the dict, and
+    several sets are applied one after another, but every file is only read
+    and written once. Binary files and files without any
+    match are left untouched. Changed files are backed up with a `.back`
+    suffix. Files are processed on a pool of `workers` threads.
 
-def recursive_replace(dir: str, replacements: Dict[str, str]):
+    Returns the paths of the files that were changed.
+    """
+    paths = []
     for root, dirs, files in os.walk(dir):
         for name in files:
-            src = os.path.join(root, name)
-            tmp = os.path.join(root, f'{name}_tmp')
-            with open(src, 'r') as f:
-                lines = f.readlines()
-            with open(tmp, 'w') as f:
-                for line in lines:
-                    for k, v in replacements.items():
-                        line = line.replace(k, v)
-                    f.write(line)
-            if filecmp.cmp(src, tmp):
-                os.remove(tmp)
-            else:
-                os.rename(src, f'{src}.back')
-                os.rename(tmp, src)
+            path = os.path.join(root, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                paths.append(path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        changed = list(pool.map(
+            lambda path: _replace_in_file(path, replacements), paths))
+
+    changed_paths = [p for p, c in zip(paths, changed) if c]
+    logger.info(f"Replaced strings in {len(changed_paths)} of {len(paths)} "
+                f"files in {dir}")
+    return changed_paths
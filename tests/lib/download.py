@@ -0,0 +1,214 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# HTTP downloads for artifacts. Large downloads are fetched in parallel range
+# requests and can be resumed if they were interrupted. The content can be
+# passed on (in order) to a consumer while it is downloaded, eg. to unpack a
+# tarball in the same pass.
+
+import concurrent.futures
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional, Set
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+class _State():
+    """
+    The progress of a segmented download, persisted next to the partial file
+    so that an interrupted download can be resumed
+    """
+    def __init__(self, path: str, url: str, size: int,
+                 validator: Optional[str]):
+        self._path = path
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.done: Set[int] = set()
+
+    def load(self):
+        try:
+            with open(self._path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if (state.get('url') == self.url and state.get('size') == self.size
+                and state.get('validator') == self.validator
+                and self.validator):
+            self.done = set(state.get('done', []))
+
+    def save(self):
+        tmp = f'{self._path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'url': self.url, 'size': self.size,
+                       'validator': self.validator,
+                       'done': sorted(self.done)}, f)
+        os.rename(tmp, self._path)
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+def _feed_file(path: str, on_chunk: Callable[[bytes], None], start: int,
+               end: int):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise Exception(f"Unexpected end of {path}")
+            on_chunk(chunk)
+            remaining -= len(chunk)
+
+
+def _download_stream(url: str, partial: str,
+                     on_chunk: Optional[Callable[[bytes], None]]) -> Dict[
+                         str, Optional[str]]:
+    with requests.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(partial, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+        return validators(r.headers)
+
+
+def _download_segment(url: str, fd: int, start: int, end: int):
+    headers = {'Range': f'bytes={start}-{end - 1}'}
+    with requests.get(url, headers=headers, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise Exception(f"{url} did not honour the range request")
+        offset = start
+        for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        if offset != end:
+            raise Exception(f"Short read for range {start}-{end} of {url}")
+
+
+def _download_segmented(url: str, partial: str, size: int,
+                        validator: Optional[str],
+                        on_chunk: Optional[Callable[[bytes], None]],
+                        parallel: int):
+    segments = [(start, min(start + SEGMENT_SIZE, size))
+                for start in range(0, size, SEGMENT_SIZE)]
+    state = _State(f'{partial}.json', url, size, validator)
+    if os.path.exists(partial):
+        state.load()
+    if state.done:
+        logger.info(f"Resuming download of {url} "
+                    f"({len(state.done)}/{len(segments)} segments done)")
+
+    fd = os.open(partial, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+        fed = 0
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=parallel) as pool:
+            futures = {
+                pool.submit(_download_segment, url, fd, *segments[i]): i
+                for i in range(len(segments)) if i not in state.done
+            }
+            pending = set(futures)
+            while True:
+                # Pass on the contiguous prefix that is complete so far
+                while fed < len(segments) and fed in state.done:
+                    if on_chunk:
+                        _feed_file(partial, on_chunk, *segments[fed])
+                    fed += 1
+                if not pending:
+                    break
+                completed, pending = concurrent.futures.wait(
+                    pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if any(f.exception() for f in completed):
+                    # Keep whatever is complete so that a retry resumes
+                    # from there
+                    for f in pending:
+                        f.cancel()
+                    completed |= concurrent.futures.wait(pending).done
+                    pending = set()
+                state.done.update(futures[f] for f in completed
+                                  if not f.cancelled() and not f.exception())
+                state.save()
+                for f in completed:
+                    if not f.cancelled():
+                        f.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    state.remove()
+
+
+def validators(headers) -> Dict[str, Optional[str]]:
+    """
+    The HTTP headers that identify a version of a resource
+    """
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+
+
+def download(url: str, dst: str,
+             on_chunk: Optional[Callable[[bytes], None]] = None,
+             parallel: int = 4) -> Dict[str, Optional[str]]:
+    """
+    Download `url` to `dst`
+
+    If the server supports range requests and the file is larger than one
+    segment (SEGMENT_SIZE), the segments are downloaded by `parallel` workers.
+    The progress is kept in `dst`.partial(.json) so that an interrupted
+    download is resumed, as long as the ETag/Last-Modified of the resource
+    did not change.
+
+    `on_chunk` is called with the content in order as it becomes available.
+
+    Returns the validators (ETag/Last-Modified) of the downloaded resource.
+    """
+    partial = f'{dst}.partial'
+    try:
+        head = requests.head(url, allow_redirects=True, timeout=30)
+        head.raise_for_status()
+    except requests.RequestException:
+        head = None
+
+    headers = head.headers if head is not None else {}
+    size = int(headers.get('Content-Length', 0))
+    if (headers.get('Accept-Ranges') == 'bytes' and size > SEGMENT_SIZE
+            and not headers.get('Content-Encoding')):
+        found = validators(headers)
+        validator = found['etag'] or found['last_modified']
+        logger.info(f"Downloading {url} ({size} bytes) in {parallel} "
+                    "parallel streams")
+        _download_segmented(url, partial, size, validator, on_chunk,
+                            parallel)
+    else:
+        logger.info(f"Downloading {url}")
+        found = _download_stream(url, partial, on_chunk)
+
+    os.rename(partial, dst)
+    return found
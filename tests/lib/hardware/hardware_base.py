@@ -20,21 +20,130 @@
 # expected state.
 
 from abc import ABC, abstractmethod
+import concurrent.futures
+import contextlib
 import json
 import os
 import yaml
-import shutil
 import logging
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
+import tempfile
 import threading
 
 from tests.config import settings
-from tests.lib.common import handle_cleanup_input
+from tests.lib import scheduler
+from tests.lib import tracing
+from tests.lib.common import (Backoff, CANCEL_CHECK_INTERVAL,
+                              handle_cleanup_input)
 from tests.lib.hardware.node_base import NodeBase, NodeRole
 from tests.lib.workspace import Workspace
 
 logger = logging.getLogger(__name__)
 
+# The delays before booting a node again after it failed to boot, giving the
+# provider time to recover from whatever made it fail
+BOOT_RETRY_BACKOFF = Backoff(initial=5, maximum=60)
+
+
+class BootError(Exception):
+    """
+    Some nodes could not be booted
+
+    `errors` holds the last error for each of them by name. The nodes that
+    did boot are part of the hardware (and cleaned up with it).
+    """
+    def __init__(self, errors: Dict[str, BaseException]):
+        self.errors = errors
+        super().__init__(
+            f"Failed to boot {len(errors)} node(s): " + ", ".join(
+                f"{name} ({error!r})"
+                for name, error in sorted(errors.items())))
+
+
+class AnsibleInventory():
+    """
+    The ansible inventory of the nodes in `path`
+
+    Hosts are added and removed in memory. `write` puts the inventory on disk
+    (atomically, so a running playbook never sees a partial file) when it
+    changed since the last write.
+    """
+    def __init__(self, path: str, common_vars: Dict[str, Any]):
+        self.path = path
+        self._common_vars = common_vars
+        self._lock = threading.Lock()
+        # Held while writing, so callers get the path once it is up to date
+        self._write_lock = threading.Lock()
+        self._hosts: Dict[str, Tuple[List[str], Dict[str, Any]]] = {}
+        self._version = 0
+        self._written: Optional[int] = None
+
+    def add(self, name: str, tags: List[str], host_vars: Dict[str, Any]):
+        with self._lock:
+            self._hosts[name] = (list(tags), host_vars)
+            self._version += 1
+
+    def remove(self, name: str):
+        with self._lock:
+            if self._hosts.pop(name, None) is not None:
+                self._version += 1
+
+    def render(self) -> Dict[str, Any]:
+        """
+        The inventory (as written to nodes.yml)
+        """
+        inv: Dict[str, Any] = {
+            'all': {
+                'hosts': {},
+                'children': {}
+            }
+        }
+        with self._lock:
+            hosts = list(self._hosts.items())
+        for name, (tags, host_vars) in hosts:
+            # Copies, so the YAML doesn't use aliases for hosts in several
+            # groups
+            if not tags:
+                inv['all']['hosts'][name] = dict(host_vars)
+            for tag in tags:
+                inv['all']['children'].setdefault(
+                    tag, {'hosts': {}})['hosts'][name] = dict(host_vars)
+        return inv
+
+    def _write_file(self, path: str, data: Any):
+        f = tempfile.NamedTemporaryFile(
+            'w', dir=os.path.dirname(path), prefix='.', delete=False)
+        try:
+            with f:
+                yaml.safe_dump(data, f)
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+
+    def write(self) -> str:
+        """
+        Write the inventory if it changed and return its path
+        """
+        with self._write_lock:
+            with self._lock:
+                version = self._version
+            if version == self._written:
+                return self.path
+            if self._written is None:
+                group_vars_all_dir = os.path.join(
+                    self.path, 'group_vars', 'all')
+                os.makedirs(group_vars_all_dir, exist_ok=True)
+                # hardware groups vars which are useful for *all* nodes
+                self._write_file(
+                    os.path.join(group_vars_all_dir, 'common.yml'),
+                    self._common_vars)
+            self._write_file(os.path.join(self.path, 'nodes.yml'),
+                             self.render())
+            self._written = version
+        logger.info(f"Inventory path: {self.path}")
+        return self.path
+
 
 class HardwareBase(ABC):
     """
@@ -44,11 +153,12 @@ class HardwareBase(ABC):
         self._workspace = workspace
         self._nodes: Dict[str, NodeBase] = {}
         self._conn = self.get_connection()
-        self._ansible_inventory_dir = os.path.join(self.workspace.working_dir,
-                                                   'inventory')
-        # when nodes are created in threads, we need to lock the recreation
-        # of the ansible inventory dir
-        self._ansible_create_inventory_lock = threading.Lock()
+        self._ansible_inventory = AnsibleInventory(
+            os.path.join(self.workspace.working_dir, 'inventory'),
+            self.workspace.ansible_inventory_vars())
+        # Held by playbooks installing packages, as zypper takes a lock on
+        # the whole node
+        self._ansible_packages_lock = threading.Lock()
 
         logger.info(f"hardware {self}: Using {self.workspace.name}")
 
@@ -120,28 +230,147 @@ class HardwareBase(ABC):
     def node_add(self, node: NodeBase):
         logger.info(f"adding new node {node.name} to hardware {self}")
         self._node_remove_ssh_key(node)
+        # The inventory is updated in memory and only written before the
+        # next playbook runs (or once the batch of nodes booted)
+        self._ansible_inventory.add(node.name, node.tags,
+                                    node.ansible_inventory_vars())
         self.nodes[node.name] = node
-        with self._ansible_create_inventory_lock:
-            self._ansible_create_inventory()
+
+    def _boot_or_destroy(self, node: NodeBase):
+        """
+        Boot `node`, removing whatever was created if that fails (so that
+        booting can be retried)
+        """
+        try:
+            node.boot()
+        except Exception:
+            logger.warning(f"Booting {node.name} failed, removing it")
+            try:
+                node.destroy()
+            except Exception:
+                logger.exception(f"Unable to remove {node.name}")
+            raise
 
     def node_remove(self, node: NodeBase):
         logger.info(f"removing node {node.name} from hardware {self}")
         del self.nodes[node.name]
-        with self._ansible_create_inventory_lock:
-            self._ansible_create_inventory()
+        self._ansible_inventory.remove(node.name)
+        # A node booted later under the same name must not get these facts
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self.workspace.ansible_fact_cache_dir,
+                                   node.name))
         node.destroy()
 
-    @abstractmethod
+    def _boot_node(self, name: str, role: NodeRole, tags: List[str],
+                   cancelled: threading.Event) -> NodeBase:
+        attempts = max(int(settings.BOOT_ATTEMPTS), 1)
+        attempt = 1
+        delays = iter(BOOT_RETRY_BACKOFF)
+        while True:
+            delay = next(delays)
+            with tracing.span(name, category='node', role=role.name,
+                              attempt=attempt):
+                try:
+                    node = self.node_create(name, role, tags)
+                except Exception as e:
+                    if attempt >= attempts or cancelled.is_set():
+                        raise
+                    logger.warning(f"Booting {name} failed (attempt "
+                                   f"{attempt} of {attempts}), retrying in "
+                                   f"{delay:.1f}s", exc_info=True)
+                    error = e
+                else:
+                    self.node_add(node)
+                    return node
+            if cancelled.wait(delay):
+                raise error
+            attempt += 1
+
     def boot_nodes(self, masters: int, workers: int, offset: int = 0):
+        """
+        Create and add `masters` and `workers` nodes
+
+        Up to BOOT_CONCURRENCY nodes are booted at a time and each is tried
+        BOOT_ATTEMPTS times, waiting BOOT_RETRY_BACKOFF between attempts. Once
+        a node can't be booted the boots that haven't started yet are
+        cancelled, and a BootError is raised when the ones in progress are
+        done. The same happens (raising a
+        StepCancelledError) when the scheduler step booting the nodes is
+        cancelled.
+        """
         logger.info("boot nodes")
+        nodes = []
+        for m in range(0, masters):
+            tags = ['master', 'first_master'] if m == 0 else ['master']
+            nodes.append((f"{self.workspace.name}-master-{m + offset}",
+                          NodeRole.MASTER, tags))
+        for m in range(0, workers):
+            nodes.append((f"{self.workspace.name}-worker-{m + offset}",
+                          NodeRole.WORKER, ['worker']))
+
+        cancelled = threading.Event()
+        errors: Dict[str, BaseException] = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(int(settings.BOOT_CONCURRENCY), 1),
+                thread_name_prefix="boot") as executor:
+            futures = {
+                executor.submit(tracing.tracer.wrap(self._boot_node),
+                                name, role, tags, cancelled): name
+                for name, role, tags in nodes}
+            pending = set(futures)
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=CANCEL_CHECK_INTERVAL,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if scheduler.cancelled() and not cancelled.is_set():
+                    logger.warning("Cancelling the boots that haven't "
+                                   "started yet as the step was cancelled")
+                    cancelled.set()
+                    for f in futures:
+                        f.cancel()
+                for future in done:
+                    if future.cancelled():
+                        continue
+                    name = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Unable to boot {name}: {e!r}")
+                        errors[name] = e
+                        if not cancelled.is_set():
+                            cancelled.set()
+                            for f in futures:
+                                f.cancel()
+        self._ansible_inventory.write()
+        scheduler.check_cancelled()
+        if errors:
+            skipped = len([f for f in futures if f.cancelled()])
+            if skipped:
+                logger.error(f"Cancelled booting {skipped} more node(s)")
+            raise BootError(errors)
 
     def prepare_nodes(self, limit_to_nodes: List[NodeBase] = []):
         logger.info("prepare nodes")
         self.ansible_run_playbook("playbook_node_base.yml", limit_to_nodes)
 
+    @contextlib.contextmanager
+    def _ansible_playbook_lock(self, exclusive: bool):
+        if not exclusive:
+            yield
+            return
+        with self._ansible_packages_lock:
+            yield
+
     def ansible_run_playbook(self, playbook: str,
                              limit_to_nodes: List[NodeBase] = [],
-                             extra_vars={}):
+                             extra_vars={}, exclusive: bool = True):
+        """
+        Run `playbook` on all nodes (or `limit_to_nodes`)
+
+        Playbooks are `exclusive` unless told otherwise, which means only one
+        of them runs at a time. Only playbooks that don't install packages
+        (or otherwise take a lock on the nodes) should run concurrently.
+        """
         path = os.path.abspath(os.path.join(
             os.path.dirname(__file__), '../../assets/ansible', playbook
         ))
@@ -151,6 +380,10 @@ class HardwareBase(ABC):
         else:
             limit = ""
 
+        # One fork per node the playbook runs on, up to ANSIBLE_MAX_FORKS
+        forks = min(len(limit_to_nodes or self.nodes),
+                    int(settings.ANSIBLE_MAX_FORKS))
+
         extra_vars_param = ""
         if extra_vars:
             extra_vars_param += f" --extra-vars '{json.dumps(extra_vars)}'"
@@ -159,57 +392,12 @@ class HardwareBase(ABC):
                                 f" '{settings.ANSIBLE_EXTRA_VARS}'"
 
         logger.info(f'Running playbook {path} ({limit})')
-        self.workspace.execute(
-            f"ansible-playbook -i {self._ansible_inventory_dir} "
-            f"{limit} {extra_vars_param} {path}",
-            logger_name=f"ansible {playbook}")
-
-    def _ansible_create_inventory(self):
-        """
-        Create an ansible inventory/ directory structure which will
-        be used during ansible-playbook runs
-        """
-        group_vars_dir = os.path.join(self._ansible_inventory_dir,
-                                      'group_vars')
-        group_vars_all_dir = os.path.join(group_vars_dir, 'all')
-
-        # drop old inventory dir if available
-        if os.path.exists(self._ansible_inventory_dir):
-            shutil.rmtree(self._ansible_inventory_dir)
-            logger.info("deleted current ansible inventory "
-                        f"dir {self._ansible_inventory_dir}")
-
-        # create a inventory & group_vars directory
-        os.makedirs(group_vars_all_dir)
-
-        # write hardware groups vars which are useful for *all* nodes
-        group_vars_all_common = os.path.join(group_vars_all_dir, 'common.yml')
-        with open(group_vars_all_common, 'w') as f:
-            yaml.dump(self.workspace.ansible_inventory_vars(), f)
-
-        # write node specific inventory
-        inv = {
-            'all': {
-                'hosts': {},
-                'children': {}
-            }
-        }
-
-        for node in self.nodes.values():
-            if not node.tags:
-                inv['all']['hosts'][node.name] = node.ansible_inventory_vars()
-            else:
-                for tag in node.tags:
-                    if tag not in inv['all']['children']:
-                        inv['all']['children'][tag] = {'hosts': {}}
-                    inv['all']['children'][tag]['hosts'][node.name] = \
-                        node.ansible_inventory_vars()
-
-        nodes_inv_path = os.path.join(self._ansible_inventory_dir, "nodes.yml")
-        with open(nodes_inv_path, 'w') as inv_file:
-            yaml.dump(inv, inv_file)
-
-        logger.info('Inventory path: {}'.format(self._ansible_inventory_dir))
+        with self._ansible_playbook_lock(exclusive), \
+                tracing.span(playbook, category='ansible', limit=limit):
+            self.workspace.execute(
+                f"ansible-playbook -i {self._ansible_inventory.write()} "
+                f"--forks {max(forks, 1)} {limit} {extra_vars_param} {path}",
+                logger_name=f"ansible {playbook}")
 
     def _get_node_by_role(self, role: NodeRole):
         items = []
@@ -26,7 +26,6 @@ import time
 import tempfile
 import textwrap
 import threading
-import wget
 import datetime
 import logging
 import libvirt
@@ -347,10 +346,9 @@ class Hardware(HardwareBase):
                 self.workspace.working_dir,
                 os.path.basename(settings.LIBVIRT.IMAGE)
             )
-            wget.download(
+            self.workspace.download(
                 settings.LIBVIRT.IMAGE,
-                download_location,
-                bar=None
+                download_location
             )
             return download_location
         return settings.LIBVIRT.IMAGE
@@ -407,40 +405,9 @@ class Hardware(HardwareBase):
         conn = self.get_connection()
         node = Node(name, role, tags, conn, self._image_path, self._network,
                     settings.LIBVIRT.VM_MEMORY, self.workspace)
-        node.boot()
+        self._boot_or_destroy(node)
         return node
 
-    def _boot_node(self, name: str, role: NodeRole, tags: List[str]):
-        node = self.node_create(name, role, tags)
-        self.node_add(node)
-
-    def boot_nodes(self, masters: int, workers: int, offset: int = 0):
-        super().boot_nodes(masters, workers, offset)
-        threads = []
-        for c in range(0, masters):
-            if c == 0:
-                tags = ['master', 'first_master']
-            else:
-                tags = ['master']
-            t = threading.Thread(
-                target=self._boot_node, args=(
-                    f"{self.workspace.name}-master-{c}",
-                    NodeRole.MASTER, tags))
-            threads.append(t)
-            t.start()
-
-        for c in range(0, workers):
-            t = threading.Thread(
-                target=self._boot_node, args=(
-                    f"{self.workspace.name}-worker-{c}",
-                    NodeRole.WORKER, ['worker']))
-            threads.append(t)
-            t.start()
-
-        # wait for all threads to finish
-        for t in threads:
-            t.join()
-
     def destroy(self, skip=False):
         super().destroy(skip=skip)
 
@@ -0,0 +1,158 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A hardware provider that only simulates nodes. Booting, attaching disks and
+# running playbooks take a configurable amount of time and can be made to
+# fail, but nothing is created. This allows benchmarking and testing the
+# orchestration (node scheduling, inventory generation, ...) with any number
+# of nodes without a cloud.
+
+import ipaddress
+import logging
+import random
+import string
+import threading
+import time
+from typing import Any, Dict, List
+
+from tests.config import settings
+from tests.lib import tracing
+from tests.lib.hardware.hardware_base import HardwareBase
+from tests.lib.hardware.node_base import NodeBase, NodeRole
+from tests.lib.workspace import Workspace
+
+
+logger = logging.getLogger(__name__)
+
+# Addresses reserved for benchmarking (RFC 2544), they never route anywhere
+NODE_NETWORK = ipaddress.ip_network('198.18.0.0/15')
+
+
+class Simulator():
+    """
+    Delays operations by their configured latency and injects failures
+
+    `config` holds `<operation>_latency` (seconds) and
+    `<operation>_failure_rate` (0 to 1) for each operation, `latency_jitter`
+    (the fraction by which latencies vary randomly) and an optional `seed`.
+    """
+    def __init__(self, config: Dict[str, Any]):
+        self._config = config
+        self._lock = threading.Lock()
+        seed = config.get('seed')
+        self._random = random.Random(seed if seed != "" else None)
+
+    def _get(self, key: str) -> float:
+        return float(self._config.get(key) or 0)
+
+    def run(self, operation: str, subject: str):
+        latency = self._get(f'{operation}_latency')
+        jitter = self._get('latency_jitter')
+        with self._lock:
+            latency *= 1 + self._random.uniform(-jitter, jitter)
+            fail = self._random.random() < self._get(
+                f'{operation}_failure_rate')
+        if latency > 0:
+            time.sleep(latency)
+        if fail:
+            raise Exception(f"Injected {operation} failure for {subject}")
+
+
+class Node(NodeBase):
+    def __init__(self, name: str, role: NodeRole, tags: List[str],
+                 ip: str, simulator: Simulator):
+        super().__init__(name, role, tags)
+        self._ip = ip
+        self._simulator = simulator
+        self._booted = False
+
+    def boot(self):
+        self._simulator.run('boot', self.name)
+        self._booted = True
+        logger.info(f"Simulated node {self.name} booted at {self._ip}")
+
+        if self._role == NodeRole.WORKER:
+            for i in range(0, settings.WORKER_INITIAL_DATA_DISKS):
+                disk_name = self.disk_create(10)
+                self.disk_attach(name=disk_name)
+
+    def get_ssh_ip(self) -> str:
+        return self._ip
+
+    def disk_create(self, capacity: int):
+        super().disk_create(capacity)
+        if not self._booted:
+            raise Exception("Can not create a disk until a node is created")
+        suffix = ''.join(random.choice(string.ascii_lowercase)
+                         for i in range(5))
+        name = f"{self.name}-volume-{suffix}"
+        self._disks[name] = {'capacity': capacity, 'attached': False}
+        return name
+
+    def disk_attach(self, name: str):
+        self._simulator.run('disk_attach', name)
+        self._disks[name]['attached'] = True
+        logger.info(f"disk {name} attached to {self.name}")
+
+    def disk_detach(self, name: str):
+        self._disks[name]['attached'] = False
+        logger.info(f"disk {name} detached from {self.name}")
+
+    def destroy(self):
+        self._simulator.run('destroy', self.name)
+        self._disks = {}
+        self._booted = False
+
+
+class Hardware(HardwareBase):
+    """
+    The simulated hardware provider
+
+    The latencies and failure rates are taken from the [null] settings, any
+    of which can be overridden with `simulation`.
+    """
+    def __init__(self, workspace: Workspace, **simulation):
+        config = dict(settings.NULL)
+        config.update(simulation)
+        self._simulator = Simulator(config)
+        self._next_ip = 1
+        self._ip_lock = threading.Lock()
+        super().__init__(workspace)
+
+    def get_connection(self):
+        return None
+
+    def _allocate_ip(self) -> str:
+        with self._ip_lock:
+            ip = NODE_NETWORK[self._next_ip]
+            self._next_ip += 1
+        return str(ip)
+
+    def node_create(self, name: str, role: NodeRole,
+                    tags: List[str]) -> Node:
+        super().node_create(name, role, tags)
+        node = Node(name, role, tags, self._allocate_ip(), self._simulator)
+        self._boot_or_destroy(node)
+        return node
+
+    def ansible_run_playbook(self, playbook: str,
+                             limit_to_nodes: List[NodeBase] = [],
+                             extra_vars={}, exclusive: bool = True):
+        # There is nothing to connect to, so only simulate the run
+        self._ansible_inventory.write()
+        nodes = limit_to_nodes or list(self.nodes.values())
+        logger.info(f"Simulating playbook {playbook} on {len(nodes)} nodes")
+        with self._ansible_playbook_lock(exclusive), \
+                tracing.span(playbook, category='ansible'):
+            self._simulator.run('playbook', playbook)
@@ -15,7 +15,6 @@
 
 import logging
 from typing import List, Optional
-import threading
 import string
 import random
 
@@ -189,43 +188,9 @@ class Hardware(HardwareBase):
                     self._flavor, self._image,
                     self._network_private, self._network_public,
                     self._security_group, self._keypair.name)
-        node.boot()
+        self._boot_or_destroy(node)
         return node
 
-    def _node_create_add(self, name: str, role: NodeRole,
-                         tags: List[str]):
-        node = self.node_create(name, role, tags)
-        self.node_add(node)
-
-    def boot_nodes(self, masters: int, workers: int, offset: int = 0):
-        super().boot_nodes(masters, workers, offset)
-        threads = []
-        for m in range(0, masters):
-            if m == 0:
-                tags = ['master', 'first_master']
-            else:
-                tags = ['master']
-            node_name = "%s-master-%d" % (self.workspace.name, m+offset)
-
-            thread = threading.Thread(
-                target=self._node_create_add, args=(node_name, NodeRole.MASTER,
-                                                    tags))
-            threads.append(thread)
-            thread.start()
-
-        for m in range(0, workers):
-            tags = ['worker']
-            node_name = "%s-worker-%d" % (self.workspace.name, m+offset)
-            thread = threading.Thread(
-                target=self._node_create_add, args=(node_name, NodeRole.WORKER,
-                                                    tags))
-            threads.append(thread)
-            thread.start()
-
-        # wait for all threads to finish
-        for t in threads:
-            t.join()
-
     def destroy(self, skip=False):
         super().destroy(skip=skip)
 
@@ -21,15 +21,13 @@
 import logging
 import os
 from typing import List
-import threading
-import re
 import time
 
+from tests.lib.kubernetes import waiters
 from tests.lib.kubernetes.kubernetes_base import KubernetesBase
 from tests.lib.hardware.hardware_base import HardwareBase
 from tests.lib.hardware.node_base import NodeBase, NodeRole
 from tests.lib.workspace import Workspace
-from tests.lib import common
 
 
 logger = logging.getLogger(__name__)
@@ -59,17 +57,14 @@ class CaaSP(KubernetesBase):
             check=True, chdir=self._clusterpath
         )
 
-    def _skuba_join(self, node: NodeBase):
+    def _skuba_join_command(self, node: NodeBase) -> str:
         if node.role == NodeRole.WORKER:
             role = 'worker'
         else:
             role = 'master'
 
-        self.workspace.execute(
-            f"{self._skuba} node join --role {role} --user sles --sudo "
-            f"--target {node.get_ssh_ip()} {node.name}",
-            capture=True, check=True, chdir=self._clusterpath
-        )
+        return (f"{self._skuba} node join --role {role} --user sles --sudo "
+                f"--target {node.get_ssh_ip()} {node.name}")
 
     def join(self, nodes: List[NodeBase]):
         super().join(nodes)
@@ -77,14 +72,9 @@ class CaaSP(KubernetesBase):
         self.hardware.ansible_run_playbook('playbook_caasp.yaml', nodes)
 
         # join nodes in parallel
-        threads = []
-        for node in nodes:
-            t = threading.Thread(target=self._skuba_join, args=(node,))
-            threads.append(t)
-            t.start()
-        # wait for all threads to finish
-        for t in threads:
-            t.join()
+        self.workspace.execute_many(
+            [self._skuba_join_command(node) for node in nodes],
+            capture=True, check=True, chdir=self._clusterpath)
 
         # Mark the worker nodes for any role:
         for node in nodes:
@@ -97,14 +87,9 @@ class CaaSP(KubernetesBase):
         self.join(self.hardware.workers)
         logger.info("Wait for all nodes to be in 'Ready' state"
                     "(this may take a while...)")
-        pattern = re.compile(r' +Ready.*')
-        common.wait_for_result(
-            self.workspace.execute, f"{self._skuba} cluster status",
-            matcher=common.regex_count_matcher(
-                pattern, len(self.hardware.nodes)),
-            attempts=60,
-            interval=10,
-            chdir=self._clusterpath,
-            capture=True)
+        waiters.wait_for_objects(
+            self.v1.list_node,
+            waiters.nodes_ready_matcher(len(self.hardware.nodes)),
+            timeout=600, description="nodes Ready")
         # Give skupa-update/zypper some time to release lock
         time.sleep(5)
@@ -0,0 +1,193 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A long lived shell inside a pod. Instead of forking `kubectl exec` for every
+# command, one exec stream is opened through the API server's websocket and
+# commands are sent to the shell over stdin. The end of each command's output
+# is found through a marker that carries the exit code.
+#
+# The pod is looked up by label through the kubernetes informer cache before
+# every command, so when the watch reports that the pod was rescheduled the
+# session is reopened in the new pod.
+#
+# `kubernetes.stream.stream` swaps the `call_api` of the client it is given for
+# the websocket call while it runs, so the session uses an ApiClient of its own
+# rather than the one shared with the informers and waiters.
+
+import base64
+import logging
+import subprocess
+import threading
+import time
+import uuid
+from typing import Any, Optional, Tuple
+
+import kubernetes
+import websocket
+
+from tests.lib import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+class ExecSession():
+    """
+    A shell in the running pod matching `label_selector` in `namespace`
+
+    `kubernetes` is the KubernetesBase used to find the pod and open the
+    stream. Commands are run one at a time.
+    """
+    def __init__(self, kubernetes, label_selector: str,
+                 namespace: str = "rook-ceph", shell: str = "bash"):
+        self._kubernetes = kubernetes
+        self._label_selector = label_selector
+        self._namespace = namespace
+        self._shell = shell
+        self._lock = threading.Lock()
+        self._ws: Any = None
+        self._pod: Optional[str] = None
+        self._api_client: Any = None
+
+    @property
+    def pod(self) -> Optional[str]:
+        return self._pod
+
+    def _resolve(self) -> str:
+        pods = self._kubernetes.list_pods(
+            label_selector=self._label_selector, namespace=self._namespace)
+        running = [p.metadata.name for p in pods
+                   if p.status is not None and p.status.phase == 'Running'
+                   and p.metadata.deletion_timestamp is None]
+        if not running:
+            raise Exception(f"No running pod matches {self._label_selector} "
+                            f"in {self._namespace}")
+        if self._pod in running:
+            return self._pod  # type: ignore
+        return running[0]
+
+    def _exec_api(self):
+        """
+        A CoreV1Api on a client only used by this session
+        """
+        if self._api_client is None:
+            self._api_client = kubernetes.client.ApiClient(
+                self._kubernetes.api_client.configuration)
+        return kubernetes.client.CoreV1Api(self._api_client)
+
+    def _connect(self, pod: str):
+        return kubernetes.stream.stream(
+            self._exec_api().connect_get_namespaced_pod_exec,
+            pod, self._namespace, command=[self._shell],
+            stdin=True, stdout=True, stderr=True, tty=False,
+            _preload_content=False)
+
+    def _open(self, pod: str):
+        self.close()
+        logger.info(f"Opening exec session in {self._namespace}/{pod}")
+        self._ws = self._connect(pod)
+        self._pod = pod
+
+    def close(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                logger.debug("Unable to close exec session", exc_info=True)
+        self._ws = None
+        self._pod = None
+        if self._api_client is not None:
+            self._api_client.close()
+            self._api_client = None
+
+    def _run(self, command: str, timeout: float) -> Tuple[int, str, str]:
+        marker = f"__rookcheck_{uuid.uuid4().hex}__"
+        encoded = base64.b64encode(command.encode()).decode()
+        # The command is passed encoded so no quoting is needed, and the
+        # markers are written on their own line to both stdout and stderr so
+        # the end of both streams is known.
+        self._ws.write_stdin(
+            f"{self._shell} -c \"$(echo {encoded} | base64 -d)\" "
+            f"</dev/null; "
+            f"rc=$?; printf '\\n%s %s\\n' {marker} $rc; "
+            f"printf '\\n%s\\n' {marker} >&2\n")
+
+        stdout = stderr = ""
+        deadline = time.monotonic() + timeout
+        end_stdout = f"\n{marker} "
+        end_stderr = f"\n{marker}\n"
+        while end_stdout not in stdout or not stdout.endswith("\n") or \
+                end_stderr not in stderr:
+            if not self._ws.is_open():
+                raise ConnectionError(
+                    f"Exec session in {self._pod} was closed")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out running {command} in "
+                                   f"{self._pod}")
+            self._ws.update(timeout=1)
+            stdout += self._ws.read_stdout(timeout=0)
+            stderr += self._ws.read_stderr(timeout=0)
+
+        stdout, rc = stdout.rsplit(end_stdout, 1)
+        stderr = stderr.rsplit(end_stderr, 1)[0]
+        return int(rc), stdout, stderr
+
+    def execute(self, command: str, check: bool = True,
+                log_stdout: bool = True, log_stderr: bool = True,
+                timeout: float = 300) -> Tuple[int, str, str]:
+        """
+        Run `command` in the pod, like `common.execute` with capture=True
+
+        If `check` is true, subprocess.CalledProcessError is raised when the
+        RC is not 0.
+
+        If the stream was closed (eg. the pod went away) the session is
+        reopened, in the current pod, and the command is tried once more.
+        """
+        with self._lock:
+            pod = self._resolve()
+            with tracing.span(command, category='command', pod=pod) as span:
+                for attempt in range(2):
+                    if self._ws is None or pod != self._pod or \
+                            not self._ws.is_open():
+                        self._open(pod)
+                    try:
+                        rc, stdout, stderr = self._run(command, timeout)
+                        break
+                    except TimeoutError:
+                        # The shell is still busy with the command, so don't
+                        # reuse it
+                        self.close()
+                        raise
+                    except (ConnectionError, websocket.WebSocketException):
+                        self.close()
+                        if attempt:
+                            raise
+                        logger.warning(f"Exec session in {pod} failed, "
+                                       f"reopening", exc_info=True)
+                        pod = self._resolve()
+                span.args['rc'] = rc
+
+        exec_logger = logging.getLogger(f"{self._pod}: {command}")
+        if log_stdout:
+            for line in stdout.splitlines():
+                exec_logger.info(line)
+        if log_stderr:
+            for line in stderr.splitlines():
+                exec_logger.warning(line)
+        logger.debug(f"Command {command} in {self._pod} finished with RC "
+                     f"{rc}")
+        if check and rc != 0:
+            raise subprocess.CalledProcessError(rc, command, stdout, stderr)
+        return rc, stdout, stderr
@@ -0,0 +1,367 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A local cache of kubernetes objects in the style of client-go's informers.
+# The objects are listed once and then kept up to date from a watch stream in
+# a background thread. Reads are served from memory using indexes by namespace
+# and label, so polling loops don't cost a round trip to the API server.
+#
+# The cache lags behind the API server by the latency of the watch stream
+# (usually milliseconds). Use `wait_for` rather than a single read when
+# waiting for a change.
+
+import logging
+import threading
+import time
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional, Set,
+                    Tuple)
+
+import kubernetes
+
+from tests.lib import common
+from tests.lib import scheduler
+from tests.lib.kubernetes import waiters
+
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATUS_GONE = 410
+# Watches are restarted after this many seconds to refresh the connection
+WATCH_TIMEOUT = 300
+# How long to wait before relisting after an unexpected error
+RETRY_INTERVAL = 5
+
+
+class Requirement(NamedTuple):
+    key: str
+    operator: str  # one of '=', '!=', 'exists', '!exists'
+    value: Optional[str]
+
+
+def parse_label_selector(selector: Optional[str]) -> List[Requirement]:
+    """
+    Parse an equality based label selector (eg. "app=foo,tier!=db,!canary")
+
+    Raises a ValueError for set based selectors (eg. "app in (a, b)"), which
+    are not supported.
+    """
+    requirements: List[Requirement] = []
+    if not selector:
+        return requirements
+    for term in selector.split(','):
+        term = term.strip()
+        if not term:
+            continue
+        if ' ' in term or '(' in term:
+            raise ValueError(f"Unsupported label selector {selector}")
+        if '!=' in term:
+            key, value = term.split('!=', 1)
+            requirements.append(Requirement(key, '!=', value))
+        elif '==' in term:
+            key, value = term.split('==', 1)
+            requirements.append(Requirement(key, '=', value))
+        elif '=' in term:
+            key, value = term.split('=', 1)
+            requirements.append(Requirement(key, '=', value))
+        elif term.startswith('!'):
+            requirements.append(Requirement(term[1:], '!exists', None))
+        else:
+            requirements.append(Requirement(term, 'exists', None))
+    return requirements
+
+
+def parse_field_selector(selector: Optional[str]) -> Optional[str]:
+    """
+    The object name selected by a field selector (eg. "metadata.name=foo")
+
+    Raises a ValueError for any other field selector, which is not supported.
+    """
+    if not selector:
+        return None
+    key, _, value = selector.partition('=')
+    if key != 'metadata.name' or not value or ',' in value or \
+            value.startswith('='):
+        raise ValueError(f"Unsupported field selector {selector}")
+    return value
+
+
+def _matches(labels: Dict[str, str], requirements: List[Requirement]) -> bool:
+    for r in requirements:
+        if r.operator == '=' and labels.get(r.key) != r.value:
+            return False
+        if r.operator == '!=' and labels.get(r.key) == r.value:
+            return False
+        if r.operator == 'exists' and r.key not in labels:
+            return False
+        if r.operator == '!exists' and r.key in labels:
+            return False
+    return True
+
+
+def _key(obj) -> Tuple[Optional[str], str]:
+    return (obj.metadata.namespace, obj.metadata.name)
+
+
+class Informer():
+    """
+    Keeps the objects returned by `list_func` (eg.
+    `CoreV1Api.list_pod_for_all_namespaces`) up to date in memory
+
+    `watch_factory` creates the watch used to follow changes (a
+    `kubernetes.watch.Watch` by default).
+    """
+    def __init__(self, list_func: Callable, name: Optional[str] = None,
+                 watch_factory: Callable = kubernetes.watch.Watch):
+        self._list_func = list_func
+        self._name = name or list_func.__name__
+        self._watch_factory = watch_factory
+        self._lock = threading.Condition()
+        self._objects: Dict[Tuple[Optional[str], str], Any] = {}
+        self._by_namespace: Dict[Optional[str], Set[Tuple]] = {}
+        self._by_label: Dict[Tuple[str, Optional[str]], Set[Tuple]] = {}
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._watch: Any = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name=f"informer {self._name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch is not None:
+            self._watch.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def wait_for_sync(self, timeout: float = 60) -> bool:
+        """
+        Wait until the initial list has been loaded
+        """
+        return self._synced.wait(timeout)
+
+    def _index(self, key, obj):
+        self._by_namespace.setdefault(key[0], set()).add(key)
+        for label in (obj.metadata.labels or {}).items():
+            self._by_label.setdefault(label, set()).add(key)
+
+    def _unindex(self, key, obj):
+        self._by_namespace.get(key[0], set()).discard(key)
+        for label in (obj.metadata.labels or {}).items():
+            self._by_label.get(label, set()).discard(key)
+
+    def _replace(self, items: List[Any]):
+        with self._lock:
+            self._objects = {}
+            self._by_namespace = {}
+            self._by_label = {}
+            for obj in items:
+                key = _key(obj)
+                self._objects[key] = obj
+                self._index(key, obj)
+            self._lock.notify_all()
+
+    def _apply(self, event_type: str, obj):
+        key = _key(obj)
+        with self._lock:
+            old = self._objects.pop(key, None)
+            if old is not None:
+                self._unindex(key, old)
+            if event_type != 'DELETED':
+                self._objects[key] = obj
+                self._index(key, obj)
+            self._lock.notify_all()
+
+    def _run(self):
+        resource_version = None
+        while not self._stopped.is_set():
+            try:
+                if resource_version is None:
+                    result = self._list_func()
+                    self._replace(result.items)
+                    resource_version = result.metadata.resource_version
+                    self._synced.set()
+                    logger.debug(f"Informer {self._name} listed "
+                                 f"{len(result.items)} objects")
+
+                self._watch = self._watch_factory()
+                for event in self._watch.stream(
+                        self._list_func, resource_version=resource_version,
+                        timeout_seconds=WATCH_TIMEOUT):
+                    if event['type'] == 'ERROR':
+                        # The resource version is too old, start over
+                        resource_version = None
+                        break
+                    obj = event['object']
+                    resource_version = obj.metadata.resource_version
+                    if event['type'] in ('ADDED', 'MODIFIED', 'DELETED'):
+                        self._apply(event['type'], obj)
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != HTTP_STATUS_GONE:
+                    logger.warning(f"Informer {self._name} failed: {e}")
+                    self._stopped.wait(RETRY_INTERVAL)
+                resource_version = None
+            except Exception:
+                if self._stopped.is_set():
+                    break
+                logger.exception(f"Informer {self._name} failed")
+                self._stopped.wait(RETRY_INTERVAL)
+                resource_version = None
+
+    def list(self, namespace: Optional[str] = None,
+             label_selector: Optional[str] = None,
+             field_selector: Optional[str] = None) -> List[Any]:
+        """
+        The cached objects in `namespace` (or all namespaces if None) that
+        match the selectors
+
+        Raises a ValueError if a selector can't be evaluated locally (see
+        `parse_label_selector` and `parse_field_selector`).
+        """
+        requirements = parse_label_selector(label_selector)
+        name = parse_field_selector(field_selector)
+        with self._lock:
+            return self._select(namespace, requirements, name)
+
+    def _select(self, namespace: Optional[str],
+                requirements: List[Requirement],
+                name: Optional[str]) -> List[Any]:
+        # Start from the smallest index that applies
+        candidates: Optional[Set[Tuple]] = None
+        if namespace is not None:
+            candidates = self._by_namespace.get(namespace, set())
+        for r in requirements:
+            if r.operator == '=':
+                by_label = self._by_label.get((r.key, r.value), set())
+                if candidates is None or len(by_label) < len(candidates):
+                    candidates = by_label
+        keys = candidates if candidates is not None else self._objects.keys()
+
+        objects = []
+        for key in sorted(keys):
+            obj = self._objects[key]
+            if namespace is not None and key[0] != namespace:
+                continue
+            if name is not None and key[1] != name:
+                continue
+            if _matches(obj.metadata.labels or {}, requirements):
+                objects.append(obj)
+        return objects
+
+    def wait_for(self, matcher: Callable[[List[Any]], bool],
+                 namespace: Optional[str] = None,
+                 label_selector: Optional[str] = None,
+                 field_selector: Optional[str] = None, timeout: float = 600,
+                 description: Optional[str] = None,
+                 abort: Optional[Callable[[List[Any]], None]] = None
+                 ) -> List[Any]:
+        """
+        Wait until `matcher` holds for the objects selected as in `list`
+
+        The objects are re-evaluated on every change to the cache. The wait
+        is recorded in `common.wait_stats`. `abort` is as for
+        `waiters.wait_for_objects`.
+
+        Returns the objects that satisfied `matcher`, or raises a
+        TimeoutError after `timeout` seconds.
+        """
+        description = description or \
+            f"{self._name} {label_selector or ''} in {namespace}"
+        requirements = parse_label_selector(label_selector)
+        name = parse_field_selector(field_selector)
+        abort = scheduler.cancellable(abort)
+        start = time.monotonic()
+        deadline = start + timeout
+        changes = 0
+        self.wait_for_sync(timeout)
+        with self._lock:
+            while True:
+                objects = self._select(namespace, requirements, name)
+                if abort is not None:
+                    try:
+                        abort(objects)
+                    except Exception:
+                        common.wait_stats.record(
+                            description, time.monotonic() - start, changes,
+                            False)
+                        raise
+                if matcher(objects):
+                    common.wait_stats.record(
+                        description, time.monotonic() - start, changes, True)
+                    return objects
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if abort is not None:
+                    remaining = min(remaining,
+                                    waiters.ABORT_CHECK_INTERVAL)
+                if self._lock.wait(remaining):
+                    changes += 1
+
+        common.wait_stats.record(
+            description, time.monotonic() - start, changes, False)
+        logger.error(f"Timed out waiting for {description}")
+        for obj in objects:
+            logger.error(f"{_key(obj)}")
+        raise TimeoutError(f"Timed out waiting for {description}")
+
+
+class InformerCache():
+    """
+    Informers for the kinds of objects the tests look at, started on first
+    use
+
+    `watch_factory` is passed on to each Informer.
+    """
+    def __init__(self, v1: Any,
+                 watch_factory: Callable = kubernetes.watch.Watch):
+        self._lock = threading.Lock()
+        self._watch_factory = watch_factory
+        self._informers: Dict[str, Informer] = {}
+        self._list_funcs = {
+            'pods': v1.list_pod_for_all_namespaces,
+            'services': v1.list_service_for_all_namespaces,
+            'nodes': v1.list_node,
+            'pvcs': v1.list_persistent_volume_claim_for_all_namespaces,
+        }
+
+    def informer(self, kind: str) -> Informer:
+        """
+        The synced informer for `kind` (pods, services, nodes or pvcs)
+        """
+        with self._lock:
+            informer = self._informers.get(kind)
+            if informer is None:
+                informer = Informer(self._list_funcs[kind], name=kind,
+                                    watch_factory=self._watch_factory)
+                informer.start()
+                self._informers[kind] = informer
+        if not informer.wait_for_sync():
+            raise TimeoutError(f"Timed out syncing the {kind} informer")
+        return informer
+
+    def stop(self):
+        with self._lock:
+            for informer in self._informers.values():
+                informer.stop()
+            self._informers = {}
@@ -19,16 +19,22 @@
 # would require SLE and can raise an exception if that isn't provided.
 
 from abc import ABC, abstractmethod
+import collections
+import concurrent.futures
+import gzip
 import json
 import kubernetes
 import logging
 import os
-import re
-import time
-from typing import List
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 from tests.config import settings
 from tests.lib import common
+from tests.lib.kubernetes import manifests
+from tests.lib.kubernetes import waiters
+from tests.lib.kubernetes.informer import InformerCache
+from tests.lib.kubernetes.recorder import Recorder
 from tests.lib.hardware.hardware_base import HardwareBase
 from tests.lib.hardware.node_base import NodeBase
 from tests.lib.workspace import Workspace
@@ -36,6 +42,37 @@ from tests.lib.workspace import Workspace
 
 logger = logging.getLogger(__name__)
 
+# The number of HTTP connections kept open to the API server. Waits, gathering
+# logs and test helpers may use the client from several threads at once.
+API_CONNECTION_POOL_SIZE = 16
+
+# How many requests gather_logs runs at once
+GATHER_LOGS_WORKERS = 8
+# The most log output gathered for any one pod
+GATHER_LOGS_BYTES_PER_POD = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# The lists gathered by gather_logs and the CoreV1Api methods returning them
+GATHER_LOGS_LISTS = {
+    'config_maps.json': 'list_config_map_for_all_namespaces',
+    'endpoints.json': 'list_endpoints_for_all_namespaces',
+    'events.json': 'list_event_for_all_namespaces',
+    'limit_ranges.json': 'list_limit_range_for_all_namespaces',
+    'namespaces.json': 'list_namespace',
+    'nodes.json': 'list_node',
+    'persistent_volumes.json': 'list_persistent_volume',
+    'persistent_volume_claims.json':
+        'list_persistent_volume_claim_for_all_namespaces',
+    'pods.json': 'list_pod_for_all_namespaces',
+    'pod_templates.json': 'list_pod_template_for_all_namespaces',
+    'replication_controllers.json':
+        'list_replication_controller_for_all_namespaces',
+    'resource_quotas.json': 'list_resource_quota_for_all_namespaces',
+    'secrets.json': 'list_secret_for_all_namespaces',
+    'services.json': 'list_service_for_all_namespaces',
+    'service_accounts.json': 'list_service_account_for_all_namespaces'
+}
+
 
 class KubernetesBase(ABC):
     def __init__(self, workspace: Workspace, hardware: HardwareBase):
@@ -48,9 +85,31 @@ class KubernetesBase(ABC):
             self.workspace.working_dir, 'bin/kubectl')
         self._helm_exec = os.path.join(
             self.workspace.working_dir, 'bin/helm3')
-        self.v1 = None
+        self.api_client: Any = None
+        self.v1: Any = None
+        self.custom_objects: Any = None
+        self.informers: Optional[InformerCache] = None
+        self.recorder: Optional[Recorder] = None
+        self._manifest_applier: Optional[manifests.ManifestApplier] = None
+        self._fetch_lock = threading.Lock()
+        self._fetched = False
         logger.info(f"kube init on hardware {self.hardware}")
 
+    def fetch(self):
+        """
+        Download the tools needed to install and talk to kubernetes, which
+        can happen while the nodes come up
+
+        Only the first call downloads anything.
+        """
+        with self._fetch_lock:
+            if not self._fetched:
+                self._fetch()
+                self._fetched = True
+
+    def _fetch(self):
+        pass
+
     @abstractmethod
     def bootstrap(self):
         """
@@ -94,68 +153,101 @@ class KubernetesBase(ABC):
         os.makedirs(dest_dir, exist_ok=True)
         logging.info(f"Gathering kubernetes logs to {dest_dir}")
 
-        try:
-            with open(os.path.join(dest_dir, 'get_all.txt'), 'w') as f:
-                rc, stdout, stderr = self.kubectl("get all --all-namespaces",
-                                                  log_stdout=False)
-                f.write(stdout)
-        except Exception:
-            logger.exception("Unable to `kubectl get all`")
-
-        methods = {
-            'config_maps.json': 'list_config_map_for_all_namespaces',
-            'endpoints.json': 'list_endpoints_for_all_namespaces',
-            'events.json': 'list_event_for_all_namespaces',
-            'limit_ranges.json': 'list_limit_range_for_all_namespaces',
-            'namespaces.json': 'list_namespace',
-            'nodes.json': 'list_node',
-            'persistent_volumes.json': 'list_persistent_volume',
-            'persistent_volume_claims.json':
-                'list_persistent_volume_claim_for_all_namespaces',
-            'pods.json': 'list_pod_for_all_namespaces',
-            'pod_templates.json': 'list_pod_template_for_all_namespaces',
-            'replication_controllers.json':
-                'list_replication_controller_for_all_namespaces',
-            'resource_quotas.json': 'list_resource_quota_for_all_namespaces',
-            'secrets.json': 'list_secret_for_all_namespaces',
-            'services.json': 'list_service_for_all_namespaces',
-            'service_accounts.json': 'list_service_account_for_all_namespaces'
-
-        }
-
-        for file_name, method in methods.items():
-            try:
-                with open(os.path.join(dest_dir, file_name), 'w') as f:
-                    json.dump(
-                        getattr(self.v1, method)().to_dict(),
-                        f, default=str, sort_keys=True, indent=2
-                    )
-            except Exception:
-                logger.exception(f"Unable to log {method}")
-
-        pod_logs_dest_dir = os.path.join(dest_dir, 'pod_logs')
-        os.makedirs(pod_logs_dest_dir, exist_ok=True)
-        pods = self.v1.list_pod_for_all_namespaces()
-        for pod in pods.items:
-            pod_name = pod.metadata.name
-            namespace = pod.metadata.namespace
-            try:
-                with open(os.path.join(pod_logs_dest_dir, f'{pod_name}.txt'),
-                          'w') as f:
-                    f.write(
-                        self.v1.read_namespaced_pod_log(pod_name, namespace)
-                    )
-            except Exception:
-                logger.warning(f"Unable to get logs for pod {pod_name}")
+        # The logs of the containers that were recorded during the run are
+        # already on disk
+        recorded: Dict[Tuple[str, str], Set[str]] = \
+            collections.defaultdict(set)
+        if self.recorder is not None:
+            self.recorder.stop()
+            for namespace, pod, container in \
+                    self.recorder.recorded_containers:
+                recorded[(namespace, pod)].add(container)
+
+        # Everything is collected concurrently and written gzipped as it is
+        # received, so neither the time nor the memory needed grows much with
+        # the number of pods.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=GATHER_LOGS_WORKERS) as executor:
+            for command, file_name in [
+                    ("get all --all-namespaces", 'get_all.txt.gz'),
+                    ("describe pods --all-namespaces", 'describe_pods.txt.gz'),
+            ]:
+                executor.submit(self._gather_kubectl, command,
+                                os.path.join(dest_dir, file_name))
+            for file_name, method in GATHER_LOGS_LISTS.items():
+                executor.submit(self._gather_list, method,
+                                os.path.join(dest_dir, f'{file_name}.gz'))
+
+            pod_logs_dest_dir = os.path.join(dest_dir, 'pod_logs')
+            os.makedirs(pod_logs_dest_dir, exist_ok=True)
             try:
-                with open(os.path.join(pod_logs_dest_dir,
-                                       f'describe_{pod_name}.txt'), 'w') as f:
-                    rc, stdout, stderr = self.kubectl(
-                        f"-n {namespace} describe pod {pod_name}",
-                        log_stdout=False)
-                    f.write(stdout)
+                pods = self.v1.list_pod_for_all_namespaces().items
             except Exception:
-                logger.warning(f"Unable to describe pod {pod_name}")
+                logger.exception("Unable to list pods")
+                pods = []
+            for pod in pods:
+                executor.submit(self._gather_pod_logs, pod, pod_logs_dest_dir,
+                                recorded.get((pod.metadata.namespace,
+                                              pod.metadata.name), set()))
+
+    def _gather_kubectl(self, command, path):
+        try:
+            self.kubectl(command, log_stdout=False, capture=False, tee=path)
+        except Exception:
+            logger.exception(f"Unable to `kubectl {command}`")
+
+    def _gather_list(self, method, path):
+        try:
+            result = getattr(self.v1, method)().to_dict()
+            with gzip.open(path, 'wt') as f:
+                json.dump(result, f, default=str, sort_keys=True, indent=2)
+        except Exception:
+            logger.exception(f"Unable to log {method}")
+
+    def _gather_pod_logs(self, pod, dest_dir, skip=frozenset()):
+        """
+        Stream the logs of each container of `pod` into a gzipped file
+
+        The logs of the previous instance of restarted containers are
+        included. At most GATHER_LOGS_BYTES_PER_POD bytes are written. The
+        containers named in `skip` are left out.
+        """
+        pod_name = pod.metadata.name
+        namespace = pod.metadata.namespace
+        statuses = [status for status in
+                    (pod.status.init_container_statuses or []) +
+                    (pod.status.container_statuses or [])
+                    if status.name not in skip]
+        if not statuses:
+            return
+        budget = GATHER_LOGS_BYTES_PER_POD
+        with gzip.open(os.path.join(dest_dir, f'{pod_name}.txt.gz'),
+                       'wb') as f:
+            for status in statuses:
+                runs = [True, False] if status.restart_count else [False]
+                for previous in runs:
+                    if budget <= 0:
+                        break
+                    f.write(f"*** {status.name}"
+                            f"{' (previous)' if previous else ''} ***\n"
+                            .encode())
+                    try:
+                        response = self.v1.read_namespaced_pod_log(
+                            pod_name, namespace, container=status.name,
+                            previous=previous, _preload_content=False)
+                        try:
+                            for chunk in response.stream(CHUNK_SIZE):
+                                f.write(chunk[:budget])
+                                budget -= len(chunk)
+                                if budget <= 0:
+                                    break
+                        finally:
+                            response.release_conn()
+                    except Exception:
+                        logger.warning(f"Unable to get logs for container "
+                                       f"{status.name} of pod {pod_name}")
+            if budget <= 0:
+                f.write(b"\n*** Log limit reached, truncated ***\n")
 
     def __enter__(self):
         return self
@@ -163,11 +255,52 @@ class KubernetesBase(ABC):
     def __exit__(self, type, value, traceback):
         if settings._GATHER_LOGS_DIR:
             self.gather_logs(settings._GATHER_LOGS_DIR)
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.informers is not None:
+            self.informers.stop()
         self.destroy(skip=not settings.as_bool('_TEAR_DOWN_CLUSTER'))
 
     def _configure_kubernetes_client(self):
-        kubernetes.config.load_kube_config(self.kubeconfig)
-        self.v1 = kubernetes.client.CoreV1Api()
+        # One client with a connection pool shared by all APIs, so requests
+        # reuse connections instead of setting up a new one each time
+        configuration = kubernetes.client.Configuration()
+        kubernetes.config.load_kube_config(
+            self.kubeconfig, client_configuration=configuration)
+        configuration.connection_pool_maxsize = API_CONNECTION_POOL_SIZE
+        self.api_client = kubernetes.client.ApiClient(configuration)
+        self.v1 = kubernetes.client.CoreV1Api(self.api_client)
+        self.custom_objects = kubernetes.client.CustomObjectsApi(
+            self.api_client)
+        self._manifest_applier = None
+        # Pods, services, nodes and PVCs are read from a watched local cache
+        if self.informers is not None:
+            self.informers.stop()
+        self.informers = InformerCache(self.v1)
+
+        # Record the logs and events of the whole run as it happens, rather
+        # than only what is left by the time gather_logs runs
+        if settings._GATHER_LOGS_DIR and self.recorder is None:
+            self.recorder = Recorder(self, os.path.join(
+                settings._GATHER_LOGS_DIR, 'kubernetes', 'recorded'))
+            self.recorder.start()
+
+    def _list_cached(self, kind: str, label_selector: Optional[str],
+                     field_selector: Optional[str],
+                     namespace: Optional[str]) -> Optional[List[Any]]:
+        """
+        List `kind` from the informer cache
+
+        Returns None if there is no cache or the selectors can't be evaluated
+        locally, in which case the API server should be asked instead.
+        """
+        if self.informers is None:
+            return None
+        try:
+            return self.informers.informer(kind).list(
+                namespace, label_selector, field_selector)
+        except ValueError:
+            return None
 
     def helm(self, command, check=True, log_stdout=True, log_stderr=True):
         """
@@ -184,18 +317,22 @@ class KubernetesBase(ABC):
             env={'HELM_EXPERIMENTAL_OCI': '1'},
         )
 
-    def kubectl(self, command, check=True, log_stdout=True, log_stderr=True):
+    def kubectl(self, command, check=True, log_stdout=True, log_stderr=True,
+                capture=True, tee=None):
         """
         Run a kubectl command
+
+        `tee` is an optional path the stdout is written to as it arrives.
         """
         return common.execute(
             f"{self.kubectl_exec} --kubeconfig {self.kubeconfig}"
             f" {command}",
             check=check,
-            capture=True,
+            capture=capture,
             log_stdout=log_stdout,
             log_stderr=log_stderr,
             logger_name=f"kubectl {command}",
+            tee=tee,
         )
 
     def kubectl_apply(self, yaml_file, log_stdout=True, log_stderr=True):
@@ -204,6 +341,23 @@ class KubernetesBase(ABC):
             log_stderr=log_stderr
         )
 
+    def apply_manifests(self, *paths: str,
+                        overlays: Iterable[manifests.Overlay] = ()
+                        ) -> List[manifests.ApplyResult]:
+        """
+        Apply all the manifests at `paths`, modified by `overlays`, with
+        server-side apply
+
+        Unlike calling `kubectl_apply` for each file, the objects are put in
+        dependency order across the files and applied concurrently where
+        possible. Returns what happened to each object.
+        """
+        if self._manifest_applier is None:
+            self._manifest_applier = manifests.ManifestApplier(
+                kubernetes.dynamic.DynamicClient(self.api_client))
+        return self._manifest_applier.apply(
+            manifests.load_documents(*paths, overlays=overlays))
+
     def untaint_master(self):
         # Untainting returns exit status 1 since not all nodes are tainted.
         self.kubectl(
@@ -222,27 +376,90 @@ class KubernetesBase(ABC):
             log_stderr=log_stderr
         )
 
+    def list_pods(self, label_selector: Optional[str] = None,
+                  field_selector: Optional[str] = None,
+                  namespace: Optional[str] = "rook-ceph") -> List[Any]:
+        """
+        List the pods (V1Pod) matching the selectors
+
+        A `namespace` of None lists the pods of all namespaces.
+        """
+        cached = self._list_cached(
+            'pods', label_selector, field_selector, namespace)
+        if cached is not None:
+            return cached
+        if namespace is None:
+            return self.v1.list_pod_for_all_namespaces(
+                label_selector=label_selector,
+                field_selector=field_selector).items
+        return self.v1.list_namespaced_pod(
+            namespace, label_selector=label_selector,
+            field_selector=field_selector).items
+
+    def list_services(self, label_selector: Optional[str] = None,
+                      field_selector: Optional[str] = None,
+                      namespace: Optional[str] = "rook-ceph") -> List[Any]:
+        """
+        List the services (V1Service) matching the selectors
+
+        A `namespace` of None lists the services of all namespaces.
+        """
+        cached = self._list_cached(
+            'services', label_selector, field_selector, namespace)
+        if cached is not None:
+            return cached
+        if namespace is None:
+            return self.v1.list_service_for_all_namespaces(
+                label_selector=label_selector,
+                field_selector=field_selector).items
+        return self.v1.list_namespaced_service(
+            namespace, label_selector=label_selector,
+            field_selector=field_selector).items
+
+    def list_pvcs(self, label_selector: Optional[str] = None,
+                  field_selector: Optional[str] = None,
+                  namespace: Optional[str] = "rook-ceph") -> List[Any]:
+        """
+        List the persistent volume claims (V1PersistentVolumeClaim) matching
+        the selectors
+
+        A `namespace` of None lists the claims of all namespaces.
+        """
+        cached = self._list_cached(
+            'pvcs', label_selector, field_selector, namespace)
+        if cached is not None:
+            return cached
+        if namespace is None:
+            return self.v1.list_persistent_volume_claim_for_all_namespaces(
+                label_selector=label_selector,
+                field_selector=field_selector).items
+        return self.v1.list_namespaced_persistent_volume_claim(
+            namespace, label_selector=label_selector,
+            field_selector=field_selector).items
+
+    def list_nodes(self, label_selector: Optional[str] = None,
+                   field_selector: Optional[str] = None) -> List[Any]:
+        """
+        List the nodes (V1Node) matching the selectors
+        """
+        cached = self._list_cached('nodes', label_selector, field_selector,
+                                   None)
+        if cached is not None:
+            return cached
+        return self.v1.list_node(
+            label_selector=label_selector,
+            field_selector=field_selector).items
+
     def get_pods_by_app_label(self, label, namespace="rook-ceph"):
-        pods_string = self.kubectl(
-            '-n %s get pod -l app="%s"'
-            ' --output custom-columns=name:metadata.name --no-headers'
-            % (namespace, label)
-        )[1].strip()
-        return pods_string.split('\n')
+        return [pod.metadata.name for pod in self.list_pods(
+            label_selector=f"app={label}", namespace=namespace)]
 
     def get_services_by_app_label(self, label, namespace="rook-ceph"):
-        services_string = self.kubectl(
-            '-n %s get svc -l app="%s"'
-            ' --output custom-columns=name:metadata.name --no-headers'
-            % (namespace, label)
-        )[1].strip()
-        return services_string.split('\n')
+        return [service.metadata.name for service in self.list_services(
+            label_selector=f"app={label}", namespace=namespace)]
 
     def execute_in_pod_by_label(self, command, label, namespace="rook-ceph",
                                 log_stdout=True, log_stderr=True):
-        # Note(jhesketh): The pod isn't cached, so if running multiple commands
-        #                 in the one pod consider calling the following
-        #                 manually
         pods = self.get_pods_by_app_label(label, namespace)
         return self.execute_in_pod(
             command, pods[0], namespace, log_stdout=log_stdout,
@@ -263,28 +480,94 @@ class KubernetesBase(ABC):
         pass
 
     def configure_kubernetes_client(self):
-        kubernetes.config.load_kube_config(self.kubeconfig)
-        self.v1 = kubernetes.client.CoreV1Api()
+        self._configure_kubernetes_client()
 
     def wait_for_service(self, service, sleep=10, iteration=60,
                          namespace="rook-ceph"):
-        found = False
-        for i in range(iteration):
-            output = self.kubectl(
-                            '-n ' + namespace + ' get service ' + service,
-                            check=False)
-            if output[0] == 0:
-                found = True
-                break
-            time.sleep(10)
-
-        return found
-
-    def wait_for_pods_by_app_label(self, label, count=1, sleep=5, attempts=120,
+        """
+        Wait up to `sleep` * `iteration` seconds for `service` to exist
+
+        Returns whether the service was found.
+        """
+        description = f"service {service} in {namespace}"
+        try:
+            if self.informers is not None:
+                self.informers.informer('services').wait_for(
+                    waiters.objects_exist_matcher(1), namespace,
+                    field_selector=f"metadata.name={service}",
+                    timeout=sleep * iteration, description=description)
+            else:
+                waiters.wait_for_objects(
+                    self.v1.list_namespaced_service,
+                    waiters.objects_exist_matcher(1), namespace,
+                    field_selector=f"metadata.name={service}",
+                    timeout=sleep * iteration, description=description)
+        except TimeoutError:
+            return False
+        return True
+
+    def wait_for_pods(self, matcher, label_selector=None, timeout=600,
+                      namespace="rook-ceph", fail_fast=True):
+        """
+        Wait until `matcher` holds for the pods matching `label_selector`
+
+        The pods are watched through the API so this returns as soon as a pod
+        change satisfies `matcher`.
+
+        With `fail_fast` a waiters.PodFailedError is raised as soon as one of
+        the pods is failed or stuck (eg. in ImagePullBackOff) instead of
+        waiting for the timeout.
+        """
+        description = f"pods {label_selector} in {namespace}"
+        abort = waiters.pods_failed_checker() if fail_fast else None
+        if self.informers is not None:
+            try:
+                return self.informers.informer('pods').wait_for(
+                    matcher, namespace, label_selector=label_selector,
+                    timeout=timeout, description=description, abort=abort)
+            except ValueError:
+                pass
+        return waiters.wait_for_objects(
+            self.v1.list_namespaced_pod, matcher, namespace,
+            timeout=timeout, description=description, abort=abort,
+            label_selector=label_selector)
+
+    def wait_for_custom_objects(self, group, version, plural, matcher,
+                                name=None, namespace="rook-ceph",
+                                timeout=600, description=None, abort=None):
+        """
+        Wait until `matcher` holds for the custom objects of `plural` (called
+        `name` if given) in `namespace`
+
+        The objects are plain dicts as returned by the CustomObjectsApi.
+        `abort` is as for waiters.wait_for_objects.
+        """
+        kwargs = {}
+        if name is not None:
+            kwargs['field_selector'] = f"metadata.name={name}"
+        return waiters.wait_for_objects(
+            self.custom_objects.list_namespaced_custom_object, matcher,
+            group, version, namespace, plural, timeout=timeout,
+            description=description or f"{plural} {name or ''} in "
+                                       f"{namespace}",
+            abort=abort, **kwargs)
+
+    def pods_failed_checker(self, namespace="rook-ceph", label_selector=None):
+        """
+        A function raising a waiters.PodFailedError if any pod matching
+        `label_selector` is failed or stuck, to pass as the `abort` of
+        common.wait_until
+        """
+        check = waiters.pods_failed_checker()
+
+        def abort():
+            check(self.list_pods(label_selector=label_selector,
+                                 namespace=namespace))
+        return abort
+
+    def wait_for_pods_by_app_label(self, label, count=1, timeout=600,
                                    namespace="rook-ceph"):
-        pattern = re.compile(r'.*Running')
-        common.wait_for_result(
-            self.kubectl,
-            f'-n {namespace} get pod -l app="{label}" --no-headers',
-            matcher=common.regex_count_matcher(pattern, count),
-            attempts=attempts, interval=sleep)
+        return self.wait_for_pods(
+            waiters.pods_running_matcher(count),
+            label_selector=f"app={label}", timeout=timeout,
+            namespace=namespace)
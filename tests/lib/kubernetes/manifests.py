@@ -0,0 +1,282 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Loads and applies manifests.
+#
+# Each file is parsed once (with libyaml when available) into an immutable
+# tree that is kept until the file changes. Modifications are expressed as
+# overlays (JSON merge patches) applied to a copy when the manifests are
+# rendered, rather than by rewriting the files.
+#
+# Manifests are applied through the API server instead of `kubectl apply`.
+# All documents of all files are put in dependency order (namespaces and CRDs
+# first, then the objects others refer to, then workloads and custom
+# resources) and applied with server-side apply through the dynamic client.
+# The objects of each stage are applied concurrently.
+
+import concurrent.futures
+import logging
+import os
+import threading
+import types
+from typing import (Any, Dict, Iterable, List, Mapping, NamedTuple, Optional,
+                    Tuple)
+
+import yaml
+from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
+
+from tests.lib import common
+
+
+logger = logging.getLogger(__name__)
+
+FIELD_MANAGER = "rookcheck"
+APPLY_WORKERS = 8
+# How long to wait for the API server to serve a newly created CRD
+CRD_TIMEOUT = 60
+
+# The kinds applied before everything else, in stages. Anything not listed
+# (workloads and custom resources) is applied in the last stage.
+STAGES = [
+    {'Namespace', 'CustomResourceDefinition'},
+    {'PodSecurityPolicy', 'ServiceAccount', 'Secret', 'ConfigMap',
+     'StorageClass', 'PersistentVolume', 'PersistentVolumeClaim',
+     'ClusterRole', 'ClusterRoleBinding', 'Role', 'RoleBinding', 'Service',
+     'PriorityClass', 'SecurityContextConstraints'},
+]
+
+
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class Overlay(NamedTuple):
+    """
+    A JSON merge patch (RFC 7386) for the documents of `kind` (called `name`)
+    """
+    kind: str
+    patch: Dict[str, Any]
+    name: Optional[str] = None
+
+    def matches(self, document: Mapping[str, Any]) -> bool:
+        if document.get('kind') != self.kind:
+            return False
+        return self.name is None or \
+            document.get('metadata', {}).get('name') == self.name
+
+
+def merge_patch(target: Any, patch: Any) -> Any:
+    """
+    `target` with the JSON merge patch `patch` applied
+
+    `target` is not modified. Keys set to None in `patch` are removed.
+    """
+    if not isinstance(patch, Mapping):
+        return thaw(patch)
+    result = thaw(target) if isinstance(target, Mapping) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def _apply_overlays(document: Dict[str, Any],
+                    overlays: List[Overlay]) -> Dict[str, Any]:
+    for overlay in overlays:
+        if overlay.matches(document):
+            document = merge_patch(document, overlay.patch)
+    return document
+
+
+def _freeze(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return types.MappingProxyType(
+            {key: _freeze(value) for key, value in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(value) for value in obj)
+    return obj
+
+
+def thaw(obj: Any) -> Any:
+    """
+    A mutable copy of a (frozen) document
+    """
+    if isinstance(obj, Mapping):
+        return {key: thaw(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [thaw(value) for value in obj]
+    return obj
+
+
+class ManifestStore():
+    """
+    Parses each manifest once and keeps the result while the file is
+    unchanged (by modification time and size)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Tuple[Tuple[int, int], Tuple[Any, ...]]] = {}
+
+    def load(self, path: str) -> Tuple[Any, ...]:
+        """
+        The documents in `path`, as read-only mappings and tuples
+        """
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with open(path) as f:
+            documents = tuple(_freeze(d) for d in yaml.load_all(f, Loader)
+                              if d)
+        with self._lock:
+            self._cache[path] = (version, documents)
+        return documents
+
+    def render(self, *paths: str,
+               overlays: Iterable[Overlay] = ()) -> List[Dict[str, Any]]:
+        """
+        Mutable copies of the documents in `paths` with `overlays` applied
+        """
+        overlays = list(overlays)
+        return [thaw(_apply_overlays(document, overlays))
+                for path in paths for document in self.load(path)]
+
+
+# The store shared by everything loading manifests
+store = ManifestStore()
+
+
+class ApplyResult(NamedTuple):
+    kind: str
+    namespace: str
+    name: str
+    # "created", "configured" or "unchanged" (as reported by kubectl)
+    action: str
+
+
+def load_documents(*paths: str, overlays: Iterable[Overlay] = ()
+                   ) -> List[Dict[str, Any]]:
+    """
+    All the objects in the manifests at `paths` with `overlays` applied
+    (Lists are expanded)
+    """
+    documents = []
+    for document in store.render(*paths):
+        if document.get('kind', '').endswith('List') and \
+                'items' in document:
+            documents.extend(document['items'])
+        else:
+            documents.append(document)
+    overlays = list(overlays)
+    return [_apply_overlays(d, overlays) for d in documents]
+
+
+def stage(document: Dict[str, Any]) -> int:
+    for i, kinds in enumerate(STAGES):
+        if document.get('kind') in kinds:
+            return i
+    return len(STAGES)
+
+
+class ManifestApplier():
+    """
+    Applies manifests with `dynamic_client` (a
+    kubernetes.dynamic.DynamicClient)
+    """
+    def __init__(self, dynamic_client):
+        self._client = dynamic_client
+        # Discovery is not thread safe, so resources are resolved by one
+        # caller at a time
+        self._discovery_lock = threading.Lock()
+
+    def _resource(self, document: Dict[str, Any]):
+        api_version, kind = document['apiVersion'], document['kind']
+        try:
+            return self._client.resources.get(api_version=api_version,
+                                              kind=kind)
+        except ResourceNotFoundError:
+            pass
+
+        # The kind may be of a CRD that was only just created
+        def lookup():
+            self._client.resources.invalidate_cache()
+            return self._client.resources.get(api_version=api_version,
+                                              kind=kind)
+        return common.wait_until(
+            lookup, matcher=lambda resource: True, decode=None,
+            timeout=CRD_TIMEOUT, backoff=common.Backoff(maximum=5),
+            description=f"API for {api_version} {kind}")
+
+    def _apply_one(self, resource, document: Dict[str, Any]) -> ApplyResult:
+        metadata = document['metadata']
+        name = metadata['name']
+        namespace = None
+        if resource.namespaced:
+            namespace = metadata.get('namespace', 'default')
+
+        try:
+            before = self._client.get(resource, name=name,
+                                      namespace=namespace)
+            version = before.metadata.resourceVersion
+        except NotFoundError:
+            version = None
+
+        after = self._client.server_side_apply(
+            resource, body=document, name=name, namespace=namespace,
+            field_manager=FIELD_MANAGER, force_conflicts=True)
+        if version is None:
+            action = "created"
+        elif after.metadata.resourceVersion != version:
+            action = "configured"
+        else:
+            action = "unchanged"
+        logger.info(f"{document['kind']}/{name} {action}")
+        return ApplyResult(document['kind'], namespace or '', name, action)
+
+    def apply(self, documents: List[Dict[str, Any]]) -> List[ApplyResult]:
+        """
+        Apply `documents` in dependency order and return what happened to
+        each object
+
+        If an object fails to apply, the rest of its stage is still applied
+        but the later stages are not, and the first error is raised.
+        """
+        stages: Dict[int, List[Dict[str, Any]]] = {}
+        for document in documents:
+            stages.setdefault(stage(document), []).append(document)
+
+        results: List[ApplyResult] = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=APPLY_WORKERS) as executor:
+            for i in sorted(stages):
+                # Resolve the resources up front as discovery is not thread
+                # safe
+                with self._discovery_lock:
+                    work: List[Tuple[Any, Dict[str, Any]]] = [
+                        (self._resource(d), d) for d in stages[i]]
+                futures = [executor.submit(self._apply_one, resource, d)
+                           for resource, d in work]
+                concurrent.futures.wait(futures)
+                for future in futures:
+                    results.append(future.result())
+
+        changed = [r for r in results if r.action != "unchanged"]
+        logger.info(f"Applied {len(results)} objects, {len(changed)} "
+                    f"changed")
+        return results
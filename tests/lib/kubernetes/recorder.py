@@ -0,0 +1,344 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Records diagnostics while the tests run rather than after the fact. The logs
+# of the interesting Rook pods are followed from the moment each container
+# starts (so the output of crashed and restarted containers is kept), and the
+# kubernetes event stream is written as JSON lines.
+#
+# All output goes through one writer thread with a bounded queue into gzipped
+# files. When the disk can't keep up, the followers block, which in turn stops
+# them reading from the API server.
+#
+# Every follower holds a connection for as long as its container runs, so the
+# recorder talks to the API server through a client (and connection pool) of
+# its own, and at most MAX_FOLLOWERS containers are followed at a time.
+
+import collections
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import kubernetes
+
+
+logger = logging.getLogger(__name__)
+
+# The pods whose logs are followed, by namespace and label selector
+RECORDED_PODS = [
+    ("rook-ceph", "app=rook-ceph-operator"),
+    ("rook-ceph", "app=rook-ceph-osd-prepare"),
+    ("rook-ceph", "app=rook-ceph-mon"),
+]
+# How often (in seconds) to look for new containers to follow
+DISCOVERY_INTERVAL = 2
+# The most chunks waiting to be written
+QUEUE_SIZE = 256
+CHUNK_SIZE = 64 * 1024
+# How often (in seconds) the files are flushed to disk
+FLUSH_INTERVAL = 5
+# How many event versions are remembered to skip duplicates after a relist
+SEEN_EVENTS = 10000
+HTTP_STATUS_GONE = 410
+# The most container logs followed at the same time. More containers are
+# picked up as earlier ones finish.
+MAX_FOLLOWERS = 32
+
+
+class _Writer():
+    """
+    Appends chunks to gzipped files from a single thread
+
+    `write` blocks while `max_queued` chunks are waiting. A file that can't
+    be written is given up on, while the other files keep being written.
+    """
+    def __init__(self, max_queued: int = QUEUE_SIZE):
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._files: Dict[str, Any] = {}
+        self._failed: Set[str] = set()
+        self._thread = threading.Thread(
+            target=self._run, name="recorder writer", daemon=True)
+        self._thread.start()
+
+    def write(self, path: str, data: bytes):
+        self._queue.put((path, data))
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item and item[0] not in self._failed:
+                self._write(*item)
+            if time.monotonic() - last_flush > FLUSH_INTERVAL:
+                for path in list(self._files):
+                    self._close(path, flush_only=True)
+                last_flush = time.monotonic()
+        for path in list(self._files):
+            self._close(path)
+
+    def _write(self, path: str, data: bytes):
+        try:
+            f = self._files.get(path)
+            if f is None:
+                f = self._files[path] = gzip.open(path, 'ab')
+            f.write(data)
+        except Exception:
+            logger.exception(f"Unable to write to {path}, giving up on it")
+            self._failed.add(path)
+            f = self._files.pop(path, None)
+            if f is not None:
+                try:
+                    f.close()
+                except Exception:
+                    pass
+
+    def _close(self, path: str, flush_only: bool = False):
+        f = self._files.get(path)
+        if f is None:
+            return
+        try:
+            if flush_only:
+                f.flush()
+                return
+            f.close()
+        except Exception:
+            logger.exception(f"Unable to write to {path}, giving up on it")
+            self._failed.add(path)
+        del self._files[path]
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class Recorder():
+    """
+    Follows the logs of RECORDED_PODS and the events of `kubernetes` (a
+    KubernetesBase) into `dest_dir` until stopped
+
+    `v1` is the CoreV1Api the logs and events are read with, by default one
+    on a client of its own.
+    """
+    def __init__(self, kubernetes, dest_dir: str,
+                 watch_factory: Callable = kubernetes.watch.Watch,
+                 v1: Any = None):
+        self._kubernetes = kubernetes
+        self._dest_dir = dest_dir
+        self._watch_factory = watch_factory
+        self._v1 = v1
+        self._api_client: Any = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._followed: Dict[Tuple[str, str, str, int], Any] = {}
+        self._recorded: Set[Tuple[str, str, str]] = set()
+        self._following = 0
+        self._threads: List[threading.Thread] = []
+        self._writer: Optional[_Writer] = None
+        self._event_watch: Any = None
+
+    @property
+    def recorded_containers(self) -> List[Tuple[str, str, str]]:
+        """
+        The (namespace, pod, container) of every container whose log stream
+        was opened, and so recorded
+        """
+        with self._lock:
+            return sorted(self._recorded)
+
+    def start(self):
+        os.makedirs(os.path.join(self._dest_dir, 'pod_logs'), exist_ok=True)
+        logger.info(f"Recording kubernetes logs and events to "
+                    f"{self._dest_dir}")
+        self._writer = _Writer()
+        if self._v1 is None:
+            configuration = copy.deepcopy(
+                self._kubernetes.api_client.configuration)
+            # One connection per follower and one for the events
+            configuration.connection_pool_maxsize = MAX_FOLLOWERS + 1
+            self._api_client = kubernetes.client.ApiClient(configuration)
+            self._v1 = kubernetes.client.CoreV1Api(self._api_client)
+        for target in (self._discover, self._record_events):
+            self._start_thread(target, f"recorder {target.__name__}")
+
+    def _start_thread(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name,
+                                  daemon=True)
+        thread.start()
+        with self._lock:
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop recording and flush everything recorded so far to disk
+        """
+        if self._writer is None:
+            return
+        self._stopped.set()
+        if self._event_watch is not None:
+            self._event_watch.stop()
+        with self._lock:
+            responses = list(self._followed.values())
+            threads = list(self._threads)
+        for response in responses:
+            if response is not None:
+                try:
+                    # Unblocks the follower waiting for more output
+                    response.close()
+                except Exception:
+                    pass
+        for thread in threads:
+            thread.join(timeout=10)
+        self._writer.close()
+        self._writer = None
+        if self._api_client is not None:
+            self._api_client.close()
+            self._api_client = None
+            self._v1 = None
+
+    def _discover(self):
+        while not self._stopped.is_set():
+            for namespace, label_selector in RECORDED_PODS:
+                try:
+                    pods = self._kubernetes.list_pods(
+                        label_selector=label_selector, namespace=namespace)
+                except Exception:
+                    logger.debug("Unable to list pods to record",
+                                 exc_info=True)
+                    continue
+                for pod in pods:
+                    self._follow_pod(pod)
+            self._stopped.wait(DISCOVERY_INTERVAL)
+
+    def _follow_pod(self, pod):
+        if pod.status is None:
+            return
+        statuses = (pod.status.init_container_statuses or []) + \
+            (pod.status.container_statuses or [])
+        for status in statuses:
+            if status.state is None or (status.state.running is None and
+                                        status.state.terminated is None):
+                # There is no log (yet)
+                continue
+            key = (pod.metadata.namespace, pod.metadata.name, status.name,
+                   status.restart_count)
+            with self._lock:
+                if key in self._followed or self._stopped.is_set():
+                    continue
+                if self._following >= MAX_FOLLOWERS:
+                    # Picked up by a later discovery
+                    logger.debug(f"Not following {key} yet, already "
+                                 f"following {self._following} containers")
+                    return
+                self._followed[key] = None
+                self._following += 1
+            self._start_thread(self._follow, f"recorder {key}", key)
+
+    def _follow(self, key: Tuple[str, str, str, int]):
+        try:
+            self._follow_logs(key)
+        finally:
+            with self._lock:
+                self._following -= 1
+
+    def _follow_logs(self, key: Tuple[str, str, str, int]):
+        writer = self._writer
+        if writer is None:
+            return
+        namespace, pod, container, restart = key
+        path = os.path.join(self._dest_dir, 'pod_logs',
+                            f"{namespace}_{pod}_{container}_{restart}.log.gz")
+        try:
+            try:
+                response = self._v1.read_namespaced_pod_log(
+                    pod, namespace, container=container, follow=True,
+                    _preload_content=False)
+            except Exception:
+                # Tried again by the next discovery
+                with self._lock:
+                    del self._followed[key]
+                raise
+            with self._lock:
+                self._followed[key] = response
+                self._recorded.add(key[:3])
+            if self._stopped.is_set():
+                return
+            try:
+                for chunk in response.stream(CHUNK_SIZE):
+                    writer.write(path, chunk)
+            finally:
+                response.release_conn()
+        except Exception:
+            if not self._stopped.is_set():
+                logger.warning(f"Stopped following the logs of {container} "
+                               f"in {namespace}/{pod}", exc_info=True)
+
+    def _record_events(self):
+        writer = self._writer
+        if writer is None:
+            return
+        path = os.path.join(self._dest_dir, 'events.jsonl.gz')
+        list_func = self._v1.list_event_for_all_namespaces
+        seen: collections.OrderedDict = collections.OrderedDict()
+
+        def record(event):
+            version = (event.metadata.uid, event.metadata.resource_version)
+            if version in seen:
+                return
+            seen[version] = True
+            if len(seen) > SEEN_EVENTS:
+                seen.popitem(last=False)
+            line = json.dumps(event.to_dict(), default=str, sort_keys=True)
+            writer.write(path, f"{line}\n".encode())
+
+        resource_version = None
+        while not self._stopped.is_set():
+            try:
+                if resource_version is None:
+                    result = list_func()
+                    for event in result.items:
+                        record(event)
+                    resource_version = result.metadata.resource_version
+                self._event_watch = self._watch_factory()
+                for event in self._event_watch.stream(
+                        list_func, resource_version=resource_version,
+                        timeout_seconds=300):
+                    if event['type'] == 'ERROR':
+                        resource_version = None
+                        break
+                    obj = event['object']
+                    resource_version = obj.metadata.resource_version
+                    if event['type'] in ('ADDED', 'MODIFIED'):
+                        record(obj)
+            except kubernetes.client.rest.ApiException as e:
+                if e.status != HTTP_STATUS_GONE:
+                    logger.warning(f"Unable to watch events: {e}")
+                    self._stopped.wait(DISCOVERY_INTERVAL)
+                resource_version = None
+            except Exception:
+                if self._stopped.is_set():
+                    break
+                logger.warning("Unable to watch events", exc_info=True)
+                self._stopped.wait(DISCOVERY_INTERVAL)
+                resource_version = None
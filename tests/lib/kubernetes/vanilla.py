@@ -22,7 +22,6 @@
 import logging
 import os
 import stat
-import wget
 
 from tests.lib.kubernetes.kubernetes_base import KubernetesBase
 from tests.lib.hardware.hardware_base import HardwareBase
@@ -47,10 +46,13 @@ class Vanilla(KubernetesBase):
 
     def install_kubernetes(self):
         super().install_kubernetes()
-        self._download_kubectl()
+        self.fetch()
         self.untaint_master()
         self._setup_flannel()
 
+    def _fetch(self):
+        self._download_kubectl()
+
     def _setup_flannel(self):
         for node in self.hardware.nodes.values():
             self.kubectl(
@@ -68,11 +70,10 @@ class Vanilla(KubernetesBase):
         # Download specific kubectl version
         # TODO(jhesketh): Allow setting version
         logger.info("Downloading kubectl binary")
-        wget.download(
+        self.workspace.download(
             "https://storage.googleapis.com/kubernetes-release/release/v1.17.3"
             "/bin/linux/amd64/kubectl",
-            self.kubectl_exec,
-            bar=None
+            self.kubectl_exec
         )
         st = os.stat(self.kubectl_exec)
         os.chmod(self.kubectl_exec, st.st_mode | stat.S_IEXEC)
@@ -0,0 +1,363 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Waiters built on top of the kubernetes watch API. Instead of polling
+# `kubectl get ...` on an interval, the current state is listed once and then
+# kept up to date from the watch stream. The condition is re-evaluated on
+# every event so a wait returns as soon as the condition holds.
+
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import kubernetes
+
+from tests.lib import common
+from tests.lib import scheduler
+
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATUS_GONE = 410
+
+# Container states a pod does not get out of without intervention. They are
+# only treated as failures once they lasted FAIL_FAST_GRACE seconds, as some
+# (eg. a slow image pull backing off) can resolve themselves.
+STUCK_CONTAINER_REASONS = {
+    'ImagePullBackOff', 'ErrImagePull', 'InvalidImageName',
+    'CreateContainerConfigError', 'CreateContainerError',
+}
+FAIL_FAST_GRACE = 120
+# How often a container has to have crashed before CrashLoopBackOff counts
+CRASH_LOOP_RESTARTS = 3
+# How often (in seconds) a wait with an abort check re-evaluates it even when
+# nothing changed
+ABORT_CHECK_INTERVAL = 30
+# The `.status.phase` of Rook's custom resources (CephCluster, CephFilesystem,
+# CephObjectStore, ...) once the operator reconciled them, and when it failed
+# to. Object stores report Connected rather than Ready on some versions.
+CEPH_RESOURCE_READY_PHASES = {'Ready', 'Connected'}
+CEPH_RESOURCE_FAILED_PHASES = {'Failure'}
+
+
+class PodFailedError(Exception):
+    """
+    A pod that a wait depends on is in a state it won't recover from
+    """
+    def __init__(self, pod, reason: str):
+        self.pod = pod
+        self.reason = reason
+        super().__init__(f"Pod {pod.metadata.namespace}/{pod.metadata.name} "
+                         f"failed: {reason}")
+
+
+class CephResourceFailedError(Exception):
+    """
+    The Rook operator reports that it failed to reconcile a custom resource
+    """
+    def __init__(self, resource: Dict[str, Any], reason: str):
+        self.resource = resource
+        self.reason = reason
+        super().__init__(f"{resource.get('kind')} {_object_key(resource)} "
+                         f"failed: {reason}")
+
+
+def _metadata(obj) -> Dict[str, Any]:
+    # Typed APIs (eg. CoreV1Api) return models while CustomObjectsApi returns
+    # plain dicts.
+    if isinstance(obj, dict):
+        return obj.get('metadata', {})
+    return {
+        'namespace': obj.metadata.namespace,
+        'name': obj.metadata.name,
+        'resourceVersion': obj.metadata.resource_version,
+    }
+
+
+def _object_key(obj) -> str:
+    metadata = _metadata(obj)
+    return f"{metadata.get('namespace')}/{metadata.get('name')}"
+
+
+def _list_items(result) -> List[Any]:
+    if isinstance(result, dict):
+        return result.get('items', [])
+    return result.items
+
+
+def _list_resource_version(result) -> Optional[str]:
+    if isinstance(result, dict):
+        return result.get('metadata', {}).get('resourceVersion')
+    return result.metadata.resource_version
+
+
+def wait_for_objects(list_func: Callable, matcher: Callable[[List[Any]], bool],
+                     *args, timeout: int = 600,
+                     description: Optional[str] = None,
+                     abort: Optional[Callable[[List[Any]], None]] = None,
+                     **kwargs) -> List[Any]:
+    """Watch the objects returned by `list_func` until `matcher` holds
+
+    `list_func` is a kubernetes client list method (eg.
+    `CoreV1Api.list_namespaced_pod`) that is called with `args` and `kwargs`.
+    `matcher` receives the list of currently known objects and returns True
+    once the wait is over.
+
+    `abort` (eg. `pods_failed_checker()`) also receives the objects, before
+    `matcher`, and raises to end the wait early. It is called at least every
+    ABORT_CHECK_INTERVAL seconds. Waits in a step of a `scheduler.Scheduler`
+    also end once the step is cancelled.
+
+    The duration and the number of watch events processed are recorded in
+    `common.wait_stats`.
+
+    Returns the objects that satisfied `matcher`, or raises a TimeoutError
+    after `timeout` seconds.
+    """
+    description = description or f"{list_func.__name__}{args}{kwargs}"
+    abort = scheduler.cancellable(abort)
+    start = time.monotonic()
+    deadline = start + timeout
+    objects: Dict[str, Any] = {}
+    resource_version = None
+    events = 0
+    logger.info(f"Watching {description} (timeout {timeout}s)")
+
+    while True:
+        if resource_version is None:
+            # (Re)list to get a consistent starting point for the watch
+            result = list_func(*args, **kwargs)
+            objects = {_object_key(o): o for o in _list_items(result)}
+            resource_version = _list_resource_version(result)
+            if _matches(matcher, abort, objects, description, start,
+                        events):
+                common.wait_stats.record(
+                    description, time.monotonic() - start, events, True)
+                return list(objects.values())
+        elif abort is not None:
+            _check(abort, objects, description, start, events)
+
+        remaining = int(deadline - time.monotonic())
+        if remaining <= 0:
+            break
+        if abort is not None:
+            remaining = min(remaining, ABORT_CHECK_INTERVAL)
+
+        watch = kubernetes.watch.Watch()
+        try:
+            for event in watch.stream(list_func, *args,
+                                      resource_version=resource_version,
+                                      timeout_seconds=remaining, **kwargs):
+                events += 1
+                obj = event['object']
+                resource_version = _metadata(obj).get('resourceVersion')
+                if event['type'] == 'DELETED':
+                    objects.pop(_object_key(obj), None)
+                elif event['type'] in ('ADDED', 'MODIFIED'):
+                    objects[_object_key(obj)] = obj
+                else:
+                    continue
+                if _matches(matcher, abort, objects, description, start,
+                            events):
+                    watch.stop()
+                    common.wait_stats.record(
+                        description, time.monotonic() - start, events, True)
+                    return list(objects.values())
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != HTTP_STATUS_GONE:
+                raise
+            logger.debug(f"Watch on {description} expired, relisting")
+            resource_version = None
+        finally:
+            watch.stop()
+
+    common.wait_stats.record(
+        description, time.monotonic() - start, events, False)
+    logger.error(f"Timed out watching {description}")
+    logger.error("The last known objects:")
+    for key in sorted(objects):
+        logger.error(key)
+    raise TimeoutError(f"Timed out waiting for {description}")
+
+
+def _check(abort: Callable[[List[Any]], None], objects: Dict[str, Any],
+           description: str, start: float, events: int):
+    try:
+        abort(list(objects.values()))
+    except Exception:
+        common.wait_stats.record(
+            description, time.monotonic() - start, events, False)
+        raise
+
+
+def _matches(matcher: Callable[[List[Any]], bool],
+             abort: Optional[Callable[[List[Any]], None]],
+             objects: Dict[str, Any], description: str, start: float,
+             events: int) -> bool:
+    if abort is not None:
+        _check(abort, objects, description, start, events)
+    return matcher(list(objects.values()))
+
+
+def _pod_failure(pod) -> Optional[Tuple[str, str]]:
+    status = pod.status
+    if status is None:
+        return None
+    owners = pod.metadata.owner_references or []
+    if status.phase == 'Failed' and \
+            not any(o.kind == 'Job' for o in owners):
+        return 'Failed', status.reason or status.message or ''
+    for condition in status.conditions or []:
+        if condition.type == 'PodScheduled' and \
+                condition.status == 'False' and \
+                condition.reason == 'Unschedulable':
+            return 'Unschedulable', condition.message or ''
+    for container in (status.init_container_statuses or []) + \
+            (status.container_statuses or []):
+        waiting = container.state.waiting if container.state else None
+        if waiting is None:
+            continue
+        if waiting.reason in STUCK_CONTAINER_REASONS or (
+                waiting.reason == 'CrashLoopBackOff' and
+                container.restart_count >= CRASH_LOOP_RESTARTS):
+            return waiting.reason, \
+                f"container {container.name}: {waiting.message or ''}"
+    return None
+
+
+def pod_failure_reason(pod) -> Optional[str]:
+    """
+    Why `pod` is stuck or failed, or None if it isn't (or not yet)
+
+    Failed pods of a Job are not reported since the Job retries them.
+    """
+    failure = _pod_failure(pod)
+    if failure is None:
+        return None
+    return f"{failure[0]} ({failure[1]})"
+
+
+def pods_failed_checker(grace: float = FAIL_FAST_GRACE):
+    """
+    An `abort` check for waits on pods raising a PodFailedError once a pod
+    has been failed or stuck (see `pod_failure_reason`) for `grace` seconds
+
+    Failed pods and crash loops are reported straight away.
+    """
+    first_seen: Dict[Tuple[str, str], float] = {}
+
+    def check(pods):
+        now = time.monotonic()
+        failing = {}
+        for pod in pods:
+            failure = _pod_failure(pod)
+            if failure is None:
+                continue
+            key = (_object_key(pod), failure[0])
+            failing[key] = first_seen.get(key, now)
+            if failure[0] in ('Failed', 'CrashLoopBackOff') or \
+                    now - failing[key] >= grace:
+                raise PodFailedError(pod, f"{failure[0]} ({failure[1]})")
+        first_seen.clear()
+        first_seen.update(failing)
+    return check
+
+
+def _ceph_resource_status(resource: Dict[str, Any]) -> Tuple[str, str]:
+    status = resource.get('status') or {}
+    return status.get('phase', ''), \
+        (status.get('ceph') or {}).get('health', '')
+
+
+def ceph_resources_ready_matcher(min_matches: int = 1,
+                                 health: Optional[str] = None):
+    """
+    A matcher for Rook custom resources whose phase is ready and, if
+    `health` is given, whose reported Ceph health (eg. HEALTH_OK) is `health`
+    """
+    def compare(resources):
+        ready = 0
+        for resource in resources:
+            phase, ceph_health = _ceph_resource_status(resource)
+            if phase in CEPH_RESOURCE_READY_PHASES and \
+                    (health is None or ceph_health == health):
+                ready += 1
+        return ready >= min_matches
+    return compare
+
+
+def ceph_resources_failed_checker(grace: float = FAIL_FAST_GRACE):
+    """
+    An `abort` check for waits on Rook custom resources raising a
+    CephResourceFailedError once the operator reported one as failed for
+    `grace` seconds (it keeps retrying, so a failure can be temporary)
+    """
+    first_seen: Dict[str, float] = {}
+
+    def check(resources):
+        now = time.monotonic()
+        failing = {}
+        for resource in resources:
+            phase, _ = _ceph_resource_status(resource)
+            if phase not in CEPH_RESOURCE_FAILED_PHASES:
+                continue
+            key = _object_key(resource)
+            failing[key] = first_seen.get(key, now)
+            if now - failing[key] >= grace:
+                raise CephResourceFailedError(
+                    resource, resource['status'].get('message') or phase)
+        first_seen.clear()
+        first_seen.update(failing)
+    return check
+
+
+def _pod_is_running(pod) -> bool:
+    # Mirror what `kubectl get pods` reports as "Running": the pod is running
+    # and none of its containers is waiting or terminated.
+    if pod.status.phase != 'Running':
+        return False
+    for container in pod.status.container_statuses or []:
+        if container.state.running is None:
+            return False
+    return True
+
+
+def pods_running_matcher(min_matches: int = 1):
+    def compare(pods):
+        return len([p for p in pods if _pod_is_running(p)]) >= min_matches
+    return compare
+
+
+def pods_succeeded_matcher(min_matches: int = 1):
+    def compare(pods):
+        return len([p for p in pods
+                    if p.status.phase == 'Succeeded']) >= min_matches
+    return compare
+
+
+def nodes_ready_matcher(min_matches: int = 1):
+    def compare(nodes):
+        ready = 0
+        for node in nodes:
+            for condition in node.status.conditions or []:
+                if condition.type == 'Ready' and condition.status == 'True':
+                    ready += 1
+        return ready >= min_matches
+    return compare
+
+
+def objects_exist_matcher(min_matches: int = 1):
+    def compare(objects):
+        return len(objects) >= min_matches
+    return compare
@@ -12,15 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import logging
 import os
-import re
 import requests
-import yaml
+import threading
 
 from tests.config import settings
 from tests.lib import common
+from tests.lib.kubernetes import manifests, waiters
+from tests.lib.kubernetes.exec_session import ExecSession
+from tests.lib.rook.ceph import CephClient
+from tests.lib.scheduler import Scheduler
 from abc import ABC, abstractmethod
 
 logger = logging.getLogger(__name__)
@@ -30,14 +32,47 @@ class RookBase(ABC):
     def __init__(self, workspace, kubernetes):
         self._workspace = workspace
         self.kubernetes = kubernetes
-        self.toolbox_pod = None
+        self.toolbox = None
+        self.ceph = CephClient(self.execute_in_ceph_toolbox)
         self.ceph_dir = None
+        # In our CI environment the liveness tests are failing due to taking
+        # too long, so they are disabled whenever cluster.yaml is applied.
+        # See https://github.com/rook/rook/issues/3370 and
+        # https://github.com/rook/rook/blob/master/Documentation/
+        # ceph-cluster-crd.md#health-settings
+        #
+        # The operator reports the Ceph health in the CephCluster status,
+        # which the install waits on, so have it refresh that more often.
+        self.cluster_overlays = [manifests.Overlay('CephCluster', {
+            'spec': {'healthCheck': {
+                'livenessProbe': {
+                    mod: {'disabled': True} for mod in ['mon', 'mgr', 'osd']},
+                'daemonHealth': {'status': {'interval': '10s'}}}}})]
+        self._fetch_lock = threading.Lock()
+        self._fetched = False
         logger.info(f"rook init on {self.kubernetes.hardware}")
 
     @property
     def workspace(self):
         return self._workspace
 
+    def fetch(self):
+        """
+        Download what the build and the install need that doesn't depend on
+        the nodes or kubernetes, so it can happen while they come up
+
+        Only the first call downloads anything.
+        """
+        with self._fetch_lock:
+            if not self._fetched:
+                self._fetch()
+                self._fetched = True
+
+    def _fetch(self):
+        if settings.OPERATOR_INSTALLER == "helm":
+            self._get_helm()
+            self._get_charts()
+
     @abstractmethod
     def build(self):
         # Having the method in child classes allows easier test writing
@@ -46,9 +81,7 @@ class RookBase(ABC):
 
     @abstractmethod
     def preinstall(self):
-        if settings.OPERATOR_INSTALLER == "helm":
-            self._get_helm()
-            self._get_charts()
+        self.fetch()
 
     def destroy(self, skip=True):
         if skip:
@@ -63,17 +96,14 @@ class RookBase(ABC):
         logger.info(f"rook destroy on {self.kubernetes.hardware}")
         pass
 
-    def execute_in_ceph_toolbox(self, command, log_stdout=False):
-        # if not self.toolbox_pod:
-        if True:
-            # NOTE(jhesketh): Do no cache the toolbox pod in case it gets
-            #                 rescheduled.
-            toolbox_pods = self.kubernetes.get_pods_by_app_label(
-                "rook-ceph-tools")
-            self.toolbox_pod = toolbox_pods[0]
-
-        return self.kubernetes.execute_in_pod(
-            command, self.toolbox_pod, log_stdout=False)
+    def execute_in_ceph_toolbox(self, command, log_stdout=False, check=True):
+        # One shell is kept open in the toolbox. The session follows the
+        # toolbox pod if it gets rescheduled.
+        if self.toolbox is None:
+            self.toolbox = ExecSession(
+                self.kubernetes, "app=rook-ceph-tools", "rook-ceph")
+        return self.toolbox.execute(command, check=check,
+                                    log_stdout=log_stdout)
 
     @abstractmethod
     def _get_charts(self):
@@ -92,34 +122,10 @@ class RookBase(ABC):
     def _install_operator_helm(self):
         pass
 
-    def _modify_liveness(self, input_cluster):
-        # input_cluster: The example file to load
-        # Returns: A path to a fixed cluster.yaml
-
-        # In our CI environment the liveness tests are failing due to taking
-        # too long. We should increase them.
-        # See https://github.com/rook/rook/issues/3370 and
-        # https://github.com/rook/rook/blob/master/Documentation/
-        # ceph-cluster-crd.md#health-settings
-
-        with open(input_cluster) as f:
-            cluster = yaml.safe_load(f)
-
-        for mod in ['mon', 'mgr', 'osd']:
-            cluster['spec']['healthCheck']['livenessProbe'][mod][
-                'disabled'] = True
-
-        newfile = os.path.join(self.ceph_dir, 'rookcheck_cluster.yaml')
-        with open(newfile, 'w') as f:
-            yaml.dump(cluster, f, default_flow_style=False)
-
-        return newfile
-
-    def disable_bluefs_buffered_io(self):
+    def _write_config_override(self):
         # Disable bluefs_buffered_io to work around discovery bug
         # https://github.com/rook/rook/issues/8023
-
-        logger.info("Disabling bluefs buffered io")
+        # Returns: A path to the rook-config-override ConfigMap
 
         self.config_yaml = os.path.join(self.ceph_dir, '_cluster_config.yaml')
         with open(self.config_yaml, 'w') as f:
@@ -134,47 +140,64 @@ data:
     [global]
     bluefs_buffered_io = false
             """)
-        self.kubernetes.kubectl_apply(self.config_yaml)
+        return self.config_yaml
 
-    def install(self):
-        self.kubernetes.kubectl("create namespace rook-ceph")
-        self._install_operator()
+    def disable_bluefs_buffered_io(self):
+        logger.info("Disabling bluefs buffered io")
+        self.kubernetes.kubectl_apply(self._write_config_override())
 
+    def install(self):
+        # The install as a graph of steps, each with its own readiness
+        # condition, so the toolbox and the RBD pool don't wait for the OSDs
+        # to be prepared. The timing of each step is logged at the end.
+        install = Scheduler("install")
+        install.add("namespace", lambda: self.kubernetes.kubectl(
+            "create namespace rook-ceph"))
+        install.add("operator", self._install_operator,
+                    requires=["namespace"])
         # reduce wait time to discover devices
-        self.kubernetes.kubectl(
+        install.add("operator_env", lambda: self.kubernetes.kubectl(
             "-n rook-ceph set env "
-            "deployment/rook-ceph-operator ROOK_DISCOVER_DEVICES_INTERVAL=2m")
+            "deployment/rook-ceph-operator ROOK_DISCOVER_DEVICES_INTERVAL=2m"),
+            requires=["operator"])
+        # The config override (disabling bluefs buffered io) is applied before
+        # the cluster
+        install.add("config_override", lambda: self.kubernetes.apply_manifests(
+            self._write_config_override()), requires=["namespace"])
+        install.add("cluster", self._install_cluster,
+                    requires=["operator_env", "config_override"])
+        install.add("rbd", self.deploy_rbd, requires=["operator"])
+        install.add("mons", self._wait_for_mons, requires=["cluster"])
+        install.add("toolbox", self._install_toolbox, requires=["mons"])
+        install.add("cluster_ready", self._wait_for_cluster,
+                    requires=["cluster"])
+        install.add("health", self._wait_for_health,
+                    requires=["cluster_ready", "toolbox", "rbd"])
+        install.run()
 
-        # Load cluster.yaml as object
-        # Modify livenessProbe
-        # Save yaml somewhere
-        # apply new yaml
-
-        self.disable_bluefs_buffered_io()
+        logger.info("Rook successfully installed and ready!")
 
+    def _install_cluster(self):
         logger.info("Installing cluster.yaml...")
-        self.kubernetes.kubectl_apply(
-            self._modify_liveness(os.path.join(self.ceph_dir, 'cluster.yaml'))
-        )
+        self.kubernetes.apply_manifests(
+            os.path.join(self.ceph_dir, 'cluster.yaml'),
+            overlays=self.cluster_overlays)
+
+    def _wait_for_mons(self):
+        # The toolbox needs the mon secret and endpoints, which exist once
+        # the first mon is up
+        logger.info("Wait for the first mon running")
+        self.kubernetes.wait_for_pods_by_app_label("rook-ceph-mon",
+                                                   timeout=600)
+
+    def _install_toolbox(self):
         logger.info("Installing toolbox.yaml...")
-        self.kubernetes.kubectl_apply(
+        self.kubernetes.apply_manifests(
             os.path.join(self.ceph_dir, 'toolbox.yaml'))
 
-        logger.info("Wait for OSD prepare to complete "
-                    "(this may take a while...)")
-        pattern = re.compile(r'.*rook-ceph-osd-prepare.*Completed')
-        common.wait_for_result(
-            self.kubernetes.kubectl, "-n rook-ceph get pods"
-            " -l app=rook-ceph-osd-prepare",
-            matcher=common.regex_count_matcher(pattern, 3),
-            attempts=120, interval=15)
-
         logger.info("Wait for rook-ceph-tools running")
-        pattern = re.compile(r'.*rook-ceph-tools.*Running')
-        common.wait_for_result(
-            self.kubernetes.kubectl, "-n rook-ceph get pods",
-            matcher=common.regex_count_matcher(pattern, 1),
-            attempts=30, interval=10)
+        self.kubernetes.wait_for_pods_by_app_label(
+            "rook-ceph-tools", timeout=300)
 
         # As of Nautilus v14.2.20 and Octopus v15.2.11, clusters intentionally
         # come up in HEALTH_WARN (AUTH_INSECURE_GLOBAL_ID_RECLAIM) and to
@@ -184,14 +207,15 @@ data:
             " || true"
         )
 
-        logger.info("Wait for Ceph HEALTH_OK")
-        pattern = re.compile(r'.*HEALTH_OK')
-        common.wait_for_result(
-            self.execute_in_ceph_toolbox, "ceph status",
-            matcher=common.regex_matcher(pattern),
-            attempts=60, interval=10)
+    def _wait_for_cluster(self):
+        logger.info("Wait for the CephCluster to be ready "
+                    "(this may take a while...)")
+        self.wait_for_ceph_resource('cephclusters', 'rook-ceph', timeout=1800)
 
-        logger.info("Rook successfully installed and ready!")
+    def _wait_for_health(self):
+        logger.info("Wait for Ceph HEALTH_OK")
+        self.wait_for_ceph_resource('cephclusters', 'rook-ceph',
+                                    health="HEALTH_OK", timeout=600)
 
     def _install_operator(self):
         """
@@ -205,11 +229,8 @@ data:
             self._install_operator_kubectl()
 
         logger.info("Wait for rook-ceph-operator running")
-        pattern = re.compile(r'.*rook-ceph-operator.*Running')
-        common.wait_for_result(
-            self.kubernetes.kubectl, "-n rook-ceph get pods",
-            matcher=common.regex_count_matcher(pattern, 1),
-            attempts=30, interval=10)
+        self.kubernetes.wait_for_pods_by_app_label(
+            "rook-ceph-operator", timeout=300)
 
         # set operator log level
         self.kubernetes.kubectl(
@@ -217,50 +238,67 @@ data:
             "deployment/rook-ceph-operator ROOK_LOG_LEVEL=DEBUG")
 
     def _install_operator_kubectl(self):
-        logger.info('Deploying rook operator - using kubectl apply ...')
-        self.kubernetes.kubectl_apply(
-            os.path.join(self.ceph_dir, 'common.yaml'))
-        self.kubernetes.kubectl_apply(
+        logger.info('Deploying rook operator - using server-side apply ...')
+        self.kubernetes.apply_manifests(
+            os.path.join(self.ceph_dir, 'common.yaml'),
             os.path.join(self.ceph_dir, 'operator.yaml'))
 
     # TODO: need to check this in details
     # but Ceph features methods should belong to rook base class
     def deploy_rbd(self):
-        self.kubernetes.kubectl_apply(
+        self.kubernetes.apply_manifests(
             os.path.join(self.ceph_dir, 'csi/rbd/storageclass.yaml'))
 
     def deploy_filesystem(self):
         self.kubernetes.kubectl_apply(
             os.path.join(self.ceph_dir, 'filesystem.yaml'))
-        logger.info("Wait for 2 mdses to start")
-        pattern = re.compile(r'.*rook-ceph-mds-myfs.*Running')
-        common.wait_for_result(
-            self.kubernetes.kubectl, "-n rook-ceph get pods",
-            log_stdout=False,
-            matcher=common.regex_count_matcher(pattern, 2),
-            attempts=120, interval=10)
+        logger.info("Wait for myfs to be ready")
+        self.wait_for_ceph_resource('cephfilesystems', 'myfs', timeout=1200,
+                                    label_selector="app=rook-ceph-mds")
 
+        # Ready only means the operator created the MDS deployments, the
+        # filesystem can't be mounted before an MDS is active
         logger.info("Wait for myfs to be active")
-        pattern = re.compile(r'.*active')
-        common.wait_for_result(
-            self.execute_in_ceph_toolbox, "ceph fs status myfs",
-            log_stdout=False,
-            matcher=common.regex_matcher(pattern),
-            attempts=120, interval=10)
+        common.wait_until(
+            lambda: self.ceph.status().filesystems['myfs'].active,
+            matcher=lambda active: active > 0, decode=None, timeout=1200,
+            description="myfs active",
+            abort=self.kubernetes.pods_failed_checker(
+                label_selector="app=rook-ceph-mds"))
         logger.info("Ceph FS successfully installed and ready!")
 
+    def wait_for_ceph_resource(self, plural, name, health=None, timeout=600,
+                               label_selector=None):
+        """
+        Wait until the operator reports the Rook custom resource `name` of
+        `plural` (eg. cephclusters) as ready and, if given, the Ceph health
+        as `health`
+
+        The resource is watched, so this returns as soon as the operator
+        updates its status. The wait is aborted when the operator reports
+        the resource as failed or a pod matching `label_selector` in
+        rook-ceph is stuck.
+        """
+        resource_failed = waiters.ceph_resources_failed_checker()
+        pods_failed = self.kubernetes.pods_failed_checker(
+            label_selector=label_selector)
+
+        def abort(resources):
+            resource_failed(resources)
+            pods_failed()
+
+        description = f"{plural}/{name} ready"
+        if health is not None:
+            description += f" with {health}"
+        return self.kubernetes.wait_for_custom_objects(
+            'ceph.rook.io', 'v1', plural,
+            waiters.ceph_resources_ready_matcher(health=health), name=name,
+            timeout=timeout, description=description, abort=abort)
+
     def get_number_of_osds(self):
         # NOTE(jhesketh): The number of OSD pods is not necessarily the number
         #                 of running OSDs. Instead consult the ceph toolbox.
-        """
-        # get number of osds
-        osds = self.kubernetes.get_pods_by_app_label("rook-ceph-osd")
-        osds = len(osds)
-        logger.info("cluster has %s osd pods running", osds)
-        """
-        rc, stdout, stderr = \
-            self.execute_in_ceph_toolbox("ceph -f json status")
-        return json.loads(stdout)['osdmap']['num_up_osds']
+        return self.ceph.status().osdmap.num_up_osds
 
     def get_number_of_mons(self):
         # get number of mons
@@ -273,4 +311,6 @@ data:
         return self
 
     def __exit__(self, type, value, traceback):
+        if self.toolbox is not None:
+            self.toolbox.close()
         self.destroy(skip=not settings.as_bool('_TEAR_DOWN_CLUSTER'))
@@ -0,0 +1,178 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A client for the state of the Ceph cluster. Several `ceph -f json` queries
+# are run in a single exec into the toolbox and parsed into structured
+# results, so callers don't need to match on the text output.
+#
+# The last snapshot is kept for a short time and shared, so concurrent waiters
+# (and loops calling eg. `get_number_of_osds`) cost one exec between them.
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) a snapshot is reused by default
+CACHE_TTL = 2.0
+
+_SEPARATOR = "__rookcheck_ceph_query__"
+
+
+class Health(NamedTuple):
+    status: str
+    # The name of each failing check (eg. OSD_DOWN) and its summary
+    checks: Dict[str, str]
+
+
+class OSDMap(NamedTuple):
+    num_osds: int
+    num_up_osds: int
+    num_in_osds: int
+
+
+class PGMap(NamedTuple):
+    num_pgs: int
+    # The number of PGs in each state (eg. "active+clean")
+    states: Dict[str, int]
+
+    @property
+    def all_active_clean(self) -> bool:
+        return self.states.get("active+clean", 0) == self.num_pgs
+
+
+class FileSystem(NamedTuple):
+    name: str
+    max_mds: int
+    # The state of each MDS of the filesystem (eg. "up:active")
+    mds_states: List[str]
+
+    @property
+    def active(self) -> int:
+        return self.mds_states.count("up:active")
+
+
+class Status(NamedTuple):
+    health: Health
+    osdmap: OSDMap
+    pgmap: PGMap
+    quorum: List[str]
+    filesystems: Dict[str, FileSystem]
+    # When the snapshot was taken (time.monotonic())
+    timestamp: float
+
+
+def parse_health(status: Dict[str, Any]) -> Health:
+    health = status['health']
+    checks = {name: check.get('summary', {}).get('message', '')
+              for name, check in health.get('checks', {}).items()}
+    return Health(health['status'], checks)
+
+
+def parse_osdmap(status: Dict[str, Any]) -> OSDMap:
+    osdmap = status['osdmap']
+    # Before Octopus the counters were nested one level deeper
+    osdmap = osdmap.get('osdmap', osdmap)
+    return OSDMap(osdmap['num_osds'], osdmap['num_up_osds'],
+                  osdmap['num_in_osds'])
+
+
+def parse_pgmap(status: Dict[str, Any]) -> PGMap:
+    pgmap = status['pgmap']
+    states = {s['state_name']: s['count']
+              for s in pgmap.get('pgs_by_state', [])}
+    return PGMap(pgmap['num_pgs'], states)
+
+
+def parse_filesystems(fs_dump: Dict[str, Any]) -> Dict[str, FileSystem]:
+    filesystems = {}
+    for fs in fs_dump.get('filesystems', []):
+        mdsmap = fs['mdsmap']
+        filesystems[mdsmap['fs_name']] = FileSystem(
+            mdsmap['fs_name'], mdsmap['max_mds'],
+            sorted(info['state'] for info in mdsmap['info'].values()))
+    return filesystems
+
+
+class CephClient():
+    """
+    Queries the Ceph cluster through `execute`, a function running a shell
+    command in the toolbox and returning (rc, stdout, stderr) (eg.
+    `RookBase.execute_in_ceph_toolbox`)
+    """
+    def __init__(self, execute: Callable, ttl: float = CACHE_TTL):
+        self._execute = execute
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._status: Optional[Status] = None
+
+    def query(self, *commands: str) -> List[Any]:
+        """
+        Run each ceph command (eg. "osd tree") with JSON output in one exec
+
+        Returns the parsed output of each command, or raises an Exception if
+        any of them failed.
+        """
+        script = "".join(
+            f"ceph -f json {command}; rc=$?; echo; echo {_SEPARATOR} $rc\n"
+            for command in commands)
+        rc, stdout, stderr = self._execute(script, check=False)
+
+        results: List[Any] = []
+        lines: List[str] = []
+        for line in stdout.splitlines():
+            if not line.startswith(f"{_SEPARATOR} "):
+                lines.append(line)
+                continue
+            command = commands[len(results)]
+            query_rc = int(line.split()[1])
+            if query_rc != 0:
+                raise Exception(f"`ceph {command}` failed with rc "
+                                f"{query_rc}: {stderr}")
+            results.append(json.loads("\n".join(lines)))
+            lines = []
+        if len(results) != len(commands):
+            raise Exception(f"Expected {len(commands)} results from ceph but "
+                            f"got {len(results)}: {stderr}")
+        return results
+
+    def status(self, max_age: Optional[float] = None) -> Status:
+        """
+        A snapshot of the cluster status at most `max_age` (by default the
+        ttl of the client) seconds old
+
+        Callers arriving while a snapshot is taken wait for and share it.
+        """
+        max_age = self._ttl if max_age is None else max_age
+        with self._lock:
+            if self._status is None or \
+                    time.monotonic() - self._status.timestamp > max_age:
+                status, fs_dump = self.query("status", "fs dump")
+                self._status = Status(
+                    parse_health(status), parse_osdmap(status),
+                    parse_pgmap(status), status.get('quorum_names', []),
+                    parse_filesystems(fs_dump), time.monotonic())
+                logger.debug(f"Ceph is {self._status.health.status} with "
+                             f"{self._status.osdmap.num_up_osds} OSDs up")
+            return self._status
+
+    def invalidate(self):
+        """
+        Make the next `status` query the cluster
+        """
+        with self._lock:
+            self._status = None
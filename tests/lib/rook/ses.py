@@ -22,6 +22,10 @@ from tests.config import settings
 
 logger = logging.getLogger(__name__)
 
+DISCOVERY_DAEMON_REPLACEMENTS = {
+    "enableDiscoveryDaemon: false": "enableDiscoveryDaemon: true",
+}
+
 
 class RookSes(RookBase):
     def __init__(self, workspace, kubernetes):
@@ -47,7 +51,6 @@ class RookSes(RookBase):
             'playbook_rook_ses.yaml', extra_vars=repo_vars)
         self._get_rook()
         self._fix_yaml()
-        self.enable_discovery_daemon()
         self._fix_chart_values()
 
     def _get_rook(self):
@@ -68,16 +71,12 @@ class RookSes(RookBase):
 
     def _fix_chart_values(self):
         # Replacements are to point container paths and/or versions to the
-        # expected ones to test.
+        # expected ones to test. The discovery daemon is enabled in the same
+        # pass over the chart.
         replacements = settings(
             f'SES.{settings.SES.TARGET}.helm_values_substitutions')
-        recursive_replace(self.helm_dir, replacements)
-
-    def enable_discovery_daemon(self):
-        replacements = {
-            "enableDiscoveryDaemon: false": "enableDiscoveryDaemon: true",
-        }
-        recursive_replace(self.helm_dir, replacements)
+        recursive_replace(
+            self.helm_dir, DISCOVERY_DAEMON_REPLACEMENTS, replacements)
 
     def _get_charts(self):
         super()._get_charts()
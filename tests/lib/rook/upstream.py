@@ -15,11 +15,11 @@
 import logging
 import os
 import requests
-import yaml
 
 
 from tests.config import settings, converter
 from tests.lib.common import execute, recursive_replace
+from tests.lib.kubernetes import manifests
 from tests.lib.rook.base import RookBase
 
 logger = logging.getLogger(__name__)
@@ -36,11 +36,11 @@ class RookCluster(RookBase):
 
     def build(self):
         super().build()
+        self.fetch()
         self.get_rook()
         if not converter('@bool', settings.UPSTREAM_ROOK.BUILD_ROOK_FROM_GIT):
             return
 
-        self.get_golang()
         logger.info("Compiling rook...")
         execute(
             command=f"make --directory {self.build_dir} "
@@ -64,6 +64,11 @@ class RookCluster(RookBase):
                 % os.path.join(self.build_dir, 'rook-ceph.tar.gz'))
         self._rook_built = True
 
+    def _fetch(self):
+        super()._fetch()
+        if converter('@bool', settings.UPSTREAM_ROOK.BUILD_ROOK_FROM_GIT):
+            self.get_golang()
+
     def preinstall(self):
         super().preinstall()
         if converter('@bool', settings.UPSTREAM_ROOK.BUILD_ROOK_FROM_GIT):
@@ -97,21 +102,23 @@ class RookCluster(RookBase):
 
     def _fix_yaml(self):
         # Replace image reference if we built it in this run
-        with open(os.path.join(self.ceph_dir, 'operator.yaml')) as file:
-            docs = yaml.load_all(file, Loader=yaml.FullLoader)
-            for doc in docs:
-                try:
-                    image = doc['spec']['template']['spec'][
-                            'containers'][0]['image']
-                    break
-                except KeyError:
-                    pass
+        docs = manifests.store.load(
+            os.path.join(self.ceph_dir, 'operator.yaml'))
+        for doc in docs:
+            try:
+                image = doc['spec']['template']['spec'][
+                        'containers'][0]['image']
+                break
+            except KeyError:
+                pass
         replacements = {image: self.rook_image}
-        recursive_replace(dir=self.ceph_dir, replacements=replacements)
+        recursive_replace(self.ceph_dir, replacements)
 
     def upload_rook_image(self):
+        # Only copies and loads the image, so it can run while kubernetes is
+        # installed
         self.kubernetes.hardware.ansible_run_playbook(
-            "playbook_rook_upstream.yaml")
+            "playbook_rook_upstream.yaml", exclusive=False)
 
     def _install_operator_helm(self):
         version = ""
@@ -0,0 +1,268 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs a graph of steps, each once all of the steps it requires are done. Steps
+# that don't depend on each other run concurrently in threads. Every step is
+# recorded as a span (a child of the span current when the graph is run), and
+# the time each step took as well as the chain of steps that determined the
+# total duration are logged at the end.
+#
+# When a step fails, the steps still running are cancelled: waits (see
+# `cancellable`) and commands started from their threads raise a
+# StepCancelledError, so the failure is reported without waiting for them to
+# time out. Schedulers run from within a step are cancelled along with it.
+
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import (Callable, Dict, List, NamedTuple, Optional, Sequence,
+                    Tuple)
+
+from tests.lib import tracing
+
+
+logger = logging.getLogger(__name__)
+
+
+class Step(NamedTuple):
+    name: str
+    func: Callable[[], None]
+    requires: Sequence[str]
+
+
+class StepTiming(NamedTuple):
+    name: str
+    # time.monotonic() when the step started and ended
+    start: float
+    end: float
+    # When the last step it requires ended (or the graph started)
+    ready: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class StepFailedError(Exception):
+    """
+    A step of a Scheduler raised. The original exception is the __cause__.
+    """
+    def __init__(self, name: str, error: BaseException):
+        self.step = name
+        self.error = error
+        super().__init__(f"Step {name} failed: {error!r}")
+
+
+class StepCancelledError(Exception):
+    """
+    The step was stopped because another step of its scheduler failed
+    """
+
+
+_local = threading.local()
+
+
+def _cancellations() -> Tuple[threading.Event, ...]:
+    return getattr(_local, 'cancellations', ())
+
+
+def cancelled() -> bool:
+    """
+    Whether the step running in the calling thread (or a step it was run
+    from) was cancelled
+    """
+    return any(e.is_set() for e in _cancellations())
+
+
+def check_cancelled():
+    """
+    Raise a StepCancelledError if the step running in the calling thread was
+    cancelled
+    """
+    if cancelled():
+        raise StepCancelledError("Cancelled as another step failed")
+
+
+def cancellable(abort: Optional[Callable] = None) -> Optional[Callable]:
+    """
+    `abort` (a check raising to end a wait early) extended to also end the
+    wait once the step running in the calling thread is cancelled
+
+    Outside of a step `abort` is returned as is.
+    """
+    cancellations = _cancellations()
+    if not cancellations:
+        return abort
+
+    def check(*args):
+        if any(e.is_set() for e in cancellations):
+            raise StepCancelledError("Cancelled as another step failed")
+        if abort is not None:
+            abort(*args)
+    return check
+
+
+class Scheduler():
+    """
+    A graph of steps called `name`, run with up to `max_workers` threads
+    (one per step by default)
+    """
+    def __init__(self, name: str, max_workers: Optional[int] = None,
+                 category: str = 'step'):
+        self.name = name
+        self._max_workers = max_workers
+        self._category = category
+        self._steps: Dict[str, Step] = {}
+        self.timings: Dict[str, StepTiming] = {}
+
+    def add(self, name: str, func: Callable[[], None],
+            requires: Sequence[str] = ()):
+        """
+        Add the step `name` running `func` once all the steps named in
+        `requires` succeeded
+        """
+        if name in self._steps:
+            raise ValueError(f"Step {name} is already part of {self.name}")
+        self._steps[name] = Step(name, func, tuple(requires))
+
+    def _check(self):
+        for step in self._steps.values():
+            for required in step.requires:
+                if required not in self._steps:
+                    raise ValueError(f"Step {step.name} requires unknown "
+                                     f"step {required}")
+        # Kahn's algorithm, anything left over is part of a cycle
+        remaining = {s.name: set(s.requires) for s in self._steps.values()}
+        while True:
+            ready = [name for name, requires in remaining.items()
+                     if not requires]
+            if not ready:
+                break
+            for name in ready:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(ready)
+        if remaining:
+            raise ValueError(f"The steps of {self.name} have a cycle "
+                             f"through {sorted(remaining)}")
+
+    def run(self) -> Dict[str, StepTiming]:
+        """
+        Run all steps and return how long each took
+
+        When a step raises, no further steps are started and the steps
+        already running are cancelled. A StepFailedError is raised for the
+        first failure once they returned, so that nothing is left running
+        during the cleanup.
+        """
+        self._check()
+        self.timings = {}
+        cancellations = _cancellations() + (threading.Event(),)
+        start = time.monotonic()
+        pending = dict(self._steps)
+        running: Dict[concurrent.futures.Future, str] = {}
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_workers or max(len(pending), 1),
+            thread_name_prefix=self.name)
+        logger.info(f"Running {len(pending)} steps of {self.name}")
+        failure: Optional[StepFailedError] = None
+        try:
+            while running or (pending and failure is None):
+                for step in list(pending.values()):
+                    if failure is not None:
+                        break
+                    if all(r in self.timings for r in step.requires):
+                        del pending[step.name]
+                        ready = max([self.timings[r].end
+                                     for r in step.requires] + [start])
+                        future = executor.submit(
+                            tracing.tracer.wrap(self._run_step), step, ready,
+                            cancellations)
+                        running[future] = step.name
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.timings[name] = future.result()
+                    except StepCancelledError as e:
+                        logger.warning(f"Step {name} of {self.name} was "
+                                       f"cancelled")
+                        if failure is None:
+                            # Cancelled from the step this graph runs in
+                            failure = StepFailedError(name, e)
+                            failure.__cause__ = e
+                    except Exception as e:
+                        running_steps = sorted(running.values())
+                        logger.error(f"Step {name} of {self.name} failed, "
+                                     f"not starting {sorted(pending)} and "
+                                     f"cancelling {running_steps}")
+                        if failure is None:
+                            failure = StepFailedError(name, e)
+                            failure.__cause__ = e
+                        cancellations[-1].set()
+        finally:
+            executor.shutdown()
+        self.log_summary()
+        if failure is not None:
+            if isinstance(failure.error, StepCancelledError):
+                # The step this graph runs in was cancelled
+                raise failure.error
+            raise failure
+        return self.timings
+
+    def _run_step(self, step: Step, ready: float,
+                  cancellations: Tuple[threading.Event, ...]) -> StepTiming:
+        _local.cancellations = cancellations
+        try:
+            with tracing.span(step.name, category=self._category):
+                logger.info(f"Starting step {step.name} of {self.name}")
+                step_start = time.monotonic()
+                check_cancelled()
+                step.func()
+                end = time.monotonic()
+        finally:
+            _local.cancellations = ()
+        logger.info(f"Step {step.name} of {self.name} finished in "
+                    f"{end - step_start:.1f}s")
+        return StepTiming(step.name, step_start, end, ready)
+
+    def critical_path(self) -> List[StepTiming]:
+        """
+        The chain of steps that determined how long the graph took to run,
+        in the order they ran
+        """
+        if not self.timings:
+            return []
+        path = [max(self.timings.values(), key=lambda t: t.end)]
+        while True:
+            requires = self._steps[path[-1].name].requires
+            if not requires:
+                break
+            path.append(max((self.timings[r] for r in requires),
+                            key=lambda t: t.end))
+        return list(reversed(path))
+
+    def log_summary(self):
+        if not self.timings:
+            return
+        start = min(t.ready for t in self.timings.values())
+        total = max(t.end for t in self.timings.values()) - start
+        logger.info(f"{self.name} took {total:.1f}s:")
+        for t in sorted(self.timings.values(), key=lambda t: t.start):
+            logger.info(f"  {t.name}: started at {t.start - start:.1f}s, "
+                        f"took {t.duration:.1f}s")
+        logger.info(f"Critical path of {self.name}: " + " -> ".join(
+            f"{t.name} ({t.duration:.1f}s)" for t in self.critical_path()))
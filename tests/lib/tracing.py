@@ -0,0 +1,278 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Records nested spans (phases, nodes, commands, waits) of a run. The trace can
+# be exported in the Chrome trace event format and loaded into chrome://tracing
+# or https://ui.perfetto.dev. A summary of the critical path (the chain of
+# spans that determined how long the run took) is logged at the end.
+
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Spans that end this close to (in seconds) the start of the next span on the
+# critical path are considered to be gating it
+_TOLERANCE = 0.001
+
+
+class Span():
+    """
+    A named interval of the run
+
+    `async_` spans were recorded from asyncio tasks and may overlap with
+    their siblings on the same thread.
+    """
+    __slots__ = ['id', 'name', 'category', 'parent', 'tid', 'start', 'end',
+                 'args', 'async_']
+
+    def __init__(self, id: int, name: str, category: str,
+                 parent: Optional['Span'], start: float,
+                 args: Dict[str, Any], async_: bool = False):
+        self.id = id
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.tid = threading.get_ident()
+        self.start = start
+        self.end: Optional[float] = None
+        self.args = args
+        self.async_ = async_
+
+    @property
+    def duration(self) -> float:
+        end = self.end if self.end is not None else time.monotonic()
+        return end - self.start
+
+
+class Tracer():
+    """
+    Collects spans from all threads of the run
+
+    Spans nest per thread: a span started while another one is open on the
+    same thread becomes its child. Work handed to other threads can keep its
+    parent through `wrap`.
+
+    Spans are only kept while the tracer is `enabled`.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._spans: List[Span] = []
+        self._local = threading.local()
+        self._thread_names: Dict[int, str] = {}
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add(self, span: Span):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._spans.append(span)
+            self._thread_names.setdefault(
+                span.tid, threading.current_thread().name)
+
+    def current(self) -> Optional[Span]:
+        """
+        The innermost open span of the calling thread
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str = 'function',
+             parent: Optional[Span] = None, **args) -> Iterator[Span]:
+        """
+        Record the enclosed block as a span named `name`
+
+        `parent` defaults to the current span of the calling thread. `args`
+        are shown with the span in the trace viewer.
+        """
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(next(self._ids), name, category, parent,
+                    time.monotonic(), args)
+        self._add(span)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args['error'] = repr(e)
+            raise
+        finally:
+            span.end = time.monotonic()
+            stack.pop()
+
+    def record(self, name: str, category: str, start: float, end: float,
+               parent: Optional[Span] = None, async_: bool = False,
+               **args) -> Span:
+        """
+        Add a span that has already finished
+
+        Set `async_` for spans of asyncio tasks, which interleave on one
+        thread and so can't use the per thread nesting of `span`.
+        """
+        span = Span(next(self._ids), name, category, parent, start, args,
+                    async_=async_)
+        span.end = end
+        self._add(span)
+        return span
+
+    def wrap(self, func: Callable) -> Callable:
+        """
+        Wrap `func` so that the spans it records in another thread are
+        children of the current span
+        """
+        parent = self.current()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if parent is None:
+                return func(*args, **kwargs)
+            stack = self._stack()
+            # Adopt the parent for the duration of the call
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def reset(self):
+        with self._lock:
+            self._spans = []
+            self._thread_names = {}
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """
+        The spans in the Chrome trace event format
+        """
+        spans = self.spans()
+        if not spans:
+            return {'traceEvents': [], 'displayTimeUnit': 'ms'}
+        epoch = min(s.start for s in spans)
+        pid = os.getpid()
+
+        def us(t):
+            return int((t - epoch) * 1000000)
+
+        events: List[Dict[str, Any]] = []
+        for tid, name in self._thread_names.items():
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                           'tid': tid, 'args': {'name': name}})
+        for s in spans:
+            end = s.end if s.end is not None else s.start + s.duration
+            event = {'name': s.name, 'cat': s.category, 'pid': pid,
+                     'tid': s.tid, 'args': s.args}
+            if s.async_:
+                events.append(dict(event, ph='b', id=s.id, ts=us(s.start)))
+                events.append(dict(event, ph='e', id=s.id, ts=us(end)))
+            else:
+                events.append(dict(event, ph='X', ts=us(s.start),
+                                   dur=us(end) - us(s.start)))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path: str):
+        """
+        Write the trace to `path` (Chrome trace event JSON)
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info(f"Wrote trace of {len(self.spans())} spans to {path}")
+
+    def critical_path(self) -> List[Tuple[int, Span]]:
+        """
+        The chain of spans that determined the duration of the run
+
+        Starting from the span that finished last, walk back to the span that
+        finished last before it started, and so on. The same is done within
+        each span on the path for its children.
+
+        Returns a list of (depth, span) in chronological order.
+        """
+        spans = [s for s in self.spans() if s.end is not None]
+        children: Dict[Optional[int], List[Span]] = {}
+        for s in spans:
+            children.setdefault(
+                s.parent.id if s.parent else None, []).append(s)
+
+        def end(s: Span) -> float:
+            return s.start + s.duration
+
+        def walk(candidates: List[Span], until: float,
+                 depth: int) -> List[Tuple[int, Span]]:
+            chain = []
+            while True:
+                ready = [s for s in candidates
+                         if end(s) <= until + _TOLERANCE]
+                if not ready:
+                    break
+                last = max(ready, key=end)
+                chain.append(last)
+                candidates = [s for s in ready if s is not last]
+                until = last.start
+            path = []
+            for s in reversed(chain):
+                path.append((depth, s))
+                path.extend(walk(children.get(s.id, []), end(s), depth + 1))
+            return path
+
+        if not spans:
+            return []
+        return walk(children.get(None, []), max(end(s) for s in spans), 0)
+
+    def log_summary(self):
+        spans = [s for s in self.spans() if s.end is not None]
+        if not spans:
+            return
+        total = max(s.start + s.duration for s in spans) - \
+            min(s.start for s in spans)
+        logger.info("#" * 120)
+        logger.info(f"# Critical path ({total:.1f}s in total):")
+        for depth, s in self.critical_path():
+            share = s.duration / total * 100 if total else 0
+            logger.info(f"# {'  ' * depth}{s.name} [{s.category}] "
+                        f"{s.duration:.1f}s ({share:.0f}%)")
+        by_category: Dict[str, float] = {}
+        for s in spans:
+            by_category[s.category] = \
+                by_category.get(s.category, 0) + s.duration
+        logger.info("# Time per category (summed over threads):")
+        for category, duration in sorted(
+                by_category.items(), key=lambda i: i[1], reverse=True):
+            logger.info(f"#   {category}: {duration:.1f}s")
+        logger.info("#" * 120)
+
+
+# The tracer of the run, enabled when a _TRACE_FILE is set (see conftest.py)
+tracer = Tracer(enabled=False)
+span = tracer.span
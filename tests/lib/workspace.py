@@ -12,19 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import configparser
 import contextlib
 import logging
 import os
 import shutil
 import stat
 import subprocess
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import uuid
 
 import paramiko.rsakey
 
 from tests.config import settings
-from tests.lib.common import execute, handle_cleanup_input, get_unpack
+from tests.lib.async_execute import execute_async, execute_many
+from tests.lib.cache import ArtifactCache
+from tests.lib.common import (execute, handle_cleanup_input, get_unpack,
+                              unpack_stream)
+from tests.lib.download import download
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +44,10 @@ class Workspace():
         self._bin_dir: str = os.path.join(self.working_dir, 'bin')
         self._tmp_dir: str = os.path.join(self.working_dir, 'tmp')
         self._helm_dir: str = os.path.join(self.working_dir, 'helm')
+        self._ansible_config: str = os.path.join(
+            self.working_dir, 'ansible.cfg')
+        self._ansible_fact_cache_dir: str = os.path.join(
+            self.working_dir, 'ansible_facts')
 
         self._sshkey_name: Optional[str] = None
         self._public_key: Optional[str] = None
@@ -49,6 +58,13 @@ class Workspace():
         self._ssh_agent_auth_sock: str = os.path.join(
             self.working_dir, 'ssh-agent.sock')
         self._ssh_agent()
+        self._write_ansible_config()
+
+        self._artifact_cache: Optional[ArtifactCache] = None
+        if settings.ARTIFACT_CACHE_DIR:
+            self._artifact_cache = ArtifactCache(
+                settings.ARTIFACT_CACHE_DIR,
+                int(settings.ARTIFACT_CACHE_MAX_SIZE) * 1024 ** 3)
 
         logger.info(f"Workspace {self.name} set up at {self.working_dir}")
         logger.info(f"public key {self.public_key}")
@@ -80,6 +96,18 @@ class Workspace():
     def helm_dir(self) -> str:
         return self._helm_dir
 
+    @property
+    def ansible_config(self) -> str:
+        return self._ansible_config
+
+    @property
+    def ansible_fact_cache_dir(self) -> str:
+        return self._ansible_fact_cache_dir
+
+    @property
+    def artifact_cache(self) -> Optional[ArtifactCache]:
+        return self._artifact_cache
+
     @property
     def sshkey_name(self):
         return self._sshkey_name
@@ -142,38 +170,90 @@ class Workspace():
                 log_stdout: bool = True, log_stderr: bool = True,
                 env: Optional[Dict[str, str]] = None,
                 logger_name: Optional[str] = None,
-                chdir: Optional[str] = None) -> Tuple[
+                chdir: Optional[str] = None,
+                tee: Optional[str] = None) -> Tuple[
                     int, Optional[str], Optional[str]]:
         """Executes a command inside the workspace
 
         This is a wrapper around the execute util that will automatically
-        chdir into the workspace and set some common env vars (such as the
-        ssh agent).
+        run the command in the workspace and set some common env vars (such as
+        the ssh agent). The working directory of the process is left alone,
+        so commands can be run from several threads at once.
+        """
+        return execute(command, capture=capture, check=check,
+                       log_stdout=log_stdout, log_stderr=log_stderr,
+                       env=self._command_env(env), logger_name=logger_name,
+                       tee=tee, cwd=chdir or self.working_dir)
+
+    async def execute_async(self, command: str, chdir: Optional[str] = None,
+                            env: Optional[Dict[str, str]] = None,
+                            **kwargs) -> Tuple[
+                                int, Optional[str], Optional[str]]:
+        """Executes a command inside the workspace using asyncio
+
+        The same as `execute`, but the working directory is only set for the
+        command itself so that many commands can run concurrently. `kwargs`
+        are passed to `tests.lib.async_execute.execute_async`.
+        """
+        return await execute_async(
+            command, env=self._command_env(env),
+            cwd=chdir or self.working_dir, **kwargs)
+
+    def execute_many(self, commands: List[str], concurrency: int = 8,
+                     chdir: Optional[str] = None,
+                     env: Optional[Dict[str, str]] = None,
+                     **kwargs) -> List[
+                         Tuple[int, Optional[str], Optional[str]]]:
+        """Executes `commands` concurrently inside the workspace
+
+        At most `concurrency` commands run at the same time. If one fails the
+        others are cancelled.
         """
+        return execute_many(
+            commands, concurrency=concurrency, env=self._command_env(env),
+            cwd=chdir or self.working_dir, **kwargs)
+
+    def _command_env(self, env: Optional[Dict[str, str]] = None) -> Dict[
+            str, str]:
         if not env:
             env = {
                 'PATH': os.environ.get(
                     'PATH', '/usr/local/bin:/usr/bin:/bin')
             }
         env['PATH'] = f"{os.path.join(self.working_dir, 'bin')}:{env['PATH']}"
-        with self.chdir(chdir):
-            env['SSH_AUTH_SOCK'] = self.ssh_agent_auth_sock
-            env['SSH_AGENT_PID'] = self.ssh_agent_pid
-            return execute(command, capture=capture, check=check,
-                           log_stdout=log_stdout, log_stderr=log_stderr,
-                           env=env, logger_name=logger_name)
+        env['SSH_AUTH_SOCK'] = self.ssh_agent_auth_sock
+        env['SSH_AGENT_PID'] = self.ssh_agent_pid
+        env['ANSIBLE_CONFIG'] = self.ansible_config
+        return env
 
     def get_unpack(self, url, unpack_folder=None):
         """
         Download a file an unpack it in the workspace context
+
+        The download goes through the artifact cache if it is enabled.
         """
         if not unpack_folder:
             unpack_folder = self.tmp_dir
+        logger.info(f"Unpack {url} in {unpack_folder}")
+        if self.artifact_cache:
+            with unpack_stream(unpack_folder) as feed:
+                self.artifact_cache.fetch(url, on_chunk=feed)
+            return
         dst = os.path.join(self.tmp_dir, url.split('/')[-1])
         logger.info(f"Downloading {url} to {dst}")
-        logger.info(f"Unpack in {unpack_folder}")
         get_unpack(url, dst, unpack_folder)
 
+    def download(self, url, dst):
+        """
+        Download a file to `dst` (through the artifact cache if it is
+        enabled)
+        """
+        logger.info(f"Downloading {url} to {dst}")
+        if self.artifact_cache:
+            self.artifact_cache.copy_to(url, dst)
+        else:
+            download(url, dst)
+
     def ansible_inventory_vars(self) -> Dict[str, Any]:
         """
         Some basic ansible inventory variables that are common for this
@@ -190,6 +270,39 @@ class Workspace():
         }
         return vars
 
+    def _write_ansible_config(self):
+        """
+        Write the ansible.cfg used by every playbook run in this workspace
+
+        Connections to the nodes are kept open between tasks and playbooks
+        (ControlPersist), modules are piped through the open connection
+        rather than copied first and facts are gathered once per node and
+        then read from a JSON cache shared by all playbooks.
+        """
+        persist = int(settings.ANSIBLE_CONTROL_PERSIST)
+        config = configparser.ConfigParser(interpolation=None)
+        config['defaults'] = {
+            # The upper limit, each run uses one fork per node (see
+            # HardwareBase.ansible_run_playbook)
+            'forks': str(max(int(settings.ANSIBLE_MAX_FORKS), 1)),
+            'gathering': 'smart',
+            'fact_caching': 'jsonfile',
+            'fact_caching_connection': self.ansible_fact_cache_dir,
+            # The cache lives as long as the workspace
+            'fact_caching_timeout': '0',
+            'host_key_checking': 'False',
+        }
+        config['ssh_connection'] = {
+            'pipelining': 'True',
+            'ssh_args': f"-C -o ControlMaster=auto "
+                        f"-o ControlPersist={persist}s",
+            # Short, so the socket path stays below the limit of ~100 bytes
+            'control_path_dir': os.path.join(self.working_dir, 'cp'),
+            'control_path': '%(directory)s/%%C',
+        }
+        with open(self.ansible_config, 'w') as f:
+            config.write(f)
+
     @contextlib.contextmanager
     def chdir(self, path=None):
         """A context manager which changes the working directory to the given
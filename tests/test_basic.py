@@ -16,16 +16,24 @@ import logging
 import os
 import pytest
 import time
-import yaml
 import re
 
 from tests.lib.hardware.node_base import NodeRole
 from tests.lib import common
+from tests.lib.kubernetes import manifests
 
 
 logger = logging.getLogger(__name__)
 
 
+def _cluster(cluster_yaml):
+    # The CephCluster in cluster_yaml
+    for document in manifests.store.load(cluster_yaml):
+        if document['kind'] == 'CephCluster':
+            return document
+    raise Exception(f"No CephCluster in {cluster_yaml}")
+
+
 # check if all default services are available
 def test_services(rook_cluster):
     services = ["rook-ceph-mgr",
@@ -45,8 +53,7 @@ def test_services(rook_cluster):
 
 def test_service_mons(rook_cluster):
     cluster_yaml = os.path.join(rook_cluster.ceph_dir, 'cluster.yaml')
-    with open(cluster_yaml, 'r') as f:
-        cluster_object = yaml.load(f, Loader=yaml.BaseLoader)
+    cluster_object = _cluster(cluster_yaml)
     # get configured number of monitors
     count = cluster_object['spec']['mon']['count']
     count = int(count)
@@ -252,8 +259,10 @@ def test_service_rbd(rook_cluster):
     if output[0] != 0:
         pytest.fail("Could not create an ObjectStore")
 
+    rook_cluster.wait_for_ceph_resource('cephobjectstores', 'my-store',
+                                        timeout=200)
     found = rook_cluster.kubernetes.wait_for_service("rook-ceph-rgw-my-store",
-                                                     iteration=20)
+                                                     iteration=1)
 
     if found is False:
         pytest.fail("rgw service has not been started automatically")
@@ -307,9 +316,7 @@ def test_add_storage(rook_cluster):
 def test_mons_up_down(rook_cluster):
     cluster_yaml = os.path.join(rook_cluster.ceph_dir, 'cluster.yaml')
 
-    with open(cluster_yaml, 'r') as f:
-        content = yaml.full_load(f)
-        mons = int(content['spec']['mon']['count'])
+    mons = int(_cluster(cluster_yaml)['spec']['mon']['count'])
 
     mon_pods = rook_cluster.get_number_of_mons()
 
@@ -320,18 +327,13 @@ def test_mons_up_down(rook_cluster):
 
     deltamon = 2
 
-    content['spec']['mon']['count'] = mons + deltamon
-    content['spec']['mon']['allowMultiplePerNode'] = True
-
-    cluster_yaml_modded = os.path.join(
-        rook_cluster.ceph_dir, 'cluster_modded.yaml')
-
-    with open(cluster_yaml_modded, 'w') as f:
-        yaml.dump(content, f)
+    more_mons = manifests.Overlay('CephCluster', {'spec': {'mon': {
+        'count': mons + deltamon, 'allowMultiplePerNode': True}}})
 
     logger.info("About to increase the number of monitors by %d", deltamon)
 
-    rook_cluster.kubernetes.kubectl_apply(cluster_yaml_modded)
+    rook_cluster.kubernetes.apply_manifests(
+        cluster_yaml, overlays=rook_cluster.cluster_overlays + [more_mons])
     rook_cluster.kubernetes.wait_for_pods_by_app_label(
         "rook-ceph-mon", count=mons+deltamon)
 
@@ -349,7 +351,8 @@ def test_mons_up_down(rook_cluster):
 
     logger.info("Attempting to restore the number of monitors to %d", mons)
 
-    rook_cluster.kubernetes.kubectl_apply(cluster_yaml)
+    rook_cluster.kubernetes.apply_manifests(
+        cluster_yaml, overlays=rook_cluster.cluster_overlays)
 
     check = 1
     mon_pods = rook_cluster.get_number_of_mons()
@@ -374,9 +377,8 @@ def test_rbd_pvc(rook_cluster):
 
     # check if StorageClass is up and available
     pattern = re.compile(r'.*rook-ceph-block*')
-    common.wait_for_result(rook_cluster.kubernetes.kubectl, "get sc",
-                           matcher=common.regex_matcher(pattern),
-                           attempts=30, interval=10)
+    common.wait_until(rook_cluster.kubernetes.kubectl, "get sc",
+                      matcher=common.regex_matcher(pattern), timeout=300)
 
     # create an rbd based PVC
     output = rook_cluster.kubernetes.kubectl_apply(
@@ -386,9 +388,8 @@ def test_rbd_pvc(rook_cluster):
         pytest.fail("Could not create a rbd-PVC")
 
     pattern = re.compile(r'.*Bound*')
-    common.wait_for_result(rook_cluster.kubernetes.kubectl, "get pvc rbd-pvc",
-                           matcher=common.regex_matcher(pattern),
-                           attempts=30, interval=10)
+    common.wait_until(rook_cluster.kubernetes.kubectl, "get pvc rbd-pvc",
+                      matcher=common.regex_matcher(pattern), timeout=300)
 
     # create a pod using the PVC
     output = rook_cluster.kubernetes.kubectl_apply(
@@ -398,10 +399,9 @@ def test_rbd_pvc(rook_cluster):
         pytest.fail("Could not create a rbd-pod")
 
     pattern = re.compile(r'.*Running*')
-    common.wait_for_result(rook_cluster.kubernetes.kubectl,
-                           "get pod csirbd-demo-pod",
-                           matcher=common.regex_matcher(pattern),
-                           attempts=30, interval=10)
+    common.wait_until(rook_cluster.kubernetes.kubectl,
+                      "get pod csirbd-demo-pod",
+                      matcher=common.regex_matcher(pattern), timeout=300)
 
     rook_cluster.kubernetes.kubectl('delete pod csirbd-demo-pod')
     rook_cluster.kubernetes.kubectl('delete pvc rbd-pvc')
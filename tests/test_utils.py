@@ -12,12 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import configparser
+import gzip
+import hashlib
+import http.server
+import io
+import json
 import logging
+import os
+import queue
+import selectors
+import socketserver
 import subprocess
+import tarfile
+import threading
+import time
+import types
 
+import kubernetes
+from kubernetes.dynamic.exceptions import NotFoundError, ResourceNotFoundError
 import pytest
+import yaml
 
+from tests.config import settings
+from tests.lib import async_execute
+from tests.lib import common
+from tests.lib import download
+from tests.lib import scheduler
+from tests.lib import tracing
+from tests.lib.cache import ArtifactCache
 from tests.lib.common import execute
+from tests.lib.hardware import hardware_base
+from tests.lib.hardware import null
+from tests.lib.hardware.hardware_base import AnsibleInventory, BootError
+from tests.lib.kubernetes import exec_session
+from tests.lib.kubernetes import informer
+from tests.lib.kubernetes import kubernetes_base
+from tests.lib.kubernetes import manifests
+from tests.lib.kubernetes import recorder
+from tests.lib.kubernetes import waiters
+from tests.lib.rook import ceph
+from tests.lib.workspace import Workspace
 
 logger = logging.getLogger(__name__)
 
@@ -94,3 +130,1581 @@ def test_command_matrix(log_stdout, log_stderr, capture, check, fail_command,
         assert caplog.records[0].name == logger_name_check
         assert caplog.records[0].levelname == 'WARNING'
         assert caplog.records[0].getMessage() == 'error'
+
+
+def test_command_large_output():
+    rc, stdout, stderr = execute(
+        "seq 1 100000", capture=True, log_stdout=False)
+    assert stdout == "".join(f"{i}\n" for i in range(1, 100001))
+
+
+def test_command_partial_last_line(caplog):
+    caplog.set_level(logging.INFO)
+    rc, stdout, stderr = execute(
+        'printf "one\\ntwo"', capture=True, logger_name="partial")
+    assert stdout == "one\ntwo"
+    assert [r.getMessage() for r in caplog.records
+            if r.name == "partial"] == ["one", "two"]
+
+
+def test_command_tee(tmp_path):
+    tee = tmp_path / "output.txt"
+    rc, stdout, stderr = execute(
+        'echo "Hello world" && >&2 echo "error"', log_stdout=False,
+        log_stderr=False, tee=str(tee))
+    assert stdout is None
+    assert tee.read_text() == "Hello world\n"
+
+    tee = tmp_path / "output.txt.gz"
+    execute('echo "Hello world"', log_stdout=False, tee=str(tee))
+    with gzip.open(str(tee), 'rt') as f:
+        assert f.read() == "Hello world\n"
+
+
+def test_backoff_intervals():
+    backoff = common.Backoff(initial=1, maximum=8, factor=2, jitter=0,
+                             fast_probes=2)
+    intervals = [i for i, _ in zip(backoff, range(6))]
+    assert intervals == [1, 1, 2, 4, 8, 8]
+
+
+def test_wait_until_returns_match():
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return len(calls)
+
+    backoff = common.Backoff(initial=0.01, maximum=0.01)
+    out = common.wait_until(probe, matcher=common.simple_matcher(3),
+                            timeout=5, backoff=backoff, decode=None,
+                            description="probe test")
+    assert out == 3
+    record = common.wait_stats.records[-1]
+    assert record.description == "probe test"
+    assert record.probes == 3
+    assert record.success
+
+
+def test_wait_until_times_out_when_always_raising():
+    def probe():
+        raise subprocess.CalledProcessError(1, "false")
+
+    backoff = common.Backoff(initial=0.01, maximum=0.05)
+    with pytest.raises(TimeoutError):
+        common.wait_until(probe, timeout=0.2, backoff=backoff)
+    assert not common.wait_stats.records[-1].success
+
+
+def test_wait_until_reraises():
+    def probe():
+        raise subprocess.CalledProcessError(1, "false")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        common.wait_until(probe, timeout=5, ignore_exceptions=False)
+
+
+def test_execute_many_runs_concurrently():
+    start = time.monotonic()
+    results = async_execute.execute_many(
+        [f"sleep 0.5 && echo {i}" for i in range(4)], concurrency=4,
+        capture=True)
+    assert time.monotonic() - start < 1.5
+    assert [stdout for rc, stdout, stderr in results] == \
+        [f"{i}\n" for i in range(4)]
+
+
+def test_execute_async_line_callback():
+    lines = []
+    rc, stdout, stderr = async_execute.run_async(
+        async_execute.execute_async(
+            'echo "Hello world" && >&2 echo "error"', log_stdout=False,
+            log_stderr=False,
+            line_callback=lambda stream, line: lines.append((stream, line))))
+    assert stdout is None
+    assert sorted(lines) == [("stderr", "error"), ("stdout", "Hello world")]
+
+
+def test_execute_many_cancels_on_failure():
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        async_execute.execute_many(["sleep 30", "exit 3"], concurrency=2)
+    assert time.monotonic() - start < 10
+
+
+def test_execute_async_cancel_terminates():
+    async def cancel_soon():
+        task = asyncio.ensure_future(
+            async_execute.execute_async("sleep 30", log_stdout=False))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.monotonic()
+    async_execute.run_async(cancel_soon())
+    assert time.monotonic() - start < 10
+
+
+def test_recursive_replace(tmp_path):
+    (tmp_path / "sub").mkdir()
+    changed = tmp_path / "sub" / "changed.yaml"
+    changed.write_text("image: rook/ceph:master\nother: rook/ceph\n")
+    unchanged = tmp_path / "unchanged.yaml"
+    unchanged.write_text("nothing to see\n")
+    binary = tmp_path / "binary.bin"
+    binary.write_bytes(b"rook/ceph\0\xff")
+
+    changed_paths = common.recursive_replace(
+        str(tmp_path),
+        {"rook/ceph": "registry/rook", "rook/ceph:master": "registry/tag"},
+        {"registry/rook": "registry/rook2"})
+
+    assert changed_paths == [str(changed)]
+    # Keys and sets are applied one after another, in order
+    assert changed.read_text() == \
+        "image: registry/rook2:master\nother: registry/rook2\n"
+    assert (tmp_path / "sub" / "changed.yaml.back").exists()
+    assert not (tmp_path / "unchanged.yaml.back").exists()
+    assert binary.read_bytes() == b"rook/ceph\0\xff"
+
+
+def test_recursive_replace_chained(tmp_path):
+    # As in helm_values_substitutions of config/ses.toml, the second key
+    # only matches once the first one was replaced
+    values = tmp_path / "values.yaml"
+    values.write_text("  #image: registry.suse.com/ses/7.1/ceph\n")
+    common.recursive_replace(str(tmp_path), {
+        "registry.suse.com": "registry.suse.de/containers",
+        "#image: registry": "image: registry",
+    })
+    assert values.read_text() == \
+        "  image: registry.suse.de/containers/ses/7.1/ceph\n"
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_files():
+    """
+    Serve a dict of path -> content over http, recording GET requests
+
+    Range requests are supported and recorded as "<path> <range>". Ranges
+    starting at an offset in `fail_at` are aborted (once).
+    """
+    files = {}
+    gets = []
+    fail_at = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _send_headers(self, status=200, length=None):
+            content = files.get(self.path)
+            if content is None:
+                self.send_error(404)
+                return None
+            self.send_response(status)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(
+                len(content) if length is None else length))
+            self.send_header('ETag', hashlib.md5(content).hexdigest())
+            self.end_headers()
+            return content
+
+        def do_HEAD(self):
+            self._send_headers()
+
+        def do_GET(self):
+            range_header = self.headers.get('Range')
+            if not range_header:
+                gets.append(self.path)
+                content = self._send_headers()
+                if content is not None:
+                    self.wfile.write(content)
+                return
+            gets.append(f"{self.path} {range_header}")
+            start, end = (int(x) for x in
+                          range_header.split('=')[1].split('-'))
+            if start in fail_at:
+                fail_at.remove(start)
+                self.send_error(500)
+                return
+            content = self._send_headers(206, end + 1 - start)
+            if content is not None:
+                self.wfile.write(content[start:end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield files, f"http://127.0.0.1:{server.server_port}", gets, fail_at
+    server.shutdown()
+
+
+def test_artifact_cache(tmp_path, http_files):
+    files, url, gets, _ = http_files
+    files["/a.txt"] = b"a" * 100
+    files["/b.txt"] = b"b" * 100
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=150)
+
+    path = cache.fetch(f"{url}/a.txt")
+    assert open(path, 'rb').read() == b"a" * 100
+    assert cache.fetch(f"{url}/a.txt") == path
+    assert gets == ["/a.txt"]
+
+    with pytest.raises(Exception, match="Checksum mismatch"):
+        cache.fetch(f"{url}/b.txt", sha256="0" * 64)
+
+    sha256 = hashlib.sha256(b"b" * 100).hexdigest()
+    cache.copy_to(f"{url}/b.txt", str(tmp_path / "b.txt"), sha256=sha256)
+    assert (tmp_path / "b.txt").read_bytes() == b"b" * 100
+    # a.txt was least recently used and got evicted to fit max_size
+    assert not os.path.exists(path)
+
+
+def test_artifact_cache_keeps_blobs_in_use(tmp_path, http_files):
+    files, url, gets, _ = http_files
+    files["/a.txt"] = b"a" * 100
+    files["/b.txt"] = b"b" * 100
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=150)
+    path = cache.fetch(f"{url}/a.txt")
+
+    def fetch_b(chunk):
+        # Another run fetching b.txt while a.txt is being read
+        cache.fetch(f"{url}/b.txt")
+        assert os.path.exists(path)
+
+    cache.fetch(f"{url}/a.txt", on_chunk=fetch_b)
+    # Once a.txt is no longer in use it can be evicted
+    cache.fetch(f"{url}/b.txt")
+    assert not os.path.exists(path)
+
+
+def test_artifact_cache_revalidates(tmp_path, http_files):
+    files, url, gets, _ = http_files
+    files["/a.txt"] = b"old"
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=1024)
+    assert open(cache.fetch(f"{url}/a.txt"), 'rb').read() == b"old"
+    files["/a.txt"] = b"new"
+    assert open(cache.fetch(f"{url}/a.txt"), 'rb').read() == b"new"
+
+
+def _tarball(members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def test_get_unpack_parallel_resume(tmp_path, http_files, monkeypatch):
+    files, url, gets, fail_at = http_files
+    monkeypatch.setattr(download, 'SEGMENT_SIZE', 4096)
+    members = {'a': os.urandom(10000), 'dir/b': os.urandom(20000)}
+    files["/x.tar.gz"] = _tarball(members)
+    dst = str(tmp_path / "x.tar.gz")
+
+    # The download of the third segment fails, the others are kept
+    fail_at.add(8192)
+    with pytest.raises(Exception):
+        common.get_unpack(f"{url}/x.tar.gz", dst, str(tmp_path))
+    assert os.path.exists(f"{dst}.partial")
+    del gets[:]
+
+    common.get_unpack(f"{url}/x.tar.gz", dst, str(tmp_path))
+    # Segments that were being downloaded alongside the failed one are
+    # complete and not fetched again
+    assert "/x.tar.gz bytes=8192-12287" in gets
+    for start in [0, 4096, 12288]:
+        assert not [g for g in gets if f"bytes={start}-" in g]
+    assert open(dst, 'rb').read() == files["/x.tar.gz"]
+    assert not os.path.exists(f"{dst}.partial")
+    for name, content in members.items():
+        assert (tmp_path / name).read_bytes() == content
+
+
+def test_artifact_cache_unpack(tmp_path, http_files):
+    files, url, gets, _ = http_files
+    files["/x.tar.gz"] = _tarball({'a': b"a" * 100})
+    cache = ArtifactCache(str(tmp_path / "cache"), max_size=1024 * 1024)
+    for unpack_folder in [tmp_path / "1", tmp_path / "2"]:
+        unpack_folder.mkdir()
+        with common.unpack_stream(str(unpack_folder)) as feed:
+            cache.fetch(f"{url}/x.tar.gz", on_chunk=feed)
+        assert (unpack_folder / "a").read_bytes() == b"a" * 100
+    assert gets == ["/x.tar.gz"]
+
+
+def test_tracing_critical_path(tmp_path):
+    tracer = tracing.Tracer()
+    with tracer.span("run", category='phase'):
+        with tracer.span("boot", category='phase'):
+            threads = []
+            for d in [0.01, 0.05]:
+                def boot(d=d):
+                    with tracer.span(f"node {d}", category='node'):
+                        time.sleep(d)
+                threads.append(threading.Thread(target=tracer.wrap(boot)))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        with tracer.span("install", category='phase'):
+            time.sleep(0.01)
+
+    path = [(depth, s.name) for depth, s in tracer.critical_path()]
+    assert path == [(0, "run"), (1, "boot"), (2, "node 0.05"),
+                    (1, "install")]
+
+    tracer.export(str(tmp_path / "trace.json"))
+    with open(str(tmp_path / "trace.json")) as f:
+        events = json.load(f)['traceEvents']
+    names = [e['name'] for e in events if e['ph'] == 'X']
+    assert sorted(names) == ["boot", "install", "node 0.01", "node 0.05",
+                             "run"]
+
+
+def test_tracing_execute(monkeypatch):
+    monkeypatch.setattr(tracing.tracer, 'enabled', True)
+    with tracing.span("test_tracing_execute") as parent:
+        execute("true")
+    spans = [s for s in tracing.tracer.spans() if s.parent is parent]
+    assert [(s.name, s.category, s.args['rc']) for s in spans] == [
+        ("true", "command", 0)]
+
+    # Nothing is collected while tracing is off
+    monkeypatch.setattr(tracing.tracer, 'enabled', False)
+    count = len(tracing.tracer.spans())
+    with tracing.span("off"):
+        execute("true")
+    assert len(tracing.tracer.spans()) == count
+
+
+def test_null_hardware():
+    with Workspace() as workspace:
+        with null.Hardware(workspace, boot_latency=0.01,
+                           disk_attach_latency=0, playbook_latency=0,
+                           seed=1) as hardware:
+            hardware.boot_nodes(masters=1, workers=20)
+            assert len(hardware.masters) == 1
+            assert len(hardware.workers) == 20
+            assert len(set(n.get_ssh_ip() for n in hardware.nodes.values())) \
+                == 21
+            for node in hardware.workers:
+                assert [d['attached'] for d in node._disks.values()] == [True]
+            hardware.prepare_nodes()
+
+            with open(os.path.join(workspace.working_dir, 'inventory',
+                                   'nodes.yml')) as f:
+                inventory = yaml.safe_load(f)
+            assert len(inventory['all']['children']['worker']['hosts']) == 20
+
+
+def test_null_hardware_boot_retry(monkeypatch):
+    boots = {}
+    boot = null.Node.boot
+
+    def flaky_boot(node):
+        # The first boot of every node fails
+        boots.setdefault(node.name, []).append(time.monotonic())
+        if len(boots[node.name]) == 1:
+            raise Exception("boot failed")
+        boot(node)
+
+    monkeypatch.setattr(null.Node, 'boot', flaky_boot)
+    monkeypatch.setattr(hardware_base, 'BOOT_RETRY_BACKOFF',
+                        common.Backoff(initial=0.1, maximum=0.1, jitter=0))
+    with Workspace() as workspace:
+        with null.Hardware(workspace, boot_latency=0,
+                           disk_attach_latency=0) as hardware:
+            hardware.boot_nodes(masters=1, workers=4)
+            assert len(hardware.nodes) == 5
+            assert set(len(times) for times in boots.values()) == {2}
+            # Every retry waited for the backoff
+            for first, second in boots.values():
+                assert second - first >= 0.1
+
+            # Nodes failing every attempt are reported, not lost
+            monkeypatch.setattr(settings, 'BOOT_CONCURRENCY', 2)
+            monkeypatch.setattr(null.Node, 'boot', lambda node: 1 / 0)
+            with pytest.raises(BootError) as e:
+                hardware.boot_nodes(masters=0, workers=10, offset=4)
+            # The boots that hadn't started were cancelled
+            assert 0 < len(e.value.errors) < 10
+            for error in e.value.errors.values():
+                assert isinstance(error, ZeroDivisionError)
+            assert len(hardware.nodes) == 5
+
+
+def test_ansible_inventory(tmp_path):
+    inventory = AnsibleInventory(str(tmp_path / 'inventory'), {'a': 1})
+    inventory.add('master-0', ['master'], {'ansible_host': '10.0.0.1'})
+    inventory.add('worker-0', ['worker', 'osd'], {'ansible_host': '10.0.0.2'})
+    path = inventory.write()
+    nodes = os.path.join(path, 'nodes.yml')
+    with open(nodes) as f:
+        assert yaml.safe_load(f) == inventory.render()
+    with open(os.path.join(path, 'group_vars', 'all', 'common.yml')) as f:
+        assert yaml.safe_load(f) == {'a': 1}
+
+    # Nothing is written while the inventory is unchanged
+    os.utime(nodes, ns=(0, 0))
+    assert inventory.write() == path
+    assert os.stat(nodes).st_mtime_ns == 0
+
+    inventory.remove('worker-0')
+    inventory.write()
+    with open(nodes) as f:
+        assert yaml.safe_load(f)['all']['children'] == {
+            'master': {'hosts': {'master-0': {'ansible_host': '10.0.0.1'}}}}
+    # No temporary files are left behind
+    assert sorted(os.listdir(path)) == ['group_vars', 'nodes.yml']
+
+
+def test_workspace_ansible_config():
+    with Workspace() as workspace:
+        assert workspace._command_env()['ANSIBLE_CONFIG'] == \
+            workspace.ansible_config
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(workspace.ansible_config)
+        assert config['defaults']['fact_caching_connection'] == \
+            workspace.ansible_fact_cache_dir
+        assert config['defaults']['gathering'] == 'smart'
+        assert config['ssh_connection'].getboolean('pipelining')
+        assert 'ControlPersist=' in config['ssh_connection']['ssh_args']
+
+        # The cached facts of removed nodes are dropped
+        with null.Hardware(workspace, boot_latency=0,
+                           disk_attach_latency=0) as hardware:
+            hardware.boot_nodes(masters=1, workers=1)
+            os.makedirs(workspace.ansible_fact_cache_dir)
+            facts = os.path.join(workspace.ansible_fact_cache_dir,
+                                 hardware.workers[0].name)
+            with open(facts, 'w') as f:
+                f.write('{}')
+            hardware.node_remove(hardware.workers[0])
+            assert not os.path.exists(facts)
+            hardware.node_remove(hardware.masters[0])
+
+
+def test_null_hardware_exclusive_playbooks(monkeypatch):
+    running = set()
+    # The playbooks running when each one started
+    started = {}
+    lock = threading.Lock()
+
+    with Workspace() as workspace:
+        with null.Hardware(workspace, boot_latency=0, disk_attach_latency=0,
+                           playbook_latency=0) as hardware:
+            run = hardware._simulator.run
+
+            def track(kind, name):
+                if kind != 'playbook':
+                    return run(kind, name)
+                with lock:
+                    started[name] = set(running)
+                    running.add(name)
+                time.sleep(0.2)
+                with lock:
+                    running.remove(name)
+
+            monkeypatch.setattr(hardware._simulator, 'run', track)
+            threads = [threading.Thread(
+                target=hardware.ansible_run_playbook, args=(name,),
+                kwargs={'exclusive': exclusive})
+                for name, exclusive in [("caasp", True), ("ses", True),
+                                        ("image", False)]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    # The playbooks installing packages ran one after the other, the image
+    # upload alongside them
+    assert "ses" not in started["caasp"] and "caasp" not in started["ses"]
+    assert started["image"] or "image" in started["caasp"] | started["ses"]
+
+
+def test_null_hardware_failure_injection():
+    simulator = null.Simulator({'boot_failure_rate': 0.5, 'seed': 1})
+    failures = 0
+    for i in range(100):
+        try:
+            simulator.run('boot', f'node{i}')
+        except Exception as e:
+            assert str(e) == f"Injected boot failure for node{i}"
+            failures += 1
+    assert 30 < failures < 70
+    # Operations without a configured rate never fail
+    simulator.run('disk_attach', 'disk')
+
+
+def _pod(name, namespace="rook-ceph", version="1", **labels):
+    return kubernetes.client.V1Pod(metadata=kubernetes.client.V1ObjectMeta(
+        name=name, namespace=namespace, labels=labels,
+        resource_version=version))
+
+
+class _ScriptedWatch():
+    """
+    Replays the events put into `events`, None ends the stream and an
+    exception is raised
+    """
+    def __init__(self, events):
+        self.events = events
+
+    def stream(self, func, *args, **kwargs):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def stop(self):
+        self.events.put(None)
+
+
+def test_informer():
+    listed = [_pod("mon-a", app="rook-ceph-mon"),
+              _pod("osd-0", app="rook-ceph-osd", osd="0"),
+              _pod("other", namespace="default", app="rook-ceph-mon")]
+    events = queue.Queue()
+
+    def list_pods():
+        return kubernetes.client.V1PodList(
+            items=listed, metadata=kubernetes.client.V1ListMeta(
+                resource_version="1"))
+
+    pods = informer.Informer(list_pods, name="pods",
+                             watch_factory=lambda: _ScriptedWatch(events))
+    pods.start()
+    try:
+        assert pods.wait_for_sync(5)
+
+        def names(**kwargs):
+            return [p.metadata.name for p in pods.list(**kwargs)]
+        assert names(namespace="rook-ceph",
+                     label_selector="app=rook-ceph-mon") == ["mon-a"]
+        assert names(label_selector="app==rook-ceph-mon") == ["other", "mon-a"]
+        assert names(namespace="rook-ceph", label_selector="!osd") == ["mon-a"]
+        assert names(label_selector="app!=rook-ceph-mon,osd") == ["osd-0"]
+        assert names(field_selector="metadata.name=osd-0") == ["osd-0"]
+        with pytest.raises(ValueError):
+            pods.list(label_selector="app in (a, b)")
+        with pytest.raises(ValueError):
+            pods.list(field_selector="status.phase=Running")
+
+        def add_mons():
+            time.sleep(0.1)
+            events.put({'type': 'ADDED',
+                        'object': _pod("mon-b", version="2",
+                                       app="rook-ceph-mon")})
+            events.put({'type': 'DELETED',
+                        'object': _pod("osd-0", version="3")})
+        threading.Thread(target=add_mons).start()
+        mons = pods.wait_for(lambda objects: len(objects) == 2, "rook-ceph",
+                             label_selector="app=rook-ceph-mon", timeout=5)
+        assert [p.metadata.name for p in mons] == ["mon-a", "mon-b"]
+        pods.wait_for(lambda objects: not objects, "rook-ceph",
+                      label_selector="app=rook-ceph-osd", timeout=5)
+
+        with pytest.raises(TimeoutError):
+            pods.wait_for(lambda objects: False, "rook-ceph", timeout=0.1)
+    finally:
+        pods.stop()
+
+
+class _Kubernetes(kubernetes_base.KubernetesBase):
+    def bootstrap(self):
+        pass
+
+    def join(self, nodes):
+        pass
+
+    def install_kubernetes(self):
+        pass
+
+
+def _metadata(name, namespace="rook-ceph", **labels):
+    return kubernetes.client.V1ObjectMeta(
+        name=name, namespace=namespace, labels=labels, resource_version="1")
+
+
+class _FakeCoreV1Api():
+    """The list methods of CoreV1Api over fixed objects"""
+    def __init__(self, pods=(), services=(), pvcs=(), nodes=()):
+        self.calls = []
+        for kind, objects, list_type in [
+                ('pod', pods, kubernetes.client.V1PodList),
+                ('service', services, kubernetes.client.V1ServiceList),
+                ('persistent_volume_claim', pvcs,
+                 kubernetes.client.V1PersistentVolumeClaimList)]:
+            setattr(self, f'list_namespaced_{kind}', self._lister(
+                f'list_namespaced_{kind}', objects, list_type))
+            setattr(self, f'list_{kind}_for_all_namespaces', self._lister(
+                f'list_{kind}_for_all_namespaces', objects, list_type))
+        self.list_node = self._lister('list_node', nodes,
+                                      kubernetes.client.V1NodeList)
+
+    def _lister(self, name, objects, list_type):
+        def list_objects(namespace=None, label_selector=None,
+                         field_selector=None, **kwargs):
+            self.calls.append((name, namespace, label_selector))
+            items = [o for o in objects
+                     if namespace in (None, o.metadata.namespace)
+                     and self._selected(o, label_selector, field_selector)]
+            return list_type(items=items, metadata=kubernetes.client.
+                             V1ListMeta(resource_version="1"))
+        list_objects.__name__ = name
+        return list_objects
+
+    @staticmethod
+    def _selected(obj, label_selector, field_selector):
+        # Only equality selectors, anything else selects everything
+        for selector, values in [
+                (label_selector, obj.metadata.labels),
+                (field_selector, {'metadata.name': obj.metadata.name})]:
+            for requirement in (selector or "").split(","):
+                key, equals, value = requirement.partition("=")
+                if equals and not key.endswith("!") and values.get(
+                        key) != value:
+                    return False
+        return True
+
+
+def test_kubernetes_lists():
+    v1 = _FakeCoreV1Api(
+        pods=[kubernetes.client.V1Pod(metadata=m) for m in [
+            _metadata("mon-a", app="rook-ceph-mon"),
+            _metadata("osd-0", app="rook-ceph-osd"),
+            _metadata("other", namespace="default", app="rook-ceph-mon")]],
+        services=[kubernetes.client.V1Service(metadata=m) for m in [
+            _metadata("rook-ceph-mgr", app="rook-ceph-mgr"),
+            _metadata("kubernetes", namespace="default")]],
+        pvcs=[kubernetes.client.V1PersistentVolumeClaim(metadata=m) for m in [
+            _metadata("data-0"), _metadata("data-1", namespace="default")]],
+        nodes=[kubernetes.client.V1Node(metadata=m) for m in [
+            _metadata("master-0", namespace=None, role="master"),
+            _metadata("worker-0", namespace=None, role="worker")]])
+
+    def names(objects):
+        return sorted(o.metadata.name for o in objects)
+
+    with Workspace() as workspace:
+        k8s = _Kubernetes(workspace, None)
+        k8s.v1 = v1
+        # Straight from the API first, then from the informers
+        for informers in [None, informer.InformerCache(
+                v1, watch_factory=lambda: _ScriptedWatch(queue.Queue()))]:
+            k8s.informers = informers
+            v1.calls = []
+            try:
+                assert names(k8s.list_pods(
+                    label_selector="app=rook-ceph-mon")) == ["mon-a"]
+                assert names(k8s.list_pods(
+                    label_selector="app=rook-ceph-mon", namespace=None)) == [
+                        "mon-a", "other"]
+                assert k8s.get_pods_by_app_label("rook-ceph-mon") == [
+                    "mon-a"]
+                assert k8s.get_pods_by_app_label("rook-ceph-mds") == []
+                assert k8s.get_services_by_app_label("rook-ceph-mgr") == [
+                    "rook-ceph-mgr"]
+                assert names(k8s.list_services(
+                    field_selector="metadata.name=kubernetes")) == []
+                assert names(k8s.list_services(namespace=None)) == [
+                    "kubernetes", "rook-ceph-mgr"]
+                assert names(k8s.list_pvcs()) == ["data-0"]
+                assert names(k8s.list_pvcs(namespace=None)) == [
+                    "data-0", "data-1"]
+                assert names(k8s.list_nodes(label_selector="role=worker")) \
+                    == ["worker-0"]
+                assert names(k8s.list_nodes()) == ["master-0", "worker-0"]
+
+                if informers is None:
+                    assert ("list_namespaced_pod", "rook-ceph",
+                            "app=rook-ceph-mds") in v1.calls
+                    assert ("list_pod_for_all_namespaces", None,
+                            "app=rook-ceph-mon") in v1.calls
+                    continue
+                # Each kind was listed once to fill its informer
+                assert sorted(call[0] for call in v1.calls) == [
+                    "list_node",
+                    "list_persistent_volume_claim_for_all_namespaces",
+                    "list_pod_for_all_namespaces",
+                    "list_service_for_all_namespaces"]
+                # Selectors the informers can't evaluate go to the API
+                k8s.list_pods(label_selector="app in (rook-ceph-mon)")
+                assert v1.calls[-1] == ("list_namespaced_pod", "rook-ceph",
+                                        "app in (rook-ceph-mon)")
+            finally:
+                if informers is not None:
+                    informers.stop()
+
+
+def test_wait_for_service(monkeypatch):
+    def add_service(events, name):
+        time.sleep(0.1)
+        events.put({'type': 'ADDED', 'object': kubernetes.client.V1Service(
+            metadata=_metadata(name, app=name))})
+
+    v1 = _FakeCoreV1Api()
+    events = queue.Queue()
+    monkeypatch.setattr(kubernetes.watch, 'Watch',
+                        lambda: _ScriptedWatch(events))
+    with Workspace() as workspace:
+        k8s = _Kubernetes(workspace, None)
+        k8s.v1 = v1
+
+        # Without informers the services are watched through the API
+        threading.Thread(target=add_service,
+                         args=(events, "rook-ceph-mgr")).start()
+        assert k8s.wait_for_service("rook-ceph-mgr", sleep=1, iteration=10)
+        assert v1.calls == [("list_namespaced_service", "rook-ceph", None)]
+        assert not k8s.wait_for_service("rook-ceph-mds", sleep=0.1,
+                                        iteration=2)
+
+        informer_events = queue.Queue()
+        k8s.informers = informer.InformerCache(
+            v1, watch_factory=lambda: _ScriptedWatch(informer_events))
+        try:
+            threading.Thread(target=add_service,
+                             args=(informer_events, "rook-ceph-mds")).start()
+            assert k8s.wait_for_service("rook-ceph-mds", sleep=1,
+                                        iteration=10)
+            assert not k8s.wait_for_service("rook-ceph-rgw", sleep=0.1,
+                                            iteration=2)
+        finally:
+            k8s.informers.stop()
+
+
+class _LocalShell():
+    """A local shell behind the interface of kubernetes' WSClient"""
+    def __init__(self, shell):
+        self.process = subprocess.Popen(
+            [shell], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd="/")
+        self.buffers = {'stdout': b'', 'stderr': b''}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ,
+                               'stdout')
+        self.selector.register(self.process.stderr, selectors.EVENT_READ,
+                               'stderr')
+
+    def write_stdin(self, data):
+        self.process.stdin.write(data.encode())
+        self.process.stdin.flush()
+
+    def is_open(self):
+        return self.process.poll() is None
+
+    def update(self, timeout=0):
+        for key, _ in self.selector.select(timeout):
+            self.buffers[key.data] += os.read(key.fileobj.fileno(), 65536)
+
+    def _read(self, channel):
+        data, self.buffers[channel] = self.buffers[channel], b''
+        return data.decode()
+
+    def read_stdout(self, timeout=0):
+        return self._read('stdout')
+
+    def read_stderr(self, timeout=0):
+        return self._read('stderr')
+
+    def close(self):
+        self.selector.close()
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+
+def test_exec_session(caplog):
+    toolbox = [_pod("tools-1", app="rook-ceph-tools")]
+    toolbox[0].status = kubernetes.client.V1PodStatus(phase="Running")
+
+    class FakeKubernetes():
+        def list_pods(self, label_selector, namespace):
+            return toolbox
+
+    class LocalSession(exec_session.ExecSession):
+        connects = []
+
+        def _connect(self, pod):
+            self.connects.append(pod)
+            return _LocalShell(self._shell)
+
+    session = LocalSession(FakeKubernetes(), "app=rook-ceph-tools")
+    try:
+        assert session.execute("echo foo; echo bar >&2") == \
+            (0, "foo\n", "bar\n")
+        # stderr is logged as a warning, as by common.execute
+        assert [(r.levelno, r.getMessage()) for r in caplog.records
+                if r.name == "tools-1: echo foo; echo bar >&2"] == [
+                    (logging.INFO, "foo"), (logging.WARNING, "bar")]
+        # No trailing newline, quoting and a heredoc survive the trip
+        assert session.execute("printf '%s' \"a'b\"\ncat <<EOF\nc\nEOF") == \
+            (0, "a'bc\n", "")
+        assert session.execute("exit 3", check=False) == (3, "", "")
+        with pytest.raises(subprocess.CalledProcessError):
+            session.execute("false")
+        assert session.connects == ["tools-1"]
+
+        # The pod was rescheduled
+        toolbox[0] = _pod("tools-2", app="rook-ceph-tools")
+        toolbox[0].status = kubernetes.client.V1PodStatus(phase="Running")
+        assert session.execute("echo baz") == (0, "baz\n", "")
+        assert session.pod == "tools-2"
+
+        # The shell went away
+        session._ws.process.kill()
+        session._ws.process.wait()
+        assert session.execute("echo qux") == (0, "qux\n", "")
+        assert session.connects == ["tools-1", "tools-2", "tools-2"]
+    finally:
+        session.close()
+
+
+def test_exec_session_own_client():
+    shared = kubernetes.client.ApiClient(kubernetes.client.Configuration())
+
+    class FakeKubernetes():
+        api_client = shared
+        v1 = kubernetes.client.CoreV1Api(shared)
+
+    session = exec_session.ExecSession(FakeKubernetes(), "app=rook-ceph-tools")
+    api = session._exec_api()
+    # The stream never touches the client used by everything else
+    assert api.api_client is not shared
+    assert api.api_client.configuration is shared.configuration
+    assert session._exec_api().api_client is api.api_client
+    session.close()
+    assert session._exec_api().api_client is not api.api_client
+    session.close()
+    shared.close()
+
+
+def test_ceph_client():
+    status = {
+        'health': {'status': 'HEALTH_WARN', 'checks': {
+            'OSD_DOWN': {'severity': 'HEALTH_WARN',
+                         'summary': {'message': '1 osds down'}}}},
+        # Nautilus nests the osdmap counters
+        'osdmap': {'osdmap': {'num_osds': 3, 'num_up_osds': 2,
+                              'num_in_osds': 3}},
+        'pgmap': {'num_pgs': 8, 'pgs_by_state': [
+            {'state_name': 'active+clean', 'count': 6},
+            {'state_name': 'undersized+degraded', 'count': 2}]},
+        'quorum_names': ['a', 'b', 'c'],
+    }
+    fs_dump = {'filesystems': [{'mdsmap': {
+        'fs_name': 'myfs', 'max_mds': 1,
+        'info': {'gid_1': {'state': 'up:active'},
+                 'gid_2': {'state': 'up:standby-replay'}}}}]}
+    scripts = []
+
+    def execute(script, check=True):
+        scripts.append(script)
+        outputs = [json.dumps(status), json.dumps(fs_dump)]
+        stdout = "".join(f"{o}\n\n{ceph._SEPARATOR} 0\n" for o in outputs)
+        return 0, stdout, ""
+
+    client = ceph.CephClient(execute, ttl=60)
+    result = client.status()
+    assert result.health == ceph.Health(
+        'HEALTH_WARN', {'OSD_DOWN': '1 osds down'})
+    assert result.osdmap == ceph.OSDMap(3, 2, 3)
+    assert result.pgmap.num_pgs == 8
+    assert not result.pgmap.all_active_clean
+    assert result.quorum == ['a', 'b', 'c']
+    assert result.filesystems['myfs'].active == 1
+    assert len(scripts) == 1
+    assert "ceph -f json status;" in scripts[0]
+    assert "ceph -f json fs dump;" in scripts[0]
+
+    # Concurrent callers share the snapshot
+    threads = [threading.Thread(target=client.status) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(scripts) == 1
+    client.status(max_age=0)
+    assert len(scripts) == 2
+
+    def failing(script, check=True):
+        return 0, f"{ceph._SEPARATOR} 1\n", "Error EINVAL"
+    with pytest.raises(Exception, match="`ceph status` failed with rc 1"):
+        ceph.CephClient(failing).status()
+
+
+def test_ceph_client_shell(tmp_path):
+    # The generated script reports the rc of each ceph command when run by a
+    # real shell
+    fake_ceph = tmp_path / "ceph"
+    fake_ceph.write_text(
+        "#!/bin/sh\n"
+        "case \"$*\" in\n"
+        "  '-f json status') echo '{\"quorum_names\": [\"a\"]}' ;;\n"
+        "  *) echo \"Error EINVAL: $*\" >&2; exit 22 ;;\n"
+        "esac\n")
+    fake_ceph.chmod(0o755)
+    env = {'PATH': f"{tmp_path}:{os.environ['PATH']}"}
+
+    def execute(script, check=True):
+        return common.execute(script, capture=True, check=check, env=env,
+                              log_stdout=False)
+
+    client = ceph.CephClient(execute)
+    assert client.query("status") == [{'quorum_names': ['a']}]
+    with pytest.raises(Exception,
+                       match="`ceph osd tree` failed with rc 22"):
+        client.query("status", "osd tree")
+
+
+class _LogResponse():
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, amt):
+        for i in range(0, len(self.data), amt):
+            yield self.data[i:i + amt]
+
+    def release_conn(self):
+        pass
+
+
+def test_gather_pod_logs(tmp_path, monkeypatch):
+    class FakeV1():
+        def read_namespaced_pod_log(self, name, namespace, container,
+                                    previous, _preload_content):
+            if container == "broken":
+                raise Exception("container not found")
+            return _LogResponse(
+                f"{container} {'previous' if previous else 'current'}\n"
+                .encode() * 100)
+
+    pod = kubernetes.client.V1Pod(
+        metadata=kubernetes.client.V1ObjectMeta(name="osd-0",
+                                                namespace="rook-ceph"),
+        status=kubernetes.client.V1PodStatus(
+            init_container_statuses=[kubernetes.client.V1ContainerStatus(
+                name="init", restart_count=0, image="", image_id="",
+                ready=True)],
+            container_statuses=[kubernetes.client.V1ContainerStatus(
+                name=name, restart_count=restarts, image="", image_id="",
+                ready=True) for name, restarts in [("osd", 1),
+                                                   ("broken", 0),
+                                                   ("log", 0)]]))
+
+    monkeypatch.setattr(kubernetes_base, 'CHUNK_SIZE', 100)
+    monkeypatch.setattr(kubernetes_base, 'GATHER_LOGS_BYTES_PER_POD', 4000)
+    with Workspace() as workspace:
+        k8s = _Kubernetes(workspace, None)
+        k8s.v1 = FakeV1()
+        k8s._gather_pod_logs(pod, str(tmp_path))
+        # Containers recorded during the run are left out
+        os.makedirs(str(tmp_path / "skip"))
+        k8s._gather_pod_logs(pod, str(tmp_path / "skip"),
+                             skip={"init", "osd", "broken"})
+        k8s._gather_pod_logs(pod, str(tmp_path / "skip_all"),
+                             skip={"init", "osd", "broken", "log"})
+    assert not (tmp_path / "skip_all").exists()
+    with gzip.open(str(tmp_path / "skip" / "osd-0.txt.gz"), 'rt') as f:
+        assert f.read().splitlines()[0] == "*** log ***"
+
+    with gzip.open(str(tmp_path / "osd-0.txt.gz"), 'rt') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "*** init ***"
+    assert lines[1:101] == ["init current"] * 100
+    assert lines[101] == "*** osd (previous) ***"
+    assert lines[102] == "osd previous"
+    assert "*** osd ***" in lines
+    assert "*** broken ***" in lines
+    # The log container goes over the limit
+    assert 0 < lines.count("log current") < 100
+    assert lines[-1] == "*** Log limit reached, truncated ***"
+
+
+def test_recorder(tmp_path, monkeypatch):
+    def container(name, restarts, running=True):
+        state = kubernetes.client.V1ContainerState(
+            running=kubernetes.client.V1ContainerStateRunning()
+            if running else None,
+            waiting=None if running
+            else kubernetes.client.V1ContainerStateWaiting())
+        return kubernetes.client.V1ContainerStatus(
+            name=name, restart_count=restarts, image="", image_id="",
+            ready=running, state=state)
+
+    mon = _pod("mon-a", app="rook-ceph-mon")
+    mon.status = kubernetes.client.V1PodStatus(
+        container_statuses=[container("mon", 0), container("log", 0, False),
+                            container("flaky", 0)])
+    events = queue.Queue()
+    flaky = {'attempts': 0, 'available': threading.Event()}
+
+    class FakeV1():
+        def read_namespaced_pod_log(self, name, namespace, container, follow,
+                                    _preload_content):
+            if container == "flaky" and not flaky['available'].is_set():
+                flaky['attempts'] += 1
+                raise kubernetes.client.rest.ApiException(status=400)
+            return _LogResponse(f"{name} {container}\n".encode() * 10)
+
+        def list_event_for_all_namespaces(self):
+            return kubernetes.client.CoreV1EventList(
+                items=[kubernetes.client.CoreV1Event(
+                    metadata=kubernetes.client.V1ObjectMeta(
+                        name="e1", uid="1", resource_version="1"),
+                    involved_object=kubernetes.client.V1ObjectReference(),
+                    reason="Scheduled")],
+                metadata=kubernetes.client.V1ListMeta(resource_version="1"))
+
+    class FakeKubernetes():
+        def list_pods(self, label_selector, namespace):
+            if label_selector == "app=rook-ceph-mon":
+                return [mon]
+            return []
+
+    monkeypatch.setattr(recorder, 'DISCOVERY_INTERVAL', 0.05)
+    r = recorder.Recorder(FakeKubernetes(), str(tmp_path),
+                          watch_factory=lambda: _ScriptedWatch(events),
+                          v1=FakeV1())
+    r.start()
+    events.put({'type': 'ADDED', 'object': kubernetes.client.CoreV1Event(
+        metadata=kubernetes.client.V1ObjectMeta(
+            name="e2", uid="2", resource_version="2"),
+        involved_object=kubernetes.client.V1ObjectReference(),
+        reason="Pulled")})
+    common.wait_until(lambda: flaky['attempts'], decode=None,
+                      matcher=lambda attempts: attempts >= 2,
+                      timeout=5, backoff=common.Backoff(initial=0.05))
+    # Only the containers whose log could be opened count as recorded, the
+    # others are tried again
+    assert r.recorded_containers == [("rook-ceph", "mon-a", "mon")]
+    flaky['available'].set()
+    common.wait_until(lambda: r.recorded_containers, decode=None,
+                      matcher=lambda recorded: len(recorded) == 2,
+                      timeout=5, backoff=common.Backoff(initial=0.05))
+    assert r.recorded_containers == [("rook-ceph", "mon-a", "flaky"),
+                                     ("rook-ceph", "mon-a", "mon")]
+    # The container restarted
+    mon.status.container_statuses[0] = container("mon", 1)
+    time.sleep(0.2)
+    r.stop()
+
+    logs = sorted(os.listdir(str(tmp_path / "pod_logs")))
+    assert logs == ["rook-ceph_mon-a_flaky_0.log.gz",
+                    "rook-ceph_mon-a_mon_0.log.gz",
+                    "rook-ceph_mon-a_mon_1.log.gz"]
+    with gzip.open(str(tmp_path / "pod_logs" / logs[1]), 'rt') as f:
+        assert f.read() == "mon-a mon\n" * 10
+    with gzip.open(str(tmp_path / "events.jsonl.gz"), 'rt') as f:
+        reasons = [json.loads(line)['reason'] for line in f]
+    assert reasons == ["Scheduled", "Pulled"]
+
+
+def test_recorder_writer_errors(tmp_path):
+    writer = recorder._Writer(max_queued=2)
+    good = str(tmp_path / "good.gz")
+    bad = str(tmp_path / "missing" / "bad.gz")
+    # Far more chunks than fit in the queue, so the writer has to keep
+    # draining it after failing to write `bad`
+    for i in range(10):
+        writer.write(bad, b"lost\n")
+        writer.write(good, b"kept\n")
+    writer.close()
+    with gzip.open(good, 'rt') as f:
+        assert f.read() == "kept\n" * 10
+
+
+def test_recorder_limits_followers(tmp_path, monkeypatch):
+    running = kubernetes.client.V1ContainerState(
+        running=kubernetes.client.V1ContainerStateRunning())
+    osd = _pod("osd-0", app="rook-ceph-osd-prepare")
+    osd.status = kubernetes.client.V1PodStatus(container_statuses=[
+        kubernetes.client.V1ContainerStatus(
+            name=f"c{i}", restart_count=0, image="", image_id="", ready=True,
+            state=running) for i in range(4)])
+    following = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+
+    class SlowLog(_LogResponse):
+        def stream(self, amt):
+            with lock:
+                following['now'] += 1
+                following['max'] = max(following['max'], following['now'])
+            time.sleep(0.1)
+            yield from super().stream(amt)
+            with lock:
+                following['now'] -= 1
+
+    class FakeV1():
+        def read_namespaced_pod_log(self, name, namespace, container, follow,
+                                    _preload_content):
+            return SlowLog(f"{container}\n".encode())
+
+        def list_event_for_all_namespaces(self):
+            return kubernetes.client.CoreV1EventList(
+                items=[],
+                metadata=kubernetes.client.V1ListMeta(resource_version="1"))
+
+    class FakeKubernetes():
+        def list_pods(self, label_selector, namespace):
+            return [osd] if label_selector == "app=rook-ceph-osd-prepare" \
+                else []
+
+    monkeypatch.setattr(recorder, 'DISCOVERY_INTERVAL', 0.05)
+    monkeypatch.setattr(recorder, 'MAX_FOLLOWERS', 2)
+    r = recorder.Recorder(FakeKubernetes(), str(tmp_path),
+                          watch_factory=lambda: _ScriptedWatch(queue.Queue()),
+                          v1=FakeV1())
+    r.start()
+    common.wait_until(
+        lambda: len(os.listdir(str(tmp_path / "pod_logs"))), decode=None,
+        matcher=lambda logs: logs == 4, timeout=5,
+        backoff=common.Backoff(initial=0.05))
+    r.stop()
+    # All containers were followed, but never more than two at a time
+    assert following['max'] == 2
+
+
+def test_wait_for_objects(monkeypatch):
+    def watch(*events):
+        queued = queue.Queue()
+        for event in events:
+            queued.put(event)
+        streams = []
+
+        class Watch(_ScriptedWatch):
+            def stream(self, func, *args, **kwargs):
+                streams.append(kwargs['resource_version'])
+                return super().stream(func, *args, **kwargs)
+        monkeypatch.setattr(kubernetes.watch, 'Watch',
+                            lambda: Watch(queued))
+        return streams
+
+    def lister(*results):
+        results = list(results)
+
+        def list_namespaced_pod(namespace, **kwargs):
+            assert namespace == "rook-ceph"
+            assert kwargs == {'label_selector': "app=rook-ceph-mon"}
+            pods, version = results.pop(0)
+            return kubernetes.client.V1PodList(
+                items=pods, metadata=kubernetes.client.V1ListMeta(
+                    resource_version=version))
+        return list_namespaced_pod
+
+    def names(pods):
+        return sorted(p.metadata.name for p in pods)
+
+    def names_matcher(expected):
+        return lambda pods: names(pods) == expected
+
+    # Typed models are followed through ADDED, MODIFIED and DELETED events
+    streams = watch(
+        {'type': 'ADDED', 'object': _pod("mon-b", version="2")},
+        {'type': 'MODIFIED', 'object': _pod("mon-a", version="3")},
+        {'type': 'DELETED', 'object': _pod("osd-0", version="4")})
+    pods = waiters.wait_for_objects(
+        lister(([_pod("mon-a"), _pod("osd-0")], "1")),
+        names_matcher(["mon-a", "mon-b"]), "rook-ceph",
+        label_selector="app=rook-ceph-mon", timeout=10)
+    assert names(pods) == ["mon-a", "mon-b"]
+    assert [p.metadata.resource_version for p in pods
+            if p.metadata.name == "mon-a"] == ["3"]
+    assert streams == ["1"]
+
+    # An expired watch (410 Gone) relists and watches from the new version
+    streams = watch(kubernetes.client.rest.ApiException(status=410),
+                    {'type': 'ADDED', 'object': _pod("mon-c", version="7")})
+    pods = waiters.wait_for_objects(
+        lister(([_pod("mon-a")], "1"), ([_pod("mon-a"), _pod("mon-b")], "6")),
+        names_matcher(["mon-a", "mon-b", "mon-c"]), "rook-ceph",
+        label_selector="app=rook-ceph-mon", timeout=10)
+    assert names(pods) == ["mon-a", "mon-b", "mon-c"]
+    assert streams == ["1", "6"]
+
+    # Other API errors are raised
+    watch(kubernetes.client.rest.ApiException(status=500))
+    with pytest.raises(kubernetes.client.rest.ApiException):
+        waiters.wait_for_objects(
+            lister(([], "1")), names_matcher(["mon-a"]), "rook-ceph",
+            label_selector="app=rook-ceph-mon", timeout=10)
+
+    watch()
+    with pytest.raises(TimeoutError):
+        waiters.wait_for_objects(
+            lister(([_pod("mon-a")], "1")), names_matcher([]), "rook-ceph",
+            label_selector="app=rook-ceph-mon", timeout=0)
+
+
+def test_resource_matchers():
+    def pod(phase, *running):
+        return kubernetes.client.V1Pod(
+            metadata=kubernetes.client.V1ObjectMeta(name="p"),
+            status=kubernetes.client.V1PodStatus(
+                phase=phase, container_statuses=[
+                    kubernetes.client.V1ContainerStatus(
+                        name="c", restart_count=0, image="", image_id="",
+                        ready=r, state=kubernetes.client.V1ContainerState(
+                            running=kubernetes.client.V1ContainerStateRunning(
+                            ) if r else None))
+                    for r in running]))
+
+    running = waiters.pods_running_matcher()
+    assert running([pod("Running", True, True)])
+    # Running is only reported once every container runs
+    assert not running([pod("Running", True, False)])
+    assert not running([pod("Pending")])
+    assert not running([])
+    assert waiters.pods_running_matcher(2)(
+        [pod("Running", True), pod("Pending"), pod("Running")])
+    assert not waiters.pods_running_matcher(2)(
+        [pod("Running", True), pod("Pending")])
+
+    def node(*conditions):
+        return kubernetes.client.V1Node(
+            metadata=kubernetes.client.V1ObjectMeta(name="n"),
+            status=kubernetes.client.V1NodeStatus(conditions=[
+                kubernetes.client.V1NodeCondition(type=type, status=status)
+                for type, status in conditions] or None))
+
+    ready = waiters.nodes_ready_matcher(2)
+    assert ready([node(("Ready", "True")),
+                  node(("MemoryPressure", "False"), ("Ready", "True"))])
+    assert not ready([node(("Ready", "True")), node(("Ready", "False"))])
+    assert not ready([node(("Ready", "True")), node(("Ready", "Unknown")),
+                      node()])
+    assert not ready([node(("MemoryPressure", "True")),
+                      node(("Ready", "True"))])
+
+
+def test_pods_failed_checker():
+    def pod(name, reason=None, restarts=0, phase="Pending", owner=None):
+        p = _pod(name)
+        if owner:
+            p.metadata.owner_references = [kubernetes.client.V1OwnerReference(
+                api_version="batch/v1", kind=owner, name="job", uid="1")]
+        waiting = kubernetes.client.V1ContainerStateWaiting(
+            reason=reason, message="bad") if reason else None
+        p.status = kubernetes.client.V1PodStatus(
+            phase=phase, container_statuses=[
+                kubernetes.client.V1ContainerStatus(
+                    name="c", restart_count=restarts, image="", image_id="",
+                    ready=False, state=kubernetes.client.V1ContainerState(
+                        waiting=waiting))])
+        return p
+
+    check = waiters.pods_failed_checker(grace=0.1)
+    check([pod("creating", "ContainerCreating"),
+           pod("crashed-once", "CrashLoopBackOff", restarts=1),
+           pod("job-retry", phase="Failed", owner="Job"),
+           pod("pulling", "ImagePullBackOff")])
+    time.sleep(0.1)
+    # Stuck for longer than the grace period
+    with pytest.raises(waiters.PodFailedError) as e:
+        check([pod("pulling", "ImagePullBackOff")])
+    assert e.value.pod.metadata.name == "pulling"
+    assert e.value.reason == "ImagePullBackOff (container c: bad)"
+    # Crash loops and failed pods are reported straight away
+    with pytest.raises(waiters.PodFailedError):
+        waiters.pods_failed_checker()(
+            [pod("crashing", "CrashLoopBackOff", restarts=3)])
+    with pytest.raises(waiters.PodFailedError):
+        waiters.pods_failed_checker()([pod("failed", phase="Failed")])
+
+    # Waits end as soon as the check raises
+    events = queue.Queue()
+
+    def list_pods():
+        return kubernetes.client.V1PodList(
+            items=[pod("osd-0")], metadata=kubernetes.client.V1ListMeta(
+                resource_version="1"))
+
+    pods = informer.Informer(list_pods, name="pods",
+                             watch_factory=lambda: _ScriptedWatch(events))
+    pods.start()
+    try:
+        threading.Timer(0.1, events.put, [{
+            'type': 'MODIFIED',
+            'object': pod("osd-0", "CrashLoopBackOff", restarts=5)}]).start()
+        start = time.monotonic()
+        with pytest.raises(waiters.PodFailedError):
+            pods.wait_for(waiters.pods_running_matcher(1), "rook-ceph",
+                          timeout=30, abort=waiters.pods_failed_checker())
+        assert time.monotonic() - start < 5
+    finally:
+        pods.stop()
+
+    def failing():
+        raise waiters.PodFailedError(pod("osd-0"), "Failed")
+    with pytest.raises(waiters.PodFailedError):
+        common.wait_until(lambda: (0, "HEALTH_WARN", ""),
+                          matcher=common.simple_matcher("HEALTH_OK"),
+                          abort=failing)
+
+
+def test_ceph_resource_waiters(monkeypatch):
+    def cluster(phase, health="", message=""):
+        return {'kind': 'CephCluster',
+                'metadata': {'namespace': 'rook-ceph', 'name': 'rook-ceph',
+                             'resourceVersion': phase + health},
+                'status': {'phase': phase, 'message': message,
+                           'ceph': {'health': health}}}
+
+    assert not waiters.ceph_resources_ready_matcher()([{'metadata': {}}])
+    assert waiters.ceph_resources_ready_matcher()([cluster("Ready")])
+    assert not waiters.ceph_resources_ready_matcher(health="HEALTH_OK")(
+        [cluster("Ready", "HEALTH_WARN")])
+
+    check = waiters.ceph_resources_failed_checker(grace=0.1)
+    check([cluster("Failure", message="no mons")])
+    check([cluster("Progressing")])
+    # The failure cleared, so the grace period starts over
+    check([cluster("Failure", message="no mons")])
+    time.sleep(0.1)
+    with pytest.raises(waiters.CephResourceFailedError) as e:
+        check([cluster("Failure", message="no mons")])
+    assert e.value.reason == "no mons"
+
+    # Waits follow the status from the watch
+    events = queue.Queue()
+    monkeypatch.setattr(kubernetes.watch, 'Watch',
+                        lambda: _ScriptedWatch(events))
+
+    def list_clusters(group, version, namespace, plural, **kwargs):
+        assert (group, plural) == ("ceph.rook.io", "cephclusters")
+        return {'items': [cluster("Progressing")],
+                'metadata': {'resourceVersion': "1"}}
+
+    for event in (cluster("Ready", "HEALTH_WARN"), cluster("Ready",
+                                                           "HEALTH_OK")):
+        events.put({'type': 'MODIFIED', 'object': event})
+    resources = waiters.wait_for_objects(
+        list_clusters, waiters.ceph_resources_ready_matcher(
+            health="HEALTH_OK"),
+        "ceph.rook.io", "v1", "rook-ceph", "cephclusters", timeout=10,
+        abort=waiters.ceph_resources_failed_checker())
+    assert resources[0]['status']['ceph']['health'] == "HEALTH_OK"
+
+
+def test_apply_manifests(tmp_path):
+    (tmp_path / "common.yaml").write_text("""
+apiVersion: v1
+kind: ServiceAccount
+metadata:
+  name: rook-ceph-system
+  namespace: rook-ceph
+---
+apiVersion: apiextensions.k8s.io/v1
+kind: CustomResourceDefinition
+metadata:
+  name: cephclusters.ceph.rook.io
+---
+""")
+    (tmp_path / "cluster.yaml").write_text("""
+apiVersion: ceph.rook.io/v1
+kind: CephCluster
+metadata:
+  name: rook-ceph
+  namespace: rook-ceph
+---
+apiVersion: v1
+kind: List
+items:
+- apiVersion: v1
+  kind: ConfigMap
+  metadata:
+    name: rook-config-override
+    namespace: rook-ceph
+""")
+    documents = manifests.load_documents(str(tmp_path / "cluster.yaml"),
+                                         str(tmp_path / "common.yaml"))
+    assert [d['kind'] for d in documents] == [
+        "CephCluster", "ConfigMap", "ServiceAccount",
+        "CustomResourceDefinition"]
+
+    class Resource():
+        def __init__(self, kind):
+            self.kind = kind
+            self.namespaced = kind != "CustomResourceDefinition"
+
+    class Resources():
+        crds_served = False
+
+        def get(self, api_version, kind):
+            if kind == "CephCluster" and not self.crds_served:
+                raise ResourceNotFoundError("not served yet")
+            return Resource(kind)
+
+        def invalidate_cache(self):
+            self.crds_served = applied.count("CustomResourceDefinition") > 0
+
+    existing = {"ServiceAccount": "1", "ConfigMap": "5"}
+    applied = []
+
+    class FakeDynamicClient():
+        resources = Resources()
+
+        def get(self, resource, name, namespace):
+            if resource.kind not in existing:
+                raise NotFoundError(
+                    kubernetes.client.rest.ApiException(status=404))
+            return types.SimpleNamespace(metadata=types.SimpleNamespace(
+                resourceVersion=existing[resource.kind]))
+
+        def server_side_apply(self, resource, body, name, namespace,
+                              field_manager, force_conflicts):
+            assert field_manager == "rookcheck"
+            assert namespace == (None if resource.kind ==
+                                 "CustomResourceDefinition" else "rook-ceph")
+            applied.append(resource.kind)
+            version = "6" if resource.kind == "ConfigMap" else \
+                existing.get(resource.kind, "1")
+            return types.SimpleNamespace(metadata=types.SimpleNamespace(
+                resourceVersion=version))
+
+    results = manifests.ManifestApplier(FakeDynamicClient()).apply(documents)
+    assert applied[0] == "CustomResourceDefinition"
+    assert sorted(applied[1:3]) == ["ConfigMap", "ServiceAccount"]
+    assert applied[3] == "CephCluster"
+    assert sorted((r.kind, r.action) for r in results) == [
+        ("CephCluster", "created"), ("ConfigMap", "configured"),
+        ("CustomResourceDefinition", "created"),
+        ("ServiceAccount", "unchanged")]
+
+
+def test_manifest_store(tmp_path):
+    path = tmp_path / "cluster.yaml"
+    path.write_text("""
+apiVersion: ceph.rook.io/v1
+kind: CephCluster
+metadata:
+  name: rook-ceph
+spec:
+  mon:
+    count: 3
+  healthCheck:
+    livenessProbe:
+      mon:
+        disabled: false
+---
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: other
+""")
+    store = manifests.ManifestStore()
+    documents = store.load(str(path))
+    assert store.load(str(path)) is documents
+    with pytest.raises(TypeError):
+        documents[0]['spec']['mon']['count'] = 5
+
+    overlays = [
+        manifests.Overlay('CephCluster', {'spec': {
+            'mon': {'count': 5, 'allowMultiplePerNode': True},
+            'healthCheck': None}}),
+        manifests.Overlay('ConfigMap', {'data': {'a': 'b'}}, name='missing'),
+    ]
+    cluster, config_map = store.render(str(path), overlays=overlays)
+    assert cluster['spec'] == {
+        'mon': {'count': 5, 'allowMultiplePerNode': True}}
+    assert 'data' not in config_map
+    # The parsed tree is left untouched
+    assert store.load(str(path))[0]['spec']['mon']['count'] == 3
+
+    # Changed files are parsed again
+    with open(str(path), 'w') as f:
+        yaml.safe_dump(cluster, f)
+    os.utime(str(path), ns=(0, 0))
+    reloaded = store.load(str(path))
+    assert reloaded is not documents
+    assert len(reloaded) == 1
+    assert reloaded[0]['spec']['mon']['count'] == 5
+
+
+def test_scheduler():
+    ran = []
+    lock = threading.Lock()
+
+    def step(name, duration=0.0):
+        def run():
+            time.sleep(duration)
+            with lock:
+                ran.append(name)
+        return run
+
+    graph = scheduler.Scheduler("install")
+    graph.add("namespace", step("namespace"))
+    graph.add("operator", step("operator", 0.2), requires=["namespace"])
+    graph.add("toolbox", step("toolbox", 0.1), requires=["namespace"])
+    graph.add("rbd", step("rbd", 0.1), requires=["namespace"])
+    graph.add("health", step("health"), requires=["operator", "toolbox"])
+    with pytest.raises(ValueError):
+        graph.add("rbd", step("rbd"))
+
+    start = time.monotonic()
+    timings = graph.run()
+    # The independent steps overlap
+    assert time.monotonic() - start < 0.35
+    assert ran[0] == "namespace" and ran[-1] == "health"
+    assert set(timings) == {"namespace", "operator", "toolbox", "rbd",
+                            "health"}
+    assert timings["health"].start >= timings["operator"].end
+    assert [t.name for t in graph.critical_path()] == [
+        "namespace", "operator", "health"]
+
+    cycle = scheduler.Scheduler("cycle")
+    cycle.add("a", step("a"), requires=["b"])
+    cycle.add("b", step("b"), requires=["a"])
+    with pytest.raises(ValueError):
+        cycle.run()
+    unknown = scheduler.Scheduler("unknown")
+    unknown.add("a", step("a"), requires=["missing"])
+    with pytest.raises(ValueError):
+        unknown.run()
+
+    # A failing step stops the graph and its error is raised
+    def fail():
+        time.sleep(0.1)
+        raise RuntimeError("no operator")
+
+    def wait_forever():
+        common.wait_until(lambda: False, timeout=60,
+                          backoff=common.Backoff(initial=0.05, maximum=0.05))
+
+    def install():
+        # A graph run within a step is cancelled along with it
+        nested = scheduler.Scheduler("nested")
+        nested.add("cluster_ready", wait_forever)
+        nested.run()
+
+    ran.clear()
+    failing = scheduler.Scheduler("failing")
+    failing.add("operator", fail)
+    failing.add("build", lambda: execute("sleep 60"))
+    failing.add("install", install)
+    failing.add("cluster", step("cluster"), requires=["operator"])
+    start = time.monotonic()
+    with pytest.raises(scheduler.StepFailedError) as e:
+        failing.run()
+    assert e.value.step == "operator"
+    assert isinstance(e.value.__cause__, RuntimeError)
+    # The running steps were cancelled rather than waited for, the one
+    # depending on the failure was not started
+    assert time.monotonic() - start < 10
+    assert set(failing.timings) == set()
+    assert ran == []
+    assert not scheduler.cancelled()